@@ -0,0 +1,145 @@
+# -*- test-case-name: vumi.components.tests.test_delay_queue -*-
+
+"""A redis-backed queue of items that become due after a delay."""
+
+import time
+
+from twisted.internet.defer import returnValue
+
+from vumi.persist.redis_base import Manager, RedisScript
+
+
+def _fake_claim(fake_redis, keys, args):
+    [queue_key, payloads_key], [now, visible_at, limit] = keys, args
+    item_ids = fake_redis.zrangebyscore.sync(
+        fake_redis, queue_key, '-inf', float(now), 0, int(limit))
+    result = []
+    for item_id in item_ids:
+        fake_redis.zadd.sync(fake_redis, queue_key, **{
+            item_id: float(visible_at)})
+        result.append(item_id)
+        result.append(fake_redis.hget.sync(fake_redis, payloads_key, item_id))
+    return result
+
+
+# Returns a flat list of ids and payloads of items that are due, and hides
+# them until they become visible again.
+CLAIM = RedisScript("""
+local item_ids = redis.call(
+    'ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[3])
+local result = {}
+for _, item_id in ipairs(item_ids) do
+    redis.call('ZADD', KEYS[1], ARGV[2], item_id)
+    table.insert(result, item_id)
+    table.insert(result, redis.call('HGET', KEYS[2], item_id))
+end
+return result
+""", _fake_claim)
+
+
+class DelayQueue(object):
+    """
+    A queue of items that each become due at a given time.
+
+    Items are kept in a single sorted set scored by the time they're due.
+    Due items are claimed in bulk. Claiming an item hides it for
+    `visibility_timeout` seconds rather than removing it, so an item that
+    isn't acked before then is claimed again. Every item is therefore
+    delivered at least once, even if whoever claimed it goes away.
+
+    :param redis:
+        Redis manager object. All keys are written under it, so give each
+        queue its own sub-manager.
+    :param int visibility_timeout:
+        Seconds a claimed item is hidden for before it may be claimed
+        again. Defaults to DEFAULT_VISIBILITY_TIMEOUT.
+    :param int claim_limit:
+        The most items a single claim returns. Defaults to
+        DEFAULT_CLAIM_LIMIT.
+    """
+
+    QUEUE_KEY = 'queue'
+    PAYLOADS_KEY = 'payloads'
+
+    DEFAULT_VISIBILITY_TIMEOUT = 60
+    DEFAULT_CLAIM_LIMIT = 1000
+
+    def __init__(self, redis, visibility_timeout=None, claim_limit=None):
+        # Store redis as `manager` as well since @Manager.calls_manager
+        # requires it to be named as such.
+        self.redis = self.manager = redis
+        self.visibility_timeout = (visibility_timeout or
+                                   self.DEFAULT_VISIBILITY_TIMEOUT)
+        self.claim_limit = claim_limit or self.DEFAULT_CLAIM_LIMIT
+
+    def get_time(self):
+        return time.time()
+
+    @Manager.calls_manager
+    def add(self, item_id, delay=0, payload=None, now=None):
+        """
+        Add an item that becomes due `delay` seconds after `now`.
+
+        Adding an item that's already queued reschedules it.
+
+        :param str item_id:
+            The item's id.
+        :param float delay:
+            Seconds until the item is due.
+        :param str payload:
+            Optional data returned with the item when it's claimed.
+        :param float now:
+            The time to count the delay from. Defaults to the current time.
+        """
+        if now is None:
+            now = self.get_time()
+        pipe = self.redis.pipeline()
+        if payload is not None:
+            pipe.hset(self.PAYLOADS_KEY, item_id, payload)
+        pipe.zadd(self.QUEUE_KEY, **{item_id: now + delay})
+        yield pipe.execute()
+
+    @Manager.calls_manager
+    def claim(self, now=None, limit=None):
+        """
+        Claim items that are due at `now`, earliest first.
+
+        Returns a list of `(item_id, payload)` pairs. Claimed items should be
+        passed to :meth:`ack` once they've been dealt with.
+        """
+        if now is None:
+            now = self.get_time()
+        result = yield self.redis.run_script(CLAIM, [
+            self.QUEUE_KEY,
+            self.PAYLOADS_KEY,
+        ], [repr(now), repr(now + self.visibility_timeout),
+            limit or self.claim_limit])
+        returnValue(zip(result[::2], result[1::2]))
+
+    @Manager.calls_manager
+    def ack(self, item_ids):
+        """
+        Remove items from the queue for good.
+        """
+        if not item_ids:
+            return
+        pipe = self.redis.pipeline()
+        for item_id in item_ids:
+            pipe.zrem(self.QUEUE_KEY, item_id)
+        pipe.hdel(self.PAYLOADS_KEY, *item_ids)
+        yield pipe.execute()
+
+    def get_payload(self, item_id):
+        return self.redis.hget(self.PAYLOADS_KEY, item_id)
+
+    def get_due_time(self, item_id):
+        """
+        Return the time `item_id` is next due or `None` if it isn't queued.
+        """
+        return self.redis.zscore(self.QUEUE_KEY, item_id)
+
+    def get_item_ids(self):
+        return self.redis.zrange(self.QUEUE_KEY, 0, -1)
+
+    def count(self):
+        return self.redis.zcard(self.QUEUE_KEY)
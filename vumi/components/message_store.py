@@ -3,9 +3,12 @@
 
 """Message store."""
 
+from bisect import bisect_right
+from itertools import chain
 from uuid import uuid4
 
-from twisted.internet.defer import returnValue, inlineCallbacks
+from twisted.internet.defer import (
+    returnValue, inlineCallbacks, DeferredList, gatherResults)
 
 from vumi.message import TransportEvent, TransportUserMessage
 from vumi.persist.model import Model, Manager
@@ -13,6 +16,7 @@ from vumi.persist.fields import (VumiMessage, ForeignKey, ListOf, Tag, Dynamic,
                                  Unicode)
 from vumi.persist.txriak_manager import TxRiakManager
 from vumi import log
+from vumi.utils import LRUCache
 from vumi.components.message_store_cache import MessageStoreCache
 
 
@@ -86,16 +90,35 @@ class MessageStore(object):
     A small amount of information about the state of a batch (i.e. number
     of messages in the batch, messages sent, acknowledgements and delivery
     reports received) is stored in Redis.
+
+    The batch each outbound message belongs to is also kept in Redis, and
+    the most recently used of these in memory, so that events can be
+    counted against the right batch without loading their message.
+
+    :param int batch_lookup_cache_size:
+        How many message_id to batch_id mappings to keep in memory.
+        Default is 10000.
+    :param dict cache_retention:
+        Options for the cache, such as how many of the most recent keys to
+        keep for each batch. Accepts `max_keys`, `max_age`,
+        `throughput_history` and `throughput_resolution` options, as
+        described in :class:`MessageStoreCache`.
     """
 
-    def __init__(self, manager, redis):
+    DEFAULT_BATCH_LOOKUP_CACHE_SIZE = 10000
+    DEFAULT_RECONCILE_CONCURRENCY = 4
+
+    def __init__(self, manager, redis, batch_lookup_cache_size=None,
+                 cache_retention=None):
         self.manager = manager
         self.batches = manager.proxy(Batch)
         self.outbound_messages = manager.proxy(OutboundMessage)
         self.events = manager.proxy(Event)
         self.inbound_messages = manager.proxy(InboundMessage)
         self.current_tags = manager.proxy(CurrentTag)
-        self.cache = MessageStoreCache(redis)
+        self.cache = MessageStoreCache(redis, **(cache_retention or {}))
+        self.message_batch_ids = LRUCache(
+            batch_lookup_cache_size or self.DEFAULT_BATCH_LOOKUP_CACHE_SIZE)
 
     @Manager.calls_manager
     def needs_reconciliation(self, batch_id, delta=0.01):
@@ -123,35 +146,133 @@ class MessageStore(object):
 
         returnValue(False)
 
-    @Manager.calls_manager
-    def reconcile_cache(self, batch_id):
-        yield self.cache.clear_batch(batch_id)
+    @inlineCallbacks
+    def reconcile_cache(self, batch_id, resume=False, concurrency=None,
+                        progress=None):
+        """
+        Rebuild the cached information for a batch from what's in Riak.
+
+        Messages are loaded in bunches, `concurrency` bunches at a time, and
+        the cache updates for a bunch are sent to Redis together rather than
+        one at a time. How far reconciliation has got is checkpointed in
+        Redis after each bunch.
+
+        :param bool resume:
+            Carry on from the checkpoint left by an interrupted
+            reconciliation instead of clearing the cache and starting over.
+            This is ignored if the cache keeps only the most recent keys,
+            because messages stored since the interruption may be counted
+            twice.
+        :param int concurrency:
+            How many bunches of messages to reconcile at once.
+            Defaults to DEFAULT_RECONCILE_CONCURRENCY.
+        :param progress:
+            A function called as `progress(direction, done, total)` as
+            bunches of messages are reconciled, where `direction` is either
+            'inbound' or 'outbound'. By default progress is logged.
+
+        NOTE:   This function can only be called from inside Twisted as
+                it assumes that the manager returns Deferreds.
+        """
+        if resume and self.cache.truncating:
+            # Messages stored since the interruption that sort after the
+            # checkpoint would be counted again if they've already been
+            # dropped from the cache, so we start over instead.
+            log.msg("Not resuming reconciliation of batch %s because its"
+                    " cache is truncated." % (batch_id,))
+            resume = False
+        if not resume:
+            yield self.cache.clear_batch(batch_id)
+            yield self.cache.clear_reconcile_checkpoints(batch_id)
         yield self.cache.batch_start(batch_id)
-        yield self.reconcile_inbound_cache(batch_id)
-        yield self.reconcile_outbound_cache(batch_id)
+        yield self.reconcile_inbound_cache(batch_id, concurrency, progress)
+        yield self.reconcile_outbound_cache(batch_id, concurrency, progress)
+        yield self.cache.clear_reconcile_checkpoints(batch_id)
+
+    def reconcile_inbound_cache(self, batch_id, concurrency=None,
+                                progress=None):
+        return self._reconcile(
+            batch_id, 'inbound', InboundMessage, self.batch_inbound_keys,
+            self._reconcile_inbound_bunch, concurrency, progress)
+
+    def reconcile_outbound_cache(self, batch_id, concurrency=None,
+                                 progress=None):
+        return self._reconcile(
+            batch_id, 'outbound', OutboundMessage, self.batch_outbound_keys,
+            self._reconcile_outbound_bunch, concurrency, progress)
 
-    @Manager.calls_manager
-    def reconcile_inbound_cache(self, batch_id):
-        # FIXME: We're loading messages one at a time here, which is stupid.
-        inbound_keys = yield self.batch_inbound_keys(batch_id)
-        for key in inbound_keys:
-            try:
-                msg = yield self.get_inbound_message(key)
-                yield self.cache.add_inbound_message(batch_id, msg)
-            except Exception:
-                log.err()
+    @inlineCallbacks
+    def _reconcile(self, batch_id, direction, model, get_keys,
+                   reconcile_bunch, concurrency, progress):
+        concurrency = concurrency or self.DEFAULT_RECONCILE_CONCURRENCY
+        if progress is None:
+            progress = self._log_reconcile_progress
+        # Keys are sorted and we checkpoint the last key reconciled, so
+        # messages stored since an interrupted run don't shift what's left
+        # to do. Those that sort before the checkpoint were added to the
+        # cache when they were stored.
+        keys = sorted((yield get_keys(batch_id)))
+        last_key = yield self.cache.get_reconcile_checkpoint(
+            batch_id, direction)
+        start = 0
+        if last_key is not None:
+            start = bisect_right(keys, last_key)
+        bunch_size = self.manager.load_bunch_size
+        bunches = enumerate(self.manager.load_all_bunches(model, keys[start:]))
+        finished = set()
+        # Every key before keys[checkpoint[0]] has been reconciled.
+        checkpoint = [start]
+
+        @inlineCallbacks
+        def finish_bunch(index):
+            finished.add(index)
+            old_checkpoint = checkpoint[0]
+            while (checkpoint[0] - start) // bunch_size in finished:
+                finished.remove((checkpoint[0] - start) // bunch_size)
+                checkpoint[0] = min(checkpoint[0] + bunch_size, len(keys))
+            if checkpoint[0] != old_checkpoint:
+                yield self.cache.set_reconcile_checkpoint(
+                    batch_id, direction, keys[checkpoint[0] - 1])
+                progress(direction, checkpoint[0], len(keys))
+
+        @inlineCallbacks
+        def worker():
+            for index, records_d in bunches:
+                try:
+                    records = yield records_d
+                    yield reconcile_bunch(batch_id, records)
+                except Exception:
+                    log.err(None, "Error reconciling %s messages for batch"
+                            " %s." % (direction, batch_id))
+                yield finish_bunch(index)
+
+        yield gatherResults([worker() for _ in range(concurrency)])
+
+    def _log_reconcile_progress(self, direction, done, total):
+        log.msg("Reconciled %d of %d %s messages." % (done, total, direction))
+
+    def _reconcile_inbound_bunch(self, batch_id, msg_records):
+        return gatherResults(
+            [self.cache.add_inbound_message(batch_id, msg_record.msg)
+             for msg_record in msg_records], consumeErrors=True)
 
-    @Manager.calls_manager
-    def reconcile_outbound_cache(self, batch_id):
-        # FIXME: We're loading messages one at a time here, which is stupid.
-        outbound_keys = yield self.batch_outbound_keys(batch_id)
-        for key in outbound_keys:
-            try:
-                msg = yield self.get_outbound_message(key)
-                yield self.cache.add_outbound_message(batch_id, msg)
-                yield self.reconcile_event_cache(batch_id, key)
-            except Exception:
-                log.err()
+    @inlineCallbacks
+    def _reconcile_outbound_bunch(self, batch_id, msg_records):
+        writes = []
+        for msg_record in msg_records:
+            writes.append(
+                self.cache.add_outbound_message(batch_id, msg_record.msg))
+            writes.append(self.set_message_batch_id(msg_record.key, batch_id))
+
+        event_keys = yield gatherResults(
+            [self.message_event_keys(msg_record.key)
+             for msg_record in msg_records], consumeErrors=True)
+        event_keys = [key for keys in event_keys for key in keys]
+        for events_bunch in self.manager.load_all_bunches(Event, event_keys):
+            for event_record in (yield events_bunch):
+                writes.append(
+                    self.cache.add_event(batch_id, event_record.event))
+        yield gatherResults(writes, consumeErrors=True)
 
     @Manager.calls_manager
     def reconcile_event_cache(self, batch_id, message_id):
@@ -203,6 +324,7 @@ class MessageStore(object):
             yield self.cache.add_outbound_message(batch_id, msg)
 
         yield msg_record.save()
+        yield self.set_message_batch_id(msg_id, batch_id)
 
     @Manager.calls_manager
     def get_outbound_message(self, msg_id):
@@ -216,11 +338,41 @@ class MessageStore(object):
         event_record = self.events(event_id, event=event, message=msg_id)
         yield event_record.save()
 
+        batch_id = yield self.get_message_batch_id(msg_id)
+        if batch_id is not None:
+            yield self.cache.add_event(batch_id, event)
+
+    def set_message_batch_id(self, msg_id, batch_id):
+        """
+        Remember which batch an outbound message belongs to.
+        """
+        self.message_batch_ids[msg_id] = batch_id
+        return self.cache.set_message_batch_id(msg_id, batch_id)
+
+    @Manager.calls_manager
+    def get_message_batch_id(self, msg_id):
+        """
+        Return the batch_id of an outbound message, or `None` if the message
+        isn't in a batch or doesn't exist.
+
+        This checks the in-memory and Redis lookups before loading the
+        message from Riak.
+        """
+        if msg_id in self.message_batch_ids:
+            returnValue(self.message_batch_ids.get(msg_id))
+
+        known, batch_id = yield self.cache.get_message_batch_id(msg_id)
+        if known:
+            self.message_batch_ids[msg_id] = batch_id
+            returnValue(batch_id)
+
         msg_record = yield self.outbound_messages.load(msg_id)
-        if msg_record is not None:
-            batch_id = msg_record.batch.key
-            if batch_id is not None:
-                yield self.cache.add_event(batch_id, event)
+        if msg_record is None:
+            # The message may still be stored, so don't remember this.
+            returnValue(None)
+        batch_id = msg_record.batch.key
+        yield self.set_message_batch_id(msg_id, batch_id)
+        returnValue(batch_id)
 
     @Manager.calls_manager
     def get_event(self, event_id):
@@ -248,6 +400,100 @@ class MessageStore(object):
         msg = yield self.inbound_messages.load(msg_id)
         returnValue(msg.msg if msg is not None else None)
 
+    @inlineCallbacks
+    def bulk_add(self, outbound=(), inbound=(), events=()):
+        """
+        Store many messages and events at once.
+
+        All the Riak and Redis writes are issued concurrently, and each tag
+        and outbound message needed to find the batch something belongs to
+        is only loaded once. Events for outbound messages stored in the same
+        call don't need their message loaded at all.
+
+        :param list outbound:
+            `(msg, tag, batch_id)` tuples, as for `add_outbound_message()`.
+        :param list inbound:
+            `(msg, tag, batch_id)` tuples, as for `add_inbound_message()`.
+        :param list events:
+            Events, as for `add_event()`.
+
+        Returns a list of `(success, result)` tuples, as from a
+        `DeferredList`, with an entry for each outbound message, inbound
+        message and event, in that order.
+
+        NOTE:   This function can only be called from inside Twisted as
+                it assumes that the manager returns Deferreds.
+        """
+        tags = set(tag for _msg, tag, batch_id in chain(outbound, inbound)
+                   if batch_id is None and tag is not None)
+        tag_batch_ids = yield self._current_batch_ids(tags)
+
+        def batch_id_for(tag, batch_id):
+            if batch_id is None and tag is not None:
+                return tag_batch_ids.get(tag)
+            return batch_id
+
+        msg_batch_ids = {}
+        writes = []
+        for msg, tag, batch_id in outbound:
+            batch_id = batch_id_for(tag, batch_id)
+            msg_batch_ids[msg['message_id']] = batch_id
+            writes.append(self._add_outbound(msg, batch_id))
+        for msg, tag, batch_id in inbound:
+            writes.append(self._add_message(
+                self.inbound_messages, self.cache.add_inbound_message,
+                msg, batch_id_for(tag, batch_id)))
+
+        msg_ids = set(event['user_message_id'] for event in events)
+        msg_batch_ids.update((yield self._message_batch_ids(
+            msg_ids.difference(msg_batch_ids))))
+        for event in events:
+            writes.append(self._add_event(
+                event, msg_batch_ids.get(event['user_message_id'])))
+
+        results = yield DeferredList(writes, consumeErrors=True)
+        returnValue(results)
+
+    @inlineCallbacks
+    def _current_batch_ids(self, tags):
+        tags = list(tags)
+        tag_records = yield gatherResults(
+            [self.current_tags.load(tag) for tag in tags], consumeErrors=True)
+        returnValue(dict((tag, tag_record.current_batch.key)
+                         for tag, tag_record in zip(tags, tag_records)
+                         if tag_record is not None))
+
+    @inlineCallbacks
+    def _message_batch_ids(self, msg_ids):
+        msg_ids = list(msg_ids)
+        batch_ids = yield gatherResults(
+            [self.get_message_batch_id(msg_id) for msg_id in msg_ids],
+            consumeErrors=True)
+        returnValue(dict(zip(msg_ids, batch_ids)))
+
+    @inlineCallbacks
+    def _add_outbound(self, msg, batch_id):
+        yield self._add_message(
+            self.outbound_messages, self.cache.add_outbound_message,
+            msg, batch_id)
+        yield self.set_message_batch_id(msg['message_id'], batch_id)
+
+    @inlineCallbacks
+    def _add_message(self, proxy, add_to_cache, msg, batch_id):
+        msg_record = proxy(msg['message_id'], msg=msg)
+        if batch_id is not None:
+            msg_record.batch.key = batch_id
+            yield add_to_cache(batch_id, msg)
+        yield msg_record.save()
+
+    @inlineCallbacks
+    def _add_event(self, event, batch_id):
+        event_record = self.events(
+            event['event_id'], event=event, message=event['user_message_id'])
+        yield event_record.save()
+        if batch_id is not None:
+            yield self.cache.add_event(batch_id, event)
+
     def get_batch(self, batch_id):
         return self.batches.load(batch_id)
 
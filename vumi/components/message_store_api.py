@@ -1,13 +1,20 @@
 # -*- test-case-name: vumi.components.tests.test_message_store_api -*-
+import csv
 import json
 import functools
+from datetime import datetime
+from StringIO import StringIO
 
+from zope.interface import implements
 from twisted.web import resource
 from twisted.web.server import NOT_DONE_YET
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import (
+    inlineCallbacks, Deferred, gatherResults, returnValue)
+from twisted.internet.interfaces import IPushProducer
 
+from vumi import log
 from vumi.service import Worker
-from vumi.message import JSONMessageEncoder
+from vumi.message import JSONMessageEncoder, VUMI_DATE_FORMAT
 from vumi.transports.httprpc import httprpc
 from vumi.components.message_store import MessageStore
 from vumi.persist.txriak_manager import TxRiakManager
@@ -135,6 +142,227 @@ class MatchResource(resource.Resource):
         return self
 
 
+class JSONLinesFormatter(object):
+    """
+    Formats message payloads as newline-delimited JSON.
+    """
+
+    content_type = 'application/x-ndjson; charset=utf-8'
+
+    def header(self):
+        return ''
+
+    def format(self, payloads):
+        return ''.join(json.dumps(payload, cls=JSONMessageEncoder) + '\n'
+                       for payload in payloads)
+
+
+class CSVFormatter(object):
+    """
+    Formats message payloads as CSV rows with a fixed set of columns.
+
+    :param list fields:
+        The payload fields to include as columns.
+    """
+
+    content_type = 'text/csv; charset=utf-8'
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    def _encode(self, value):
+        if value is None:
+            return ''
+        if isinstance(value, datetime):
+            return value.strftime(VUMI_DATE_FORMAT)
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        return str(value)
+
+    def _rows(self, rows):
+        data = StringIO()
+        writer = csv.writer(data)
+        writer.writerows(rows)
+        return data.getvalue()
+
+    def header(self):
+        return self._rows([self.fields])
+
+    def format(self, payloads):
+        return self._rows([[self._encode(payload.get(field))
+                            for field in self.fields]
+                           for payload in payloads])
+
+
+class ExportProducer(object):
+    """
+    Streams bunches of message payloads to a request, pausing whenever the
+    request's transport asks it to.
+
+    Only one bunch is loaded at a time, so memory use doesn't depend on how
+    many bunches there are.
+
+    :param request:
+        The request to write to.
+    :param bunches:
+        An iterator over Deferreds that fire with lists of message
+        payloads. The next bunch is only requested once the previous one
+        has been written.
+    :param formatter:
+        Formats the payloads, see :class:`JSONLinesFormatter`.
+    """
+
+    implements(IPushProducer)
+
+    def __init__(self, request, bunches, formatter):
+        self.request = request
+        self.bunches = bunches
+        self.formatter = formatter
+        self.paused = False
+        self.stopped = False
+        self._resumed = None
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        if self._resumed is not None:
+            d, self._resumed = self._resumed, None
+            d.callback(None)
+
+    def stopProducing(self):
+        self.stopped = True
+        self.resumeProducing()
+
+    @inlineCallbacks
+    def start(self):
+        """
+        Write all the bunches and finish the request. Returns a Deferred
+        that fires once this is done.
+        """
+        self.request.registerProducer(self, True)
+        try:
+            self.request.write(self.formatter.header())
+            while True:
+                if self.paused:
+                    self._resumed = Deferred()
+                    yield self._resumed
+                if self.stopped:
+                    # The client went away.
+                    self.request.unregisterProducer()
+                    return
+                try:
+                    bunch = self.bunches.next()
+                except StopIteration:
+                    break
+                payloads = yield bunch
+                if payloads:
+                    self.request.write(self.formatter.format(payloads))
+        except Exception:
+            log.err(None, "Exporting messages failed.")
+            # We've already sent the headers, so the only way to tell the
+            # client something went wrong is to not finish the response.
+            self.request.unregisterProducer()
+            self.request.transport.loseConnection()
+            return
+        self.request.unregisterProducer()
+        self.request.finish()
+
+
+class ExportResource(resource.Resource):
+    """
+    A Resource that streams all of a batch's inbound messages, outbound
+    messages or events as newline-delimited JSON or, if the `format` query
+    parameter is `csv`, as CSV.
+
+    Messages are loaded from Riak in bunches and each bunch is only loaded
+    once the previous one has been sent to the client.
+    """
+
+    isLeaf = True
+
+    MESSAGE_FIELDS = [
+        'message_id', 'timestamp', 'from_addr', 'to_addr', 'content',
+        'transport_name', 'transport_type', 'session_event', 'in_reply_to',
+        'group',
+    ]
+    EVENT_FIELDS = [
+        'event_id', 'timestamp', 'event_type', 'user_message_id',
+        'sent_message_id', 'delivery_status', 'transport_name',
+    ]
+
+    def __init__(self, direction, message_store, batch_id):
+        """
+        :param str direction:
+            One of 'inbound', 'outbound' or 'events'.
+        :param MessageStore message_store:
+            Instance of the MessageStore.
+        :param str batch_id:
+            The batch_id to export.
+        """
+        resource.Resource.__init__(self)
+        self.direction = direction
+        self.message_store = message_store
+        self.batch_id = batch_id
+
+    def _message_bunches(self, proxy, keys):
+        for bunch in proxy.load_all_bunches(keys):
+            yield bunch.addCallback(
+                lambda msgs: [msg.msg.payload for msg in msgs])
+
+    def _event_bunches(self, keys):
+        # We only need the outbound message keys to find their events, so
+        # the messages themselves aren't loaded.
+        bunch_size = self.message_store.manager.load_bunch_size
+        for i in xrange(0, len(keys), bunch_size):
+            yield self._load_events(keys[i:i + bunch_size])
+
+    @inlineCallbacks
+    def _load_events(self, message_keys):
+        event_keys = yield gatherResults(
+            [self.message_store.message_event_keys(key)
+             for key in message_keys], consumeErrors=True)
+        event_keys = [key for keys in event_keys for key in keys]
+        events = []
+        for bunch in self.message_store.events.load_all_bunches(event_keys):
+            events.extend(event.event.payload for event in (yield bunch))
+        returnValue(events)
+
+    @inlineCallbacks
+    def _get_bunches(self):
+        store = self.message_store
+        if self.direction == 'inbound':
+            keys = yield store.batch_inbound_keys(self.batch_id)
+            returnValue(self._message_bunches(store.inbound_messages, keys))
+        keys = yield store.batch_outbound_keys(self.batch_id)
+        if self.direction == 'outbound':
+            returnValue(self._message_bunches(store.outbound_messages, keys))
+        returnValue(self._event_bunches(keys))
+
+    @inlineCallbacks
+    def _render_export(self, request, formatter):
+        try:
+            bunches = yield self._get_bunches()
+        except Exception:
+            log.err(None, "Listing messages to export failed.")
+            request.setResponseCode(500)
+            request.finish()
+            return
+        yield ExportProducer(request, bunches, formatter).start()
+
+    def render_GET(self, request):
+        if request.args.get('format', ['json'])[0] == 'csv':
+            formatter = CSVFormatter(self.EVENT_FIELDS
+                                     if self.direction == 'events'
+                                     else self.MESSAGE_FIELDS)
+        else:
+            formatter = JSONLinesFormatter()
+        request.setHeader('Content-Type', formatter.content_type)
+        self._render_export(request, formatter)
+        return NOT_DONE_YET
+
+
 class BatchResource(resource.Resource):
 
     def __init__(self, message_store, batch_id):
@@ -152,6 +380,15 @@ class BatchResource(resource.Resource):
             MatchResource('outbound', message_store, batch_id))
         self.putChild('outbound', outbound)
 
+        for direction, parent in [('inbound', inbound),
+                                  ('outbound', outbound)]:
+            parent.putChild('export',
+                ExportResource(direction, message_store, batch_id))
+        events = resource.Resource()
+        events.putChild('export',
+            ExportResource('events', message_store, batch_id))
+        self.putChild('events', events)
+
     def render_GET(self, request):
         return self.batch_id
 
@@ -187,6 +424,10 @@ class MessageStoreAPIWorker(Worker):
     Worker that starts the MessageStoreAPI. It has some ability to connect to
     AMQP but to doesn't do anything with it yet.
 
+    A batch's messages and events can be exported by requesting
+    `batch/<batch_id>/inbound/export`, `batch/<batch_id>/outbound/export` or
+    `batch/<batch_id>/events/export`, optionally with `?format=csv`.
+
     :param str web_path:
         What is the base path this API should listen on?
     :param int web_port:
@@ -197,6 +438,9 @@ class MessageStoreAPIWorker(Worker):
         The configuration parameters for TxRiakManager
     :param dict redis_manager:
         The configuration parameters for TxRedisManager
+    :param dict cache_retention:
+        The cache retention options used by the message store's writers,
+        see :class:`vumi.components.message_store_cache.MessageStoreCache`.
     """
     @inlineCallbacks
     def startWorker(self):
@@ -206,7 +450,8 @@ class MessageStoreAPIWorker(Worker):
 
         riak = yield TxRiakManager.from_config(self.config['riak_manager'])
         redis = yield TxRedisManager.from_config(self.config['redis_manager'])
-        self.store = MessageStore(riak, redis)
+        self.store = MessageStore(
+            riak, redis, cache_retention=self.config.get('cache_retention'))
 
         self.webserver = self.start_web_resources([
             (MessageStoreAPI(self.store), web_path),
@@ -6,11 +6,67 @@ import json
 
 from twisted.internet.defer import returnValue
 
-from vumi.persist.redis_base import Manager
+from vumi.persist.redis_base import Manager, RedisScript
 from vumi.message import TransportEvent
 from vumi.errors import VumiError
 
 
+def _fake_count_throughput(fake_redis, keys, args):
+    [throughput_key, latest_key] = keys
+    bucket, history, resolution = [int(arg) for arg in args]
+    latest = fake_redis.get.sync(fake_redis, latest_key)
+    if latest is not None:
+        latest = int(latest)
+        if bucket < latest - history:
+            return 0
+        if bucket > latest:
+            if bucket - latest > history:
+                fake_redis.delete.sync(fake_redis, throughput_key)
+            else:
+                first = latest - history
+                first += -first % resolution
+                for old in range(first, bucket - history, resolution):
+                    fake_redis.hdel.sync(fake_redis, throughput_key, str(old))
+    if latest is None or bucket > latest:
+        fake_redis.set.sync(fake_redis, latest_key, str(bucket))
+    fake_redis.hincrby.sync(fake_redis, throughput_key, str(bucket), 1)
+    return 1
+
+
+# Counts a message in the throughput bucket ARGV[1], unless that's more
+# than ARGV[2] seconds older than the most recent bucket, which is kept in
+# KEYS[2]. When the most recent bucket moves forward, only the buckets that
+# have just fallen out of the history are removed, so the hash of buckets
+# is never scanned.
+COUNT_THROUGHPUT = RedisScript("""
+local bucket = tonumber(ARGV[1])
+local history = tonumber(ARGV[2])
+local resolution = tonumber(ARGV[3])
+local latest = tonumber(redis.call('GET', KEYS[2]))
+if latest then
+    if bucket < latest - history then
+        return 0
+    end
+    if bucket > latest then
+        if bucket - latest > history then
+            redis.call('DEL', KEYS[1])
+        else
+            local first = latest - history
+            first = first + (-first) % resolution
+            for old = first, bucket - history - 1, resolution do
+                redis.call('HDEL', KEYS[1], string.format('%d', old))
+            end
+        end
+    end
+end
+if not latest or bucket > latest then
+    redis.call('SET', KEYS[2], ARGV[1])
+end
+redis.call('HINCRBY', KEYS[1], ARGV[1], 1)
+return 1
+""", _fake_count_throughput)
+
+
 class MessageStoreCacheException(VumiError):
     pass
 
@@ -19,6 +75,38 @@ class MessageStoreCache(object):
     """
     A helper class to provide a view on information in the message store
     that is difficult to query straight from riak.
+
+    By default the cache keeps every message key, event key and address
+    seen in a batch. For long running batches it can instead keep only the
+    most recent ones. The message, event and address counts then come from
+    counters that are kept alongside the truncated sets. The unique address
+    counts are approximate because they use HyperLogLog. The other counts
+    are exact as long as each key is only added once. A key that is added
+    again after it has been dropped from its set is counted again. This
+    happens, for example, when AMQP redelivers a message or event older
+    than the keys that are kept, so `max_keys` and `max_age` should be
+    generous enough to cover redeliveries.
+
+    Throughput is always counted in rolling time buckets, so that it can
+    be read without going through the sets. Messages more than
+    `throughput_history` seconds older than the most recent one aren't
+    counted in them.
+
+    All users of the same cache should have the same options.
+
+    :param int max_keys:
+        If given, keep at most this many keys in each set.
+    :param int max_age:
+        If given, only keep keys whose timestamps are within this many
+        seconds of the most recent one added.
+    :param int throughput_history:
+        How many seconds of throughput counts to keep. This is the largest
+        `sample_time` the throughput buckets are used for. Defaults to
+        DEFAULT_THROUGHPUT_HISTORY.
+    :param int throughput_resolution:
+        The size of each throughput bucket in seconds, usually 1 or 60.
+        Throughput is only counted to the nearest bucket. Defaults to
+        DEFAULT_THROUGHPUT_RESOLUTION.
     """
     BATCH_KEY = 'batches'
     OUTBOUND_KEY = 'outbound'
@@ -29,14 +117,39 @@ class MessageStoreCache(object):
     STATUS_KEY = 'status'
     SEARCH_TOKEN_KEY = 'search_token'
     SEARCH_RESULT_KEY = 'search_result'
+    SEARCH_KEYS_KEY = 'search_keys'
+    MESSAGE_BATCH_KEY = 'message_batch'
+    RECONCILE_KEY = 'reconcile'
+    COUNTS_KEY = 'counts'
+    TO_ADDR_HLL_KEY = 'to_addr_hll'
+    FROM_ADDR_HLL_KEY = 'from_addr_hll'
+    RECENT_EVENT_KEY = 'recent_event'
+    THROUGHPUT_KEY = 'throughput'
+    THROUGHPUT_LATEST_KEY = 'throughput_latest'
 
     # Cache search results for 24 hrs
     DEFAULT_SEARCH_RESULT_TTL = 60 * 60 * 24
-
-    def __init__(self, redis):
+    # Number of search result keys sent with each SADD.
+    SEARCH_KEYS_CHUNK_SIZE = 1000
+    # Remember which batch an outbound message is in for a week, which
+    # should be long enough for all its events to arrive.
+    DEFAULT_MESSAGE_BATCH_TTL = 60 * 60 * 24 * 7
+    # Keep an hour of per-second throughput counts.
+    DEFAULT_THROUGHPUT_HISTORY = 60 * 60
+    DEFAULT_THROUGHPUT_RESOLUTION = 1
+
+    def __init__(self, redis, max_keys=None, max_age=None,
+                 throughput_history=None, throughput_resolution=None):
         # Store redis as `manager` as well since @Manager.calls_manager
         # requires it to be named as such.
         self.redis = self.manager = redis
+        self.max_keys = max_keys
+        self.max_age = max_age
+        self.truncating = bool(max_keys or max_age)
+        self.throughput_history = (throughput_history or
+                                   self.DEFAULT_THROUGHPUT_HISTORY)
+        self.throughput_resolution = (throughput_resolution or
+                                      self.DEFAULT_THROUGHPUT_RESOLUTION)
 
     def key(self, *args):
         return ':'.join([unicode(a) for a in args])
@@ -68,6 +181,33 @@ class MessageStoreCache(object):
     def search_result_key(self, batch_id, token):
         return self.batch_key(self.SEARCH_RESULT_KEY, batch_id, token)
 
+    def search_keys_key(self, batch_id, token):
+        return self.batch_key(self.SEARCH_KEYS_KEY, batch_id, token)
+
+    def counts_key(self, batch_id):
+        return self.batch_key(self.COUNTS_KEY, batch_id)
+
+    def to_addr_hll_key(self, batch_id):
+        return self.batch_key(self.TO_ADDR_HLL_KEY, batch_id)
+
+    def from_addr_hll_key(self, batch_id):
+        return self.batch_key(self.FROM_ADDR_HLL_KEY, batch_id)
+
+    def recent_event_key(self, batch_id):
+        return self.batch_key(self.RECENT_EVENT_KEY, batch_id)
+
+    def throughput_key(self, batch_id, direction):
+        return self.batch_key(self.THROUGHPUT_KEY, direction, batch_id)
+
+    def throughput_latest_key(self, batch_id, direction):
+        return self.batch_key(self.THROUGHPUT_LATEST_KEY, direction, batch_id)
+
+    def reconcile_key(self, batch_id):
+        return self.batch_key(self.RECONCILE_KEY, batch_id)
+
+    def message_batch_key(self, message_id):
+        return self.key(self.MESSAGE_BATCH_KEY, message_id)
+
     @Manager.calls_manager
     def batch_start(self, batch_id):
         """
@@ -93,8 +233,10 @@ class MessageStoreCache(object):
                   ['delivery_report.%s' % status
                    for status in TransportEvent.DELIVERY_STATUSES] +
                   ['sent'])
+        pipe = self.redis.pipeline()
         for event in events:
-            yield self.redis.hsetnx(self.status_key(batch_id), event, 0)
+            pipe.hsetnx(self.status_key(batch_id), event, 0)
+        yield pipe.execute()
 
     def get_batch_ids(self):
         """
@@ -116,13 +258,68 @@ class MessageStoreCache(object):
                 cached values your UI values might be off while the
                 reconciliation is taking place.
         """
-        yield self.redis.delete(self.inbound_key(batch_id))
-        yield self.redis.delete(self.outbound_key(batch_id))
-        yield self.redis.delete(self.event_key(batch_id))
-        yield self.redis.delete(self.status_key(batch_id))
-        yield self.redis.delete(self.to_addr_key(batch_id))
-        yield self.redis.delete(self.from_addr_key(batch_id))
-        yield self.redis.srem(self.batch_key(), batch_id)
+        pipe = self.redis.pipeline()
+        pipe.delete(self.inbound_key(batch_id))
+        pipe.delete(self.outbound_key(batch_id))
+        pipe.delete(self.event_key(batch_id))
+        pipe.delete(self.status_key(batch_id))
+        pipe.delete(self.to_addr_key(batch_id))
+        pipe.delete(self.from_addr_key(batch_id))
+        pipe.delete(self.counts_key(batch_id))
+        pipe.delete(self.to_addr_hll_key(batch_id))
+        pipe.delete(self.from_addr_hll_key(batch_id))
+        pipe.delete(self.recent_event_key(batch_id))
+        pipe.delete(self.throughput_key(batch_id, 'inbound'))
+        pipe.delete(self.throughput_key(batch_id, 'outbound'))
+        pipe.delete(self.throughput_latest_key(batch_id, 'inbound'))
+        pipe.delete(self.throughput_latest_key(batch_id, 'outbound'))
+        pipe.srem(self.batch_key(), batch_id)
+        yield pipe.execute()
+
+    def set_message_batch_id(self, message_id, batch_id, ttl=None):
+        """
+        Remember which batch an outbound message belongs to so that its
+        events can be counted without loading the message from Riak.
+
+        :param str batch_id:
+            The batch_id, or `None` if the message isn't in a batch.
+        :param int ttl:
+            How long to remember this for.
+            Defaults to DEFAULT_MESSAGE_BATCH_TTL.
+        """
+        ttl = ttl or self.DEFAULT_MESSAGE_BATCH_TTL
+        return self.redis.setex(
+            self.message_batch_key(message_id), ttl, batch_id or '')
+
+    @Manager.calls_manager
+    def get_message_batch_id(self, message_id):
+        """
+        Return a `(known, batch_id)` tuple for an outbound message. `known`
+        is `False` if `set_message_batch_id()` hasn't been called for the
+        message (or was called too long ago) and `batch_id` is `None` if the
+        message isn't in a batch.
+        """
+        batch_id = yield self.redis.get(self.message_batch_key(message_id))
+        if batch_id is None:
+            returnValue((False, None))
+        returnValue((True, batch_id or None))
+
+    def get_reconcile_checkpoint(self, batch_id, direction):
+        """
+        Return the last message key reconciled in the given direction, if
+        reconciliation of a batch was interrupted, or `None` otherwise.
+        """
+        return self.redis.hget(self.reconcile_key(batch_id), direction)
+
+    def set_reconcile_checkpoint(self, batch_id, direction, key):
+        """
+        Record the last message key reconciled in the given direction.
+        Every key that sorts before it has been reconciled too.
+        """
+        return self.redis.hset(self.reconcile_key(batch_id), direction, key)
+
+    def clear_reconcile_checkpoints(self, batch_id):
+        return self.redis.delete(self.reconcile_key(batch_id))
 
     def get_timestamp(self, datetime):
         """
@@ -130,6 +327,63 @@ class MessageStoreCache(object):
         """
         return time.mktime(datetime.timetuple())
 
+    def _truncate(self, pipe, key, timestamp):
+        """
+        Queue the removal of keys that we no longer want to keep from the
+        sorted set at `key` on a pipeline.
+        """
+        if self.max_keys:
+            pipe.zremrangebyrank(key, 0, -self.max_keys - 1)
+        if self.max_age:
+            pipe.zremrangebyscore(
+                key, '-inf', '(%r' % (timestamp - self.max_age,))
+
+    def throughput_bucket(self, timestamp):
+        """
+        Return the start of the throughput bucket `timestamp` falls in.
+        """
+        resolution = self.throughput_resolution
+        return int(timestamp // resolution) * resolution
+
+    @Manager.calls_manager
+    def _count_new_message_key(self, batch_id, direction, timestamp):
+        """
+        Count a new message key in the throughput buckets and, if we're
+        truncating, in the message counts, truncating the set it was added
+        to.
+        """
+        yield self.redis.run_script(COUNT_THROUGHPUT, [
+            self.throughput_key(batch_id, direction),
+            self.throughput_latest_key(batch_id, direction),
+        ], [self.throughput_bucket(timestamp), self.throughput_history,
+            self.throughput_resolution])
+        if self.truncating:
+            message_key = getattr(self, '%s_key' % (direction,))(batch_id)
+            pipe = self.redis.pipeline()
+            pipe.hincrby(self.counts_key(batch_id), direction, 1)
+            self._truncate(pipe, message_key, timestamp)
+            yield pipe.execute()
+
+    @Manager.calls_manager
+    def _add_addr(self, addr_key, hll_key, addr, timestamp):
+        """
+        Add an address to the sorted set at `addr_key`, counting it in the
+        HyperLogLog at `hll_key` if we're truncating.
+        """
+        addr = addr.encode('utf-8')
+        pipe = self.redis.pipeline()
+        pipe.zadd(addr_key, **{addr: timestamp})
+        if self.truncating:
+            pipe.pfadd(hll_key, addr)
+            self._truncate(pipe, addr_key, timestamp)
+        results = yield pipe.execute()
+        returnValue(results[0])
+
+    @Manager.calls_manager
+    def _get_count(self, batch_id, direction):
+        count = yield self.redis.hget(self.counts_key(batch_id), direction)
+        returnValue(int(count or 0))
+
     @Manager.calls_manager
     def add_outbound_message(self, batch_id, msg):
         """
@@ -150,6 +404,7 @@ class MessageStoreCache(object):
             })
         if new_entry:
             yield self.increment_event_status(batch_id, 'sent')
+            yield self._count_new_message_key(batch_id, 'outbound', timestamp)
 
     @Manager.calls_manager
     def add_event(self, batch_id, event):
@@ -158,7 +413,8 @@ class MessageStoreCache(object):
         """
 
         event_id = event['event_id']
-        new_entry = yield self.add_event_key(batch_id, event_id)
+        new_entry = yield self.add_event_key(
+            batch_id, event_id, self.get_timestamp(event['timestamp']))
         if new_entry:
             event_type = event['event_type']
             yield self.increment_event_status(batch_id, event_type)
@@ -166,12 +422,28 @@ class MessageStoreCache(object):
                 yield self.increment_event_status(batch_id,
                     '%s.%s' % (event_type, event['delivery_status']))
 
-    def add_event_key(self, batch_id, event_key):
+    @Manager.calls_manager
+    def add_event_key(self, batch_id, event_key, timestamp=None):
         """
         Add the event key to the set of known event keys.
         Returns 0 if the key already exists in the set, 1 if it doesn't.
+
+        When truncating, the most recent event keys are kept in a sorted
+        set weighted by `timestamp`, which defaults to now.
         """
-        return self.redis.sadd(self.event_key(batch_id), event_key)
+        if not self.truncating:
+            new_entry = yield self.redis.sadd(
+                self.event_key(batch_id), event_key)
+            returnValue(new_entry)
+
+        if timestamp is None:
+            timestamp = time.time()
+        key = self.recent_event_key(batch_id)
+        pipe = self.redis.pipeline()
+        pipe.zadd(key, **{event_key.encode('utf-8'): timestamp})
+        self._truncate(pipe, key, timestamp)
+        results = yield pipe.execute()
+        returnValue(results[0])
 
     def increment_event_status(self, batch_id, event_type):
         """
@@ -199,22 +471,26 @@ class MessageStoreCache(object):
             timestamp)
         yield self.add_from_addr(batch_id, msg['from_addr'], timestamp)
 
+    @Manager.calls_manager
     def add_inbound_message_key(self, batch_id, message_key, timestamp):
         """
         Add a message key, weighted with the timestamp to the batch_id
         """
-        return self.redis.zadd(self.inbound_key(batch_id), **{
+        new_entry = yield self.redis.zadd(self.inbound_key(batch_id), **{
             message_key.encode('utf-8'): timestamp,
             })
+        if new_entry:
+            yield self._count_new_message_key(batch_id, 'inbound', timestamp)
+        returnValue(new_entry)
 
     def add_from_addr(self, batch_id, from_addr, timestamp):
         """
         Add a from_addr to this batch_id, weighted by timestamp. Generally
         this information is retrieved when `add_inbound_message()` is called.
         """
-        return self.redis.zadd(self.from_addr_key(batch_id), **{
-            from_addr.encode('utf-8'): timestamp,
-            })
+        return self._add_addr(self.from_addr_key(batch_id),
+                              self.from_addr_hll_key(batch_id),
+                              from_addr, timestamp)
 
     def get_from_addrs(self, batch_id, asc=False):
         """
@@ -225,8 +501,11 @@ class MessageStoreCache(object):
 
     def count_from_addrs(self, batch_id):
         """
-        Return the number of from_addrs for this batch_id
+        Return the number of from_addrs for this batch_id. This is an
+        estimate when truncating.
         """
+        if self.truncating:
+            return self.redis.pfcount(self.from_addr_hll_key(batch_id))
         return self.redis.zcard(self.from_addr_key(batch_id))
 
     def add_to_addr(self, batch_id, to_addr, timestamp):
@@ -234,9 +513,9 @@ class MessageStoreCache(object):
         Add a to-addr to this batch_id, weighted by timestamp. Generally
         this information is retrieved when `add_outbound_message()` is called.
         """
-        return self.redis.zadd(self.to_addr_key(batch_id), **{
-            to_addr.encode('utf-8'): timestamp,
-            })
+        return self._add_addr(self.to_addr_key(batch_id),
+                              self.to_addr_hll_key(batch_id),
+                              to_addr, timestamp)
 
     def get_to_addrs(self, batch_id, asc=False):
         """
@@ -248,8 +527,11 @@ class MessageStoreCache(object):
 
     def count_to_addrs(self, batch_id):
         """
-        Return count of the unique to_addrs in this batch.
+        Return count of the unique to_addrs in this batch. This is an
+        estimate when truncating.
         """
+        if self.truncating:
+            return self.redis.pfcount(self.to_addr_hll_key(batch_id))
         return self.redis.zcard(self.to_addr_key(batch_id))
 
     def get_inbound_message_keys(self, batch_id, start=0, stop=-1, asc=False,
@@ -265,6 +547,8 @@ class MessageStoreCache(object):
         """
         Return the count of the unique inbound message keys for this batch_id
         """
+        if self.truncating:
+            return self._get_count(batch_id, 'inbound')
         return self.redis.zcard(self.inbound_key(batch_id))
 
     def get_outbound_message_keys(self, batch_id, start=0, stop=-1, asc=False,
@@ -280,9 +564,10 @@ class MessageStoreCache(object):
         """
         Return the count of the unique outbound message keys for this batch_id
         """
+        if self.truncating:
+            return self._get_count(batch_id, 'outbound')
         return self.redis.zcard(self.outbound_key(batch_id))
 
-    @Manager.calls_manager
     def count_inbound_throughput(self, batch_id, sample_time=300):
         """
         Calculate the number of messages seen in the last `sample_time` amount
@@ -291,19 +576,14 @@ class MessageStoreCache(object):
         :param int sample_time:
             How far to look back to calculate the throughput.
             Defaults to 300 seconds (5 minutes)
-        """
-        last_seen = yield self.redis.zrange(
-                            self.inbound_key(batch_id), 0, 0, desc=True,
-                            withscores=True)
-        if not last_seen:
-            returnValue(0)
 
-        [(latest, timestamp)] = last_seen
-        count = yield self.redis.zcount(self.inbound_key(batch_id),
-            timestamp - sample_time, timestamp)
-        returnValue(int(count))
+        If `sample_time` is longer than `throughput_history`, the count
+        comes from the message keys instead of the throughput buckets. If
+        the cache is truncating those may be incomplete, so
+        :class:`MessageStoreCacheException` is raised.
+        """
+        return self._count_throughput(batch_id, 'inbound', sample_time)
 
-    @Manager.calls_manager
     def count_outbound_throughput(self, batch_id, sample_time=300):
         """
         Calculate the number of messages seen in the last `sample_time` amount
@@ -312,17 +592,71 @@ class MessageStoreCache(object):
         :param int sample_time:
             How far to look back to calculate the throughput.
             Defaults to 300 seconds (5 minutes)
+
+        If `sample_time` is longer than `throughput_history`, the count
+        comes from the message keys instead of the throughput buckets. If
+        the cache is truncating those may be incomplete, so
+        :class:`MessageStoreCacheException` is raised.
         """
-        last_seen = yield self.redis.zrange(
-                            self.outbound_key(batch_id), 0, 0, desc=True,
-                            withscores=True)
+        return self._count_throughput(batch_id, 'outbound', sample_time)
+
+    @Manager.calls_manager
+    def _count_throughput(self, batch_id, direction, sample_time):
+        key = getattr(self, '%s_key' % (direction,))(batch_id)
+        last_seen = yield self.redis.zrange(key, 0, 0, desc=True,
+                                            withscores=True)
         if not last_seen:
             returnValue(0)
 
         [(latest, timestamp)] = last_seen
-        count = yield self.redis.zcount(self.outbound_key(batch_id),
-            timestamp - sample_time, timestamp)
-        returnValue(int(count))
+        if sample_time > self.throughput_history:
+            if self.truncating:
+                raise MessageStoreCacheException(
+                    "Can't count throughput over %s seconds, only %s seconds"
+                    " of throughput are kept." % (
+                        sample_time, self.throughput_history))
+            count = yield self.redis.zcount(
+                key, timestamp - sample_time, timestamp)
+            returnValue(int(count))
+
+        throughput_key = self.throughput_key(batch_id, direction)
+        pipe = self.redis.pipeline()
+        for bucket in range(self.throughput_bucket(timestamp - sample_time),
+                            self.throughput_bucket(timestamp) + 1,
+                            self.throughput_resolution):
+            pipe.hget(throughput_key, str(bucket))
+        counts = yield pipe.execute()
+        returnValue(sum(int(count or 0) for count in counts))
+
+    def get_inbound_throughput_series(self, batch_id):
+        """
+        Return the inbound throughput for this batch as a list of
+        `(timestamp, count)` pairs, one for each throughput bucket within
+        `throughput_history` of the most recent, oldest first.
+        """
+        return self._get_throughput_series(batch_id, 'inbound')
+
+    def get_outbound_throughput_series(self, batch_id):
+        """
+        Return the outbound throughput for this batch as a list of
+        `(timestamp, count)` pairs, one for each throughput bucket within
+        `throughput_history` of the most recent, oldest first.
+        """
+        return self._get_throughput_series(batch_id, 'outbound')
+
+    @Manager.calls_manager
+    def _get_throughput_series(self, batch_id, direction):
+        buckets = yield self.redis.hgetall(
+            self.throughput_key(batch_id, direction))
+        if not buckets:
+            returnValue([])
+        counts = dict((int(b), int(count)) for b, count in buckets.items())
+        latest = max(counts)
+        first = min(b for b in counts
+                    if b >= latest - self.throughput_history)
+        returnValue([(bucket, counts.get(bucket, 0))
+                     for bucket in range(first, latest + 1,
+                                         self.throughput_resolution)])
 
     def get_query_token(self, direction, query):
         """
@@ -361,9 +695,11 @@ class MessageStoreCache(object):
                             ttl=None):
         """
         Store the inbound query results for a query that was started with
-        `start_inbound_query`. Internally this grabs the timestamps from
-        the cache (there is an assumption that it has already been reconciled)
-        and orders the results accordingly.
+        `start_inbound_query`. Internally this orders the results by the
+        timestamps already in the cache (there is an assumption that it has
+        already been reconciled). The ordering is done by redis, which
+        intersects a temporary set of the keys with the batch's sorted set
+        of message keys, so keys that aren't in the cache are left out.
 
         :param str token:
             The token to store the results under.
@@ -377,6 +713,7 @@ class MessageStoreCache(object):
         """
         ttl = ttl or self.DEFAULT_SEARCH_RESULT_TTL
         result_key = self.search_result_key(batch_id, token)
+        keys_key = self.search_keys_key(batch_id, token)
         if direction == 'inbound':
             score_set_key = self.inbound_key(batch_id)
         elif direction == 'outbound':
@@ -384,18 +721,20 @@ class MessageStoreCache(object):
         else:
             raise MessageStoreCacheException('Invalid direction')
 
+        pipe = self.redis.pipeline()
+        pipe.delete(keys_key)
+        for i in range(0, len(keys), self.SEARCH_KEYS_CHUNK_SIZE):
+            pipe.sadd(keys_key, *keys[i:i + self.SEARCH_KEYS_CHUNK_SIZE])
         # populate the results set weighted according to the timestamps
-        # that are already known in the cache.
-        for key in keys:
-            timestamp = yield self.redis.zscore(score_set_key, key)
-            yield self.redis.zadd(result_key, **{
-                key.encode('utf-8'): timestamp,
-                })
-
+        # that are already known in the cache. Members of the keys set
+        # have a score of 1, which we weight to nothing.
+        pipe.zinterstore(result_key, {score_set_key: 1, keys_key: 0})
+        pipe.delete(keys_key)
         # Auto expire after TTL
-        yield self.redis.expire(result_key, ttl)
+        pipe.expire(result_key, ttl)
         # Remove from the list of in progress search operations.
-        yield self.redis.srem(self.search_token_key(batch_id), token)
+        pipe.srem(self.search_token_key(batch_id), token)
+        yield pipe.execute()
 
     def is_query_in_progress(self, batch_id, token):
         """
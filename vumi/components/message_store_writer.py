@@ -0,0 +1,207 @@
+# -*- test-case-name: vumi.components.tests.test_message_store_writer -*-
+
+"""Write-behind buffering for the message store."""
+
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    Deferred, DeferredLock, inlineCallbacks, succeed)
+from twisted.internet.task import LoopingCall
+from twisted.python.failure import Failure
+
+from vumi import log
+from vumi.blinkenlights.metrics import Metric, Timer
+
+
+class MessageStoreWriter(object):
+    """Buffers writes to a :class:`vumi.components.MessageStore` and
+    flushes them in bulk.
+
+    Writes are queued and flushed using `MessageStore.bulk_add()` once
+    `flush_size` writes are waiting or every `flush_interval` seconds,
+    whichever comes first. Writes that callers are waiting on are also
+    flushed on the next reactor turn.
+
+    :param MessageStore store:
+        The message store to write to.
+    :param str durability:
+        When a write's Deferred fires. One of:
+
+        * `sync`: writes aren't buffered at all and go straight to the
+          message store, as if there were no writer.
+        * `flush`: once the flush containing the write has completed.
+          Callers wait for their writes, so these are flushed on the next
+          reactor turn rather than waiting for `flush_size` or
+          `flush_interval`. Writes queued in the same reactor turn, or while
+          an earlier flush is running, are flushed together.
+        * `buffered`: as soon as the write is queued. A write that fills the
+          queue waits for the queue to be flushed. Queued writes are lost if
+          the process dies and failed writes are only logged.
+
+        Default is `flush`.
+    :param int max_queue_size:
+        The number of queued writes at which `buffered` writes start waiting
+        for a flush. Default is 1000.
+    :param int flush_size:
+        The number of queued writes that triggers a flush. Default is 100.
+    :param float flush_interval:
+        Seconds between periodic flushes. Default is 1.
+    :param MetricManager metrics:
+        If given, the queue depth at each flush and the time each flush takes
+        are published as `message_store.queue_depth` and
+        `message_store.flush_latency`.
+    """
+
+    DURABILITY_LEVELS = ('sync', 'flush', 'buffered')
+
+    clock = reactor
+
+    def __init__(self, store, durability='flush', max_queue_size=1000,
+                 flush_size=100, flush_interval=1.0, metrics=None):
+        if durability not in self.DURABILITY_LEVELS:
+            raise ValueError("Unknown durability level %r, expected one of %r"
+                             % (durability, self.DURABILITY_LEVELS))
+        self.store = store
+        self.durability = durability
+        self.max_queue_size = max_queue_size
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.queue_depth_metric = Metric('message_store.queue_depth')
+        self.flush_timer = Timer('message_store.flush_latency')
+        if metrics is not None:
+            metrics.register(self.queue_depth_metric)
+            metrics.register(self.flush_timer)
+        self._queue = []
+        self._flush_lock = DeferredLock()
+        self._flush_waiters = []
+        self._flush_task = None
+        self._flush_soon = None
+
+    @classmethod
+    def from_config(cls, store, config, metrics=None):
+        return cls(store,
+                   durability=config.get('durability', 'flush'),
+                   max_queue_size=int(config.get('max_queue_size', 1000)),
+                   flush_size=int(config.get('flush_size', 100)),
+                   flush_interval=float(config.get('flush_interval', 1.0)),
+                   metrics=metrics)
+
+    def __len__(self):
+        """Number of writes waiting to be flushed."""
+        return len(self._queue)
+
+    def start(self):
+        """Start flushing periodically."""
+        if self.durability == 'sync':
+            return
+        self._flush_task = LoopingCall(self.flush)
+        self._flush_task.clock = self.clock
+        done = self._flush_task.start(self.flush_interval, now=False)
+        done.addErrback(lambda failure: log.err(
+            failure, "MessageStoreWriter flushing task died"))
+
+    def stop(self):
+        """Stop flushing periodically and flush anything still queued."""
+        if self._flush_task is not None:
+            self._flush_task.stop()
+            self._flush_task = None
+        if self._flush_soon is not None:
+            self._flush_soon.cancel()
+            self._flush_soon = None
+        return self.flush()
+
+    def add_outbound_message(self, msg, tag=None, batch_id=None):
+        if self.durability == 'sync':
+            return self.store.add_outbound_message(
+                msg, tag=tag, batch_id=batch_id)
+        return self._enqueue('outbound', (msg, tag, batch_id))
+
+    def add_inbound_message(self, msg, tag=None, batch_id=None):
+        if self.durability == 'sync':
+            return self.store.add_inbound_message(
+                msg, tag=tag, batch_id=batch_id)
+        return self._enqueue('inbound', (msg, tag, batch_id))
+
+    def add_event(self, event):
+        if self.durability == 'sync':
+            return self.store.add_event(event)
+        return self._enqueue('event', event)
+
+    def _enqueue(self, kind, write):
+        d = None
+        if self.durability == 'flush':
+            d = Deferred()
+        self._queue.append((kind, write, d))
+
+        if len(self._queue) >= self.max_queue_size:
+            flushed = self.flush()
+            if d is None:
+                d = flushed
+        elif len(self._queue) >= self.flush_size:
+            self.flush()
+        elif d is not None and self._flush_soon is None:
+            # Waiting for the periodic flush would hold up a caller that
+            # processes one message at a time for up to `flush_interval`.
+            self._flush_soon = self.clock.callLater(0, self._flush_queued)
+        return d if d is not None else succeed(None)
+
+    def _flush_queued(self):
+        self._flush_soon = None
+        self.flush()
+
+    def flush(self):
+        """Write everything currently queued to the message store.
+
+        Flushes never overlap, so this waits for any flush already in
+        progress before starting a new one. Calls made while waiting share
+        the same flush.
+        """
+        d = Deferred()
+        self._flush_waiters.append(d)
+        if len(self._flush_waiters) == 1:
+            self._flush_lock.run(self._flush)
+        return d
+
+    @inlineCallbacks
+    def _flush(self):
+        flush_waiters, self._flush_waiters = self._flush_waiters, []
+        try:
+            yield self._write_queue()
+        finally:
+            for d in flush_waiters:
+                d.callback(None)
+
+    @inlineCallbacks
+    def _write_queue(self):
+        queue, self._queue = self._queue, []
+        if not queue:
+            return
+        self.queue_depth_metric.set(len(queue))
+        writes = {'outbound': [], 'inbound': [], 'event': []}
+        for kind, write, _d in queue:
+            writes[kind].append(write)
+        # bulk_add() returns results in this order.
+        waiters = [d for kind in ('outbound', 'inbound', 'event')
+                   for write_kind, _write, d in queue if write_kind == kind]
+
+        with self.flush_timer:
+            try:
+                results = yield self.store.bulk_add(
+                    outbound=writes['outbound'], inbound=writes['inbound'],
+                    events=writes['event'])
+            except Exception:
+                failure = Failure()
+                log.err(failure, "Flushing %d message store writes failed."
+                        % (len(queue),))
+                for d in waiters:
+                    if d is not None:
+                        d.errback(failure)
+                return
+
+        for d, (success, result) in zip(waiters, results):
+            if d is not None:
+                if success:
+                    d.callback(None)
+                else:
+                    d.errback(result)
+            elif not success:
+                log.err(result, "Buffered message store write failed.")
@@ -9,7 +9,210 @@ import time
 from twisted.internet.defer import returnValue
 
 from vumi.errors import VumiError
-from vumi.persist.redis_base import Manager
+from vumi.persist.redis_base import Manager, RedisScript
+
+
+# Every pool script takes the same first five keys:
+#
+#   KEYS[1]: sorted set of free tags, scored by when they were freed
+#   KEYS[2]: counter used to score free tags
+#   KEYS[3]: list of free tags from before free tags were kept sorted
+#   KEYS[4]: set of free tags from before free tags were kept sorted
+#   KEYS[5]: set of tags in use
+#
+# Pools written before the sorted set was introduced are moved over, keeping
+# the order of their free tags, by the first script that touches them.
+MIGRATE_LUA = """
+if redis.call('EXISTS', KEYS[3]) == 1 then
+    for _, tag in ipairs(redis.call('LRANGE', KEYS[3], 0, -1)) do
+        if redis.call('SISMEMBER', KEYS[4], tag) == 1 then
+            redis.call('ZADD', KEYS[1], redis.call('INCR', KEYS[2]), tag)
+        end
+    end
+    redis.call('DEL', KEYS[3], KEYS[4])
+end
+"""
+
+
+def _fake_migrate(fake_redis, keys):
+    free_zset_key, counter_key, free_list_key, free_set_key = keys[:4]
+    if not fake_redis.exists.sync(fake_redis, free_list_key):
+        return
+    for tag in fake_redis.lrange.sync(fake_redis, free_list_key, 0, -1):
+        if fake_redis.sismember.sync(fake_redis, free_set_key, tag):
+            _fake_free(fake_redis, keys, tag)
+    fake_redis.delete.sync(fake_redis, free_list_key)
+    fake_redis.delete.sync(fake_redis, free_set_key)
+
+
+def _fake_free(fake_redis, keys, tag):
+    free_zset_key, counter_key = keys[:2]
+    score = fake_redis.incr.sync(fake_redis, counter_key)
+    fake_redis.zadd.sync(fake_redis, free_zset_key, **{tag: score})
+
+
+def _fake_owner_entry(pool, tag):
+    # This has to match what cjson.encode({pool, tag}) returns in the scripts
+    # below: no spaces, UTF-8 left as it is, and '/' and DEL escaped.
+    entry = json.dumps([pool.decode('utf-8'), tag.decode('utf-8')],
+                       separators=(',', ':'), ensure_ascii=False)
+    return entry.encode('utf-8').replace('/', '\\/').replace(
+        '\x7f', '\\u007f')
+
+
+def _fake_acquire(fake_redis, keys, args):
+    _fake_migrate(fake_redis, keys)
+    [free_zset_key, _, _, _, inuse_set_key, reason_hash_key,
+     owner_tags_key], [count, reason, pool] = keys, args
+    tags = fake_redis.zrange.sync(fake_redis, free_zset_key, 0, int(count) - 1)
+    for tag in tags:
+        fake_redis.zrem.sync(fake_redis, free_zset_key, tag)
+        fake_redis.sadd.sync(fake_redis, inuse_set_key, tag)
+        fake_redis.hset.sync(fake_redis, reason_hash_key, tag, reason)
+        fake_redis.sadd.sync(fake_redis, owner_tags_key,
+                             _fake_owner_entry(pool, tag))
+    return tags
+
+
+# Moves up to ARGV[1] of the longest free tags into use, storing the reason
+# they were acquired and adding them to their owner's tags.
+ACQUIRE = RedisScript(MIGRATE_LUA + """
+local tags = redis.call('ZRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #tags > 0 then
+    redis.call('ZREMRANGEBYRANK', KEYS[1], 0, #tags - 1)
+end
+for _, tag in ipairs(tags) do
+    redis.call('SADD', KEYS[5], tag)
+    redis.call('HSET', KEYS[6], tag, ARGV[2])
+    redis.call('SADD', KEYS[7], cjson.encode({ARGV[3], tag}))
+end
+return tags
+""", _fake_acquire)
+
+
+def _fake_acquire_specific(fake_redis, keys, args):
+    _fake_migrate(fake_redis, keys)
+    [free_zset_key, _, _, _, inuse_set_key, reason_hash_key,
+     owner_tags_key], [tag, reason, pool] = keys, args
+    if not fake_redis.zrem.sync(fake_redis, free_zset_key, tag):
+        return 0
+    fake_redis.sadd.sync(fake_redis, inuse_set_key, tag)
+    fake_redis.hset.sync(fake_redis, reason_hash_key, tag, reason)
+    fake_redis.sadd.sync(fake_redis, owner_tags_key,
+                         _fake_owner_entry(pool, tag))
+    return 1
+
+
+# Moves the free tag ARGV[1] into use, like ACQUIRE does.
+ACQUIRE_SPECIFIC = RedisScript(MIGRATE_LUA + """
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('SADD', KEYS[5], ARGV[1])
+redis.call('HSET', KEYS[6], ARGV[1], ARGV[2])
+redis.call('SADD', KEYS[7], cjson.encode({ARGV[3], ARGV[1]}))
+return 1
+""", _fake_acquire_specific)
+
+
+def _fake_release(fake_redis, keys, args):
+    _fake_migrate(fake_redis, keys)
+    [_, _, _, _, inuse_set_key, reason_hash_key, owners_prefix,
+     unowned_tags_key], [tag, pool, legacy_entry] = keys, args
+    if not fake_redis.srem.sync(fake_redis, inuse_set_key, tag):
+        return 0
+    _fake_free(fake_redis, keys, tag)
+    reason = fake_redis.hget.sync(fake_redis, reason_hash_key, tag)
+    if reason is not None:
+        owner = json.loads(reason).get('owner')
+        if owner is None:
+            owner_tags_key = unowned_tags_key
+        else:
+            owner_tags_key = "%s%s:tags" % (owners_prefix,
+                                            owner.encode('utf-8'))
+        fake_redis.srem.sync(fake_redis, owner_tags_key,
+                             _fake_owner_entry(pool, tag))
+        fake_redis.srem.sync(fake_redis, owner_tags_key, legacy_entry)
+    return 1
+
+
+# Moves the tag ARGV[1] from use to the back of the free tags and removes it
+# from its owner's tags. The owner's key is built from the prefix in KEYS[7]
+# because it depends on the stored reason. Tags acquired before this script
+# existed were added to their owner's tags as the JSON in ARGV[3].
+RELEASE = RedisScript(MIGRATE_LUA + """
+if redis.call('SREM', KEYS[5], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('ZADD', KEYS[1], redis.call('INCR', KEYS[2]), ARGV[1])
+local reason = redis.call('HGET', KEYS[6], ARGV[1])
+if reason then
+    local owner = cjson.decode(reason)['owner']
+    local owner_tags_key = KEYS[8]
+    if owner ~= nil and owner ~= cjson.null then
+        owner_tags_key = KEYS[7] .. owner .. ':tags'
+    end
+    redis.call(
+        'SREM', owner_tags_key, cjson.encode({ARGV[2], ARGV[1]}), ARGV[3])
+end
+return 1
+""", _fake_release)
+
+
+def _fake_declare(fake_redis, keys, args):
+    _fake_migrate(fake_redis, keys)
+    [free_zset_key, _, _, _, inuse_set_key, pool_list_key] = keys
+    pool, tags = args[0], args[1:]
+    fake_redis.sadd.sync(fake_redis, pool_list_key, pool)
+    declared = 0
+    for tag in tags:
+        if (fake_redis.zscore.sync(fake_redis, free_zset_key, tag) is None and
+                not fake_redis.sismember.sync(
+                    fake_redis, inuse_set_key, tag)):
+            _fake_free(fake_redis, keys, tag)
+            declared += 1
+    return declared
+
+
+# Registers the pool ARGV[1] and adds the tags in the rest of ARGV that
+# aren't already in it to the back of its free tags, returning how many
+# were added.
+DECLARE = RedisScript(MIGRATE_LUA + """
+redis.call('SADD', KEYS[6], ARGV[1])
+local declared = 0
+for i = 2, #ARGV do
+    local tag = ARGV[i]
+    if not redis.call('ZSCORE', KEYS[1], tag)
+            and redis.call('SISMEMBER', KEYS[5], tag) == 0 then
+        redis.call('ZADD', KEYS[1], redis.call('INCR', KEYS[2]), tag)
+        declared = declared + 1
+    end
+end
+return declared
+""", _fake_declare)
+
+
+def _fake_purge(fake_redis, keys, args):
+    [free_zset_key, reason_hash_key], [count] = keys, args
+    tags = fake_redis.zrange.sync(fake_redis, free_zset_key, 0, int(count) - 1)
+    for tag in tags:
+        fake_redis.zrem.sync(fake_redis, free_zset_key, tag)
+        fake_redis.hdel.sync(fake_redis, reason_hash_key, tag)
+    return len(tags)
+
+
+# Removes up to ARGV[1] free tags and their reasons, returning how many were
+# removed. Unlike the scripts above, this doesn't take the usual pool keys.
+PURGE = RedisScript("""
+local tags = redis.call('ZRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #tags > 0 then
+    redis.call('ZREMRANGEBYRANK', KEYS[1], 0, #tags - 1)
+end
+for _, tag in ipairs(tags) do
+    redis.call('HDEL', KEYS[2], tag)
+end
+return #tags
+""", _fake_purge)
 
 
 class TagpoolError(VumiError):
@@ -19,12 +222,22 @@ class TagpoolError(VumiError):
 class TagpoolManager(object):
     """Manage a set of tag pools.
 
+    Each pool's free tags are kept in a sorted set, scored so that tags are
+    acquired in the order they were declared or released. Acquiring,
+    releasing and declaring tags are each a single atomic script, so
+    concurrent managers never see a tag that is both free and in use.
+
     :param redis:
         An instance of :class:`vumi.persist.redis_base.Manager`.
     """
 
     encoding = "UTF-8"
 
+    # The most tags declared or purged by a single redis call, so that
+    # working on a large pool doesn't keep redis from serving anyone else
+    # for long.
+    BATCH_SIZE = 1000
+
     def __init__(self, redis):
         self.redis = redis
         self.manager = redis  # TODO: This is a bit of a hack to make the
@@ -38,8 +251,18 @@ class TagpoolManager(object):
 
     @Manager.calls_manager
     def acquire_tag(self, pool, owner=None, reason=None):
-        local_tag = yield self._acquire_tag(pool, owner, reason)
-        returnValue((pool, local_tag) if local_tag is not None else None)
+        local_tags = yield self._acquire_tags(pool, 1, owner, reason)
+        returnValue((pool, local_tags[0]) if local_tags else None)
+
+    @Manager.calls_manager
+    def acquire_tags(self, pool, count, owner=None, reason=None):
+        """Acquire up to `count` free tags from `pool` at once.
+
+        Returns a list of the tags acquired, which is shorter than `count`
+        if the pool doesn't have enough free tags.
+        """
+        local_tags = yield self._acquire_tags(pool, count, owner, reason)
+        returnValue([(pool, local_tag) for local_tag in local_tags])
 
     @Manager.calls_manager
     def acquire_specific_tag(self, tag, owner=None, reason=None):
@@ -56,13 +279,28 @@ class TagpoolManager(object):
         yield self._release_tag(pool, local_tag)
 
     @Manager.calls_manager
-    def declare_tags(self, tags):
+    def declare_tags(self, tags, progress=None):
+        """Add tags to their pools, registering any new pools.
+
+        Tags that are already in their pool are left alone. Each pool's tags
+        are declared BATCH_SIZE at a time.
+
+        :param progress:
+            Optional callable that is called with the pool, the number of its
+            tags declared so far and its total number of tags after each
+            batch.
+        """
         pools = {}
         for pool, local_tag in tags:
-            pools.setdefault(pool, []).append(local_tag)
+            pools.setdefault(pool, set()).add(self._encode(local_tag))
         for pool, local_tags in pools.items():
-            yield self._register_pool(pool)
-            yield self._declare_tags(pool, local_tags)
+            local_tags = sorted(local_tags)
+            for i in xrange(0, len(local_tags), self.BATCH_SIZE):
+                yield self._declare_tags(
+                    pool, local_tags[i:i + self.BATCH_SIZE])
+                if progress is not None:
+                    progress(pool, min(i + self.BATCH_SIZE, len(local_tags)),
+                             len(local_tags))
 
     @Manager.calls_manager
     def get_metadata(self, pool):
@@ -82,19 +320,40 @@ class TagpoolManager(object):
         yield self.redis.hmset(metadata_key, metadata)
 
     @Manager.calls_manager
-    def purge_pool(self, pool):
-        free_list_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
-        metadata_key = self._tag_pool_metadata_key(pool)
+    def purge_pool(self, pool, progress=None):
+        """Delete a pool along with its tags and metadata.
+
+        No tags from the pool may be in use. Free tags are removed BATCH_SIZE
+        at a time.
+
+        :param progress:
+            Optional callable that is called with the pool, the number of its
+            tags purged so far and its total number of free tags after each
+            batch.
+        """
+        pool_keys = self._tag_pool_keys(pool)
+        free_zset_key, inuse_set_key = pool_keys[0], pool_keys[-1]
+        reason_hash_key = self._tag_pool_reason_key(pool)
         in_use_count = yield self.redis.scard(inuse_set_key)
         if in_use_count:
             raise TagpoolError('%s tags of pool %s still in use.' % (
                                in_use_count, pool))
-        else:
-            yield self.redis.delete(free_set_key)
-            yield self.redis.delete(free_list_key)
-            yield self.redis.delete(inuse_set_key)
-            yield self.redis.delete(metadata_key)
-            yield self._unregister_pool(pool)
+        total = yield self.redis.zcard(free_zset_key)
+        purged = 0
+        while True:
+            count = yield self.redis.run_script(
+                PURGE, [free_zset_key, reason_hash_key], [self.BATCH_SIZE])
+            if not count:
+                break
+            purged += count
+            if progress is not None:
+                progress(pool, purged, total)
+        pipe = self.redis.pipeline()
+        for key in pool_keys + (reason_hash_key,
+                                self._tag_pool_metadata_key(pool)):
+            pipe.delete(key)
+        pipe.srem(self._pool_list_key(), self._encode(pool))
+        yield pipe.execute()
 
     @Manager.calls_manager
     def list_pools(self):
@@ -104,14 +363,20 @@ class TagpoolManager(object):
 
     @Manager.calls_manager
     def free_tags(self, pool):
-        _free_list, free_set_key, _inuse_set = self._tag_pool_keys(pool)
-        free_tags = yield self.redis.smembers(free_set_key)
+        free_zset_key, _counter, _free_list, free_set_key, _inuse_set = (
+            self._tag_pool_keys(pool))
+        pipe = self.redis.pipeline()
+        pipe.zrange(free_zset_key, 0, -1)
+        # Pools that no script has touched since free tags were kept
+        # sorted still have their free tags in the old set.
+        pipe.smembers(free_set_key)
+        free_tags, legacy_free_tags = yield pipe.execute()
         returnValue([(pool, self._decode(local_tag))
-                     for local_tag in free_tags])
+                     for local_tag in free_tags + sorted(legacy_free_tags)])
 
     @Manager.calls_manager
     def inuse_tags(self, pool):
-        _free_list, _free_set, inuse_set_key = self._tag_pool_keys(pool)
+        inuse_set_key = self._tag_pool_keys(pool)[-1]
         inuse_tags = yield self.redis.smembers(inuse_set_key)
         returnValue([(pool, self._decode(local_tag))
                      for local_tag in inuse_tags])
@@ -145,59 +410,53 @@ class TagpoolManager(object):
         pool_list_key = self._pool_list_key()
         yield self.redis.sadd(pool_list_key, pool)
 
-    @Manager.calls_manager
-    def _unregister_pool(self, pool):
-        """Remove a pool to list of pools."""
-        pool = self._encode(pool)
-        pool_list_key = self._pool_list_key()
-        yield self.redis.srem(pool_list_key, pool)
-
     def _tag_pool_keys(self, pool):
+        """Return the keys every pool script starts with."""
         pool = self._encode(pool)
         return tuple(":".join(["tagpools", pool, state])
-                     for state in ("free:list", "free:set", "inuse:set"))
+                     for state in ("free:zset", "free:counter", "free:list",
+                                   "free:set", "inuse:set"))
 
     def _tag_pool_metadata_key(self, pool):
         pool = self._encode(pool)
         return ":".join(["tagpools", pool, "metadata"])
 
     @Manager.calls_manager
-    def _acquire_tag(self, pool, owner, reason):
-        free_list_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
-        tag = yield self.redis.lpop(free_list_key)
-        if tag is not None:
-            yield self.redis.smove(free_set_key, inuse_set_key, tag)
-            yield self._store_reason(pool, tag, owner, reason)
-        returnValue(self._decode(tag) if tag is not None else None)
+    def _acquire_tags(self, pool, count, owner, reason):
+        if count < 1:
+            returnValue([])
+        keys = self._tag_pool_keys(pool) + (
+            self._tag_pool_reason_key(pool),
+            self._owner_tag_list_key(owner))
+        tags = yield self.redis.run_script(ACQUIRE, keys, [
+            count, self._reason_json(owner, reason), self._encode(pool)])
+        returnValue([self._decode(tag) for tag in tags])
 
     @Manager.calls_manager
     def _acquire_specific_tag(self, pool, local_tag, owner, reason):
-        local_tag = self._encode(local_tag)
-        free_list_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
-        moved = yield self.redis.lrem(free_list_key, local_tag, num=1)
-        if moved:
-            yield self.redis.smove(free_set_key, inuse_set_key, local_tag)
-            yield self._store_reason(pool, local_tag, owner, reason)
-        returnValue(moved)
+        keys = self._tag_pool_keys(pool) + (
+            self._tag_pool_reason_key(pool),
+            self._owner_tag_list_key(owner))
+        acquired = yield self.redis.run_script(ACQUIRE_SPECIFIC, keys, [
+            self._encode(local_tag), self._reason_json(owner, reason),
+            self._encode(pool)])
+        returnValue(acquired)
 
     @Manager.calls_manager
     def _release_tag(self, pool, local_tag):
-        local_tag = self._encode(local_tag)
-        free_list_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
-        count = yield self.redis.smove(inuse_set_key, free_set_key, local_tag)
-        if count == 1:
-            yield self.redis.rpush(free_list_key, local_tag)
-            yield self._remove_reason(pool, local_tag)
+        keys = self._tag_pool_keys(pool) + (
+            self._tag_pool_reason_key(pool),
+            ":".join(["tagpools", "owners", ""]),
+            self._owner_tag_list_key(None))
+        yield self.redis.run_script(RELEASE, keys, [
+            self._encode(local_tag), self._encode(pool),
+            json.dumps([pool, local_tag])])
 
     @Manager.calls_manager
     def _declare_tags(self, pool, local_tags):
-        free_list_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
-        new_tags = set(self._encode(tag) for tag in local_tags)
-        old_tags = yield self.redis.sunion(free_set_key, inuse_set_key)
-        old_tags = set(old_tags)
-        for tag in sorted(new_tags - old_tags):
-            yield self.redis.sadd(free_set_key, tag)
-            yield self.redis.rpush(free_list_key, tag)
+        keys = self._tag_pool_keys(pool) + (self._pool_list_key(),)
+        yield self.redis.run_script(
+            DECLARE, keys, [self._encode(pool)] + local_tags)
 
     def _tag_pool_reason_key(self, pool):
         pool = self._encode(pool)
@@ -209,25 +468,9 @@ class TagpoolManager(object):
         owner = self._encode(owner)
         return ":".join(["tagpools", "owners", owner, "tags"])
 
-    @Manager.calls_manager
-    def _store_reason(self, pool, local_tag, owner, reason):
+    def _reason_json(self, owner, reason):
         if reason is None:
             reason = {}
         reason['timestamp'] = time.time()
         reason['owner'] = owner
-        reason_hash_key = self._tag_pool_reason_key(pool)
-        yield self.redis.hset(reason_hash_key, local_tag, json.dumps(reason))
-        owner_tag_list_key = self._owner_tag_list_key(owner)
-        yield self.redis.sadd(owner_tag_list_key,
-                              json.dumps([pool, self._decode(local_tag)]))
-
-    @Manager.calls_manager
-    def _remove_reason(self, pool, local_tag):
-        reason_hash_key = self._tag_pool_reason_key(pool)
-        reason = yield self.redis.hget(reason_hash_key, local_tag)
-        if reason is not None:
-            reason = json.loads(reason)
-            owner = reason.get('owner')
-            owner_tag_list_key = self._owner_tag_list_key(owner)
-            self.redis.srem(owner_tag_list_key,
-                            json.dumps([pool, self._decode(local_tag)]))
+        return json.dumps(reason)
@@ -8,6 +8,7 @@ from twisted.internet.defer import inlineCallbacks
 from twisted.web.server import Site
 from twisted.application import strports
 
+from vumi import log
 from vumi.worker import BaseWorker
 from vumi.config import ConfigDict, ConfigText
 from vumi.persist.txredis_manager import TxRedisManager
@@ -50,7 +51,8 @@ class TagpoolApiServer(JSONRPC):
     @signature(tags=List("List of tags to declare.", item_type=Tag()))
     def jsonrpc_declare_tags(self, tags):
         """Declare all of the listed tags."""
-        return self.tagpool.declare_tags(tags)
+        return self.tagpool.declare_tags(
+            tags, progress=self._log_declare_progress)
 
     @signature(pool=Unicode("Name of pool to retreive metadata for."),
                returns=Dict("Retrieved metadata."))
@@ -70,7 +72,8 @@ class TagpoolApiServer(JSONRPC):
 
            No tags from the pool may be inuse.
            """
-        return self.tagpool.purge_pool(pool)
+        return self.tagpool.purge_pool(
+            pool, progress=self._log_purge_progress)
 
     @signature(returns=List("List of pool names.", item_type=Unicode()))
     def jsonrpc_list_pools(self):
@@ -108,6 +111,12 @@ class TagpoolApiServer(JSONRPC):
         """Return a list of tags currently owned by an owner."""
         return self.tagpool.owned_tags(owner)
 
+    def _log_declare_progress(self, pool, done, total):
+        log.msg("Declared %d of %d tags in pool %s." % (done, total, pool))
+
+    def _log_purge_progress(self, pool, done, total):
+        log.msg("Purged %d of %d tags from pool %s." % (done, total, pool))
+
 
 class TagpoolApiWorker(BaseWorker):
 
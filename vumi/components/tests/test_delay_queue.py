@@ -0,0 +1,88 @@
+"""Tests for vumi.components.delay_queue."""
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial.unittest import TestCase
+
+from vumi.components.delay_queue import DelayQueue
+from vumi.tests.utils import PersistenceMixin
+
+
+class TestDelayQueue(TestCase, PersistenceMixin):
+
+    @inlineCallbacks
+    def setUp(self):
+        self._persist_setUp()
+        self.redis = yield self.get_redis_manager()
+        yield self.redis._purge_all()  # Just in case
+        self.queue = DelayQueue(self.redis, visibility_timeout=30)
+
+    def tearDown(self):
+        return self._persist_tearDown()
+
+    @inlineCallbacks
+    def test_add(self):
+        yield self.queue.add('item1', 10, payload='data', now=100)
+        yield self.queue.add('item2', 5, now=100)
+        self.assertEqual((yield self.queue.count()), 2)
+        self.assertEqual((yield self.queue.get_item_ids()),
+                         ['item2', 'item1'])
+        self.assertEqual((yield self.queue.get_due_time('item1')), 110)
+        self.assertEqual((yield self.queue.get_payload('item1')), 'data')
+        self.assertEqual((yield self.queue.get_payload('item2')), None)
+
+    @inlineCallbacks
+    def test_add_reschedules(self):
+        yield self.queue.add('item1', 10, now=100)
+        yield self.queue.add('item1', 20, now=100)
+        self.assertEqual((yield self.queue.count()), 1)
+        self.assertEqual((yield self.queue.get_due_time('item1')), 120)
+
+    @inlineCallbacks
+    def test_claim(self):
+        yield self.queue.add('item1', 10, payload='data1', now=100)
+        yield self.queue.add('item2', 0, payload='data2', now=100)
+        yield self.queue.add('item3', 20, now=100)
+        self.assertEqual((yield self.queue.claim(now=99)), [])
+        self.assertEqual((yield self.queue.claim(now=110)), [
+            ('item2', 'data2'), ('item1', 'data1')])
+        # Claimed items are hidden rather than removed.
+        self.assertEqual((yield self.queue.claim(now=110)), [])
+        self.assertEqual((yield self.queue.count()), 3)
+        self.assertEqual((yield self.queue.get_due_time('item1')), 140)
+
+    @inlineCallbacks
+    def test_claim_limit(self):
+        for i in range(5):
+            yield self.queue.add('item%d' % (i,), i, now=100)
+        claimed = yield self.queue.claim(now=200, limit=3)
+        self.assertEqual([item_id for item_id, _ in claimed],
+                         ['item0', 'item1', 'item2'])
+        claimed = yield self.queue.claim(now=200, limit=3)
+        self.assertEqual([item_id for item_id, _ in claimed],
+                         ['item3', 'item4'])
+
+    @inlineCallbacks
+    def test_unacked_items_are_claimed_again(self):
+        yield self.queue.add('item1', 0, payload='data', now=100)
+        self.assertEqual((yield self.queue.claim(now=100)),
+                         [('item1', 'data')])
+        self.assertEqual((yield self.queue.claim(now=129)), [])
+        self.assertEqual((yield self.queue.claim(now=130)),
+                         [('item1', 'data')])
+
+    @inlineCallbacks
+    def test_ack(self):
+        yield self.queue.add('item1', 0, payload='data1', now=100)
+        yield self.queue.add('item2', 0, payload='data2', now=100)
+        claimed = yield self.queue.claim(now=100)
+        yield self.queue.ack([item_id for item_id, _ in claimed])
+        self.assertEqual((yield self.queue.count()), 0)
+        self.assertEqual((yield self.queue.get_payload('item1')), None)
+        self.assertEqual((yield self.queue.claim(now=1000)), [])
+
+    def test_ack_nothing(self):
+        return self.queue.ack([])
+
+
+class TestDelayQueueSync(TestDelayQueue):
+    sync_persistence = True
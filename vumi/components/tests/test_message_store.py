@@ -240,6 +240,45 @@ class TestMessageStore(TestMessageStoreBase):
         batch_status = yield self.store.batch_status(batch_id)
         self.assertEqual(batch_status, self._batch_status(sent=1, **dr_counts))
 
+    @inlineCallbacks
+    def test_add_event_uses_batch_lookup(self):
+        msg_id, msg, batch_id = yield self._create_outbound()
+        self.assertEqual(batch_id, self.store.message_batch_ids.get(msg_id))
+        self.store.message_batch_ids.clear()
+
+        def no_load(key):
+            self.fail("Outbound message %r loaded from Riak." % (key,))
+        self.patch(self.store.outbound_messages, 'load', no_load)
+
+        ack = self.mkmsg_ack(user_message_id=msg_id)
+        yield self.store.add_event(ack)
+        self.assertEqual(batch_id, self.store.message_batch_ids.get(msg_id))
+        batch_status = yield self.store.batch_status(batch_id)
+        self.assertEqual(batch_status, self._batch_status(sent=1, ack=1))
+
+    @inlineCallbacks
+    def test_get_message_batch_id_falls_back_to_riak(self):
+        msg_id, msg, batch_id = yield self._create_outbound()
+        self.store.message_batch_ids.clear()
+        yield self.redis.delete(self.store.cache.message_batch_key(msg_id))
+
+        self.assertEqual(batch_id,
+                         (yield self.store.get_message_batch_id(msg_id)))
+        self.assertEqual((True, batch_id),
+                         (yield self.store.cache.get_message_batch_id(msg_id)))
+
+    @inlineCallbacks
+    def test_get_message_batch_id_without_batch(self):
+        msg_id, msg, _batch_id = yield self._create_outbound(tag=None)
+        self.store.message_batch_ids.clear()
+        self.assertEqual((True, None),
+                         (yield self.store.cache.get_message_batch_id(msg_id)))
+        self.assertEqual(None,
+                         (yield self.store.get_message_batch_id(msg_id)))
+        self.assertEqual(None, (yield self.store.get_message_batch_id(
+            "unknown-message")))
+        self.assertFalse("unknown-message" in self.store.message_batch_ids)
+
     @inlineCallbacks
     def test_add_inbound_message(self):
         msg_id, msg, _batch_id = yield self._create_inbound(tag=None)
@@ -343,6 +382,43 @@ class TestMessageStore(TestMessageStoreBase):
                 'flags': 'i',
             }])))
 
+    @inlineCallbacks
+    def test_bulk_add(self):
+        tag = ("pool", "tag")
+        batch_id = yield self.store.batch_start([tag])
+        out_msg = self.mkmsg_out(message_id=TransportEvent.generate_id())
+        in_msg = self.mkmsg_in(message_id=TransportEvent.generate_id())
+        ack = self.mkmsg_ack(user_message_id=out_msg['message_id'])
+
+        results = yield self.store.bulk_add(
+            outbound=[(out_msg, tag, None)],
+            inbound=[(in_msg, None, batch_id)],
+            events=[ack])
+        self.assertEqual([True, True, True], [r[0] for r in results])
+
+        self.assertEqual(out_msg, (
+            yield self.store.get_outbound_message(out_msg['message_id'])))
+        self.assertEqual(in_msg, (
+            yield self.store.get_inbound_message(in_msg['message_id'])))
+        self.assertEqual(ack, (yield self.store.get_event(ack['event_id'])))
+        self.assertEqual([out_msg['message_id']],
+                         (yield self.store.batch_outbound_keys(batch_id)))
+        self.assertEqual([in_msg['message_id']],
+                         (yield self.store.batch_inbound_keys(batch_id)))
+        batch_status = yield self.store.batch_status(batch_id)
+        self.assertEqual(batch_status, self._batch_status(sent=1, ack=1))
+
+    @inlineCallbacks
+    def test_bulk_add_event_for_stored_message(self):
+        msg_id, msg, batch_id = yield self._create_outbound()
+        ack = self.mkmsg_ack(user_message_id=msg_id)
+        [(success, _result)] = yield self.store.bulk_add(events=[ack])
+        self.assertTrue(success)
+        self.assertEqual([ack['event_id']],
+                         (yield self.store.message_event_keys(msg_id)))
+        batch_status = yield self.store.batch_status(batch_id)
+        self.assertEqual(batch_status, self._batch_status(sent=1, ack=1))
+
 
 class TestMessageStoreCache(TestMessageStoreBase):
 
@@ -440,6 +516,86 @@ class TestMessageStoreCache(TestMessageStoreBase):
         self.assertEqual(batch_status['ack'], 10)
         self.assertEqual(batch_status['sent'], 10)
 
+    @inlineCallbacks
+    def test_reconcile_cache_in_bunches(self):
+        self.manager.load_bunch_size = 3
+        batch_id = yield self.store.batch_start([("pool", "tag")])
+        yield self.create_inbound_messages(batch_id, 4)
+        messages = yield self.create_outbound_messages(batch_id, 10)
+        for msg in messages:
+            yield self.store.add_event(self.mkmsg_ack(
+                user_message_id=msg['message_id']))
+
+        self.clear_cache(self.store)
+        progress = []
+        yield self.store.reconcile_cache(
+            batch_id, concurrency=2,
+            progress=lambda *args: progress.append(args))
+        self.assertTrue(('inbound', 4, 4) in progress)
+        self.assertEqual(('outbound', 10, 10), progress[-1])
+        self.assertFalse((yield self.store.needs_reconciliation(batch_id,
+            delta=0)))
+        batch_status = yield self.store.batch_status(batch_id)
+        self.assertEqual(batch_status['ack'], 10)
+        self.assertEqual(batch_status['sent'], 10)
+        self.assertEqual(None, (
+            yield self.store.cache.get_reconcile_checkpoint(
+                batch_id, 'outbound')))
+
+    @inlineCallbacks
+    def test_reconcile_cache_resume(self):
+        self.manager.load_bunch_size = 3
+        batch_id = yield self.store.batch_start([("pool", "tag")])
+        messages = yield self.create_outbound_messages(batch_id, 10)
+        keys = sorted(msg['message_id'] for msg in messages)
+
+        self.clear_cache(self.store)
+        yield self.store.cache.set_reconcile_checkpoint(
+            batch_id, 'outbound', keys[5])
+        yield self.store.reconcile_cache(batch_id, resume=True)
+        cached_keys = yield self.store.cache.count_outbound_message_keys(
+            batch_id)
+        self.assertEqual(4, cached_keys)
+        batch_status = yield self.store.batch_status(batch_id)
+        self.assertEqual(batch_status['sent'], 4)
+
+    @inlineCallbacks
+    def test_reconcile_cache_resume_after_new_messages(self):
+        self.manager.load_bunch_size = 3
+        batch_id = yield self.store.batch_start([("pool", "tag")])
+        messages = yield self.create_outbound_messages(batch_id, 10)
+        keys = sorted(msg['message_id'] for msg in messages)
+
+        self.clear_cache(self.store)
+        yield self.store.cache.set_reconcile_checkpoint(
+            batch_id, 'outbound', keys[5])
+        # These are cached as they're stored, wherever they sort.
+        yield self.create_outbound_messages(batch_id, 5)
+        yield self.store.reconcile_cache(batch_id, resume=True)
+        cached_keys = yield self.store.cache.count_outbound_message_keys(
+            batch_id)
+        self.assertEqual(9, cached_keys)
+        batch_status = yield self.store.batch_status(batch_id)
+        self.assertEqual(batch_status['sent'], 9)
+
+    @inlineCallbacks
+    def test_reconcile_cache_resume_truncated(self):
+        self.manager.load_bunch_size = 3
+        store = MessageStore(self.manager, self.redis,
+                             cache_retention={'max_keys': 5})
+        batch_id = yield self.store.batch_start([("pool", "tag")])
+        messages = yield self.create_outbound_messages(batch_id, 10)
+        keys = sorted(msg['message_id'] for msg in messages)
+
+        self.clear_cache(self.store)
+        yield store.cache.set_reconcile_checkpoint(
+            batch_id, 'outbound', keys[5])
+        yield store.reconcile_cache(batch_id, resume=True)
+        cached_keys = yield store.cache.count_outbound_message_keys(batch_id)
+        self.assertEqual(10, cached_keys)
+        batch_status = yield store.batch_status(batch_id)
+        self.assertEqual(batch_status['sent'], 10)
+
     @inlineCallbacks
     def test_find_inbound_keys_matching(self):
         batch_id = yield self.store.batch_start([("pool", "tag")])
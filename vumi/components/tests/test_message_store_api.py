@@ -1,11 +1,15 @@
+import csv
 import json
 from datetime import datetime, timedelta
 
 from twisted.internet import reactor
-from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, Deferred, succeed, fail)
+from twisted.trial.unittest import TestCase
 
-from vumi.components.message_store_api import (MatchResource,
-                                                MessageStoreAPIWorker)
+from vumi.components.message_store_api import (
+    MatchResource, MessageStoreAPIWorker, ExportProducer, JSONLinesFormatter,
+    CSVFormatter)
 from vumi.utils import http_request_full
 from vumi.tests.utils import PersistenceMixin, VumiWorkerTestCase
 from vumi.message import TransportUserMessage
@@ -254,3 +258,158 @@ class MessageStoreAPITestCase(VumiWorkerTestCase, PersistenceMixin):
         self.assertResultCount(response, 0)
         self.assertEqual(json.loads(response.delivered_body), [])
         self.assertEqual(response.code, 200)
+
+    @inlineCallbacks
+    def test_inbound_export(self):
+        messages = yield self.create_inbound(self.batch_id, 3,
+                                             'hello world {0}')
+        response = yield self.do_get('batch/%s/inbound/export' % (
+            self.batch_id,))
+        self.assertEqual(response.code, 200)
+        lines = response.delivered_body.splitlines()
+        self.assertEqual(
+            sorted(json.loads(line)['message_id'] for line in lines),
+            sorted(msg['message_id'] for msg in messages))
+
+    @inlineCallbacks
+    def test_outbound_export_csv(self):
+        messages = yield self.create_outbound(self.batch_id, 3,
+                                              'hello world {0}')
+        response = yield self.do_get('batch/%s/outbound/export?format=csv' % (
+            self.batch_id,))
+        self.assertEqual(response.code, 200)
+        rows = list(csv.reader(response.delivered_body.splitlines()))
+        self.assertEqual(rows[0][:2], ['message_id', 'timestamp'])
+        self.assertEqual(sorted(row[0] for row in rows[1:]),
+                         sorted(msg['message_id'] for msg in messages))
+
+    @inlineCallbacks
+    def test_events_export(self):
+        [msg] = yield self.create_outbound(self.batch_id, 1, 'hello')
+        ack = self.mkmsg_ack(user_message_id=msg['message_id'])
+        yield self.store.add_event(ack)
+        response = yield self.do_get('batch/%s/events/export' % (
+            self.batch_id,))
+        self.assertEqual(response.code, 200)
+        [line] = response.delivered_body.splitlines()
+        self.assertEqual(json.loads(line)['event_id'], ack['event_id'])
+
+    @inlineCallbacks
+    def test_events_export_in_bunches(self):
+        self.store.manager.load_bunch_size = 2
+        messages = yield self.create_outbound(self.batch_id, 3,
+                                              'hello world {0}')
+        acks = [self.mkmsg_ack(user_message_id=msg['message_id'])
+                for msg in messages]
+        for ack in acks:
+            yield self.store.add_event(ack)
+        response = yield self.do_get('batch/%s/events/export' % (
+            self.batch_id,))
+        self.assertEqual(response.code, 200)
+        lines = response.delivered_body.splitlines()
+        self.assertEqual(
+            sorted(json.loads(line)['event_id'] for line in lines),
+            sorted(ack['event_id'] for ack in acks))
+
+
+class RecordingRequest(object):
+    """Just enough of a request to see what an ExportProducer does."""
+
+    def __init__(self):
+        self.written = []
+        self.producer = None
+        self.finished = False
+        self.connection_lost = False
+        self.transport = self
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def write(self, data):
+        self.written.append(data)
+
+    def finish(self):
+        self.finished = True
+
+    def loseConnection(self):
+        self.connection_lost = True
+
+
+class ExportProducerTestCase(TestCase):
+
+    def setUp(self):
+        self.request = RecordingRequest()
+        self.loaded = []
+
+    def mk_bunches(self, bunches):
+        for bunch in bunches:
+            self.loaded.append(bunch)
+            yield bunch
+
+    def test_streams_bunches(self):
+        first, second = Deferred(), Deferred()
+        producer = ExportProducer(self.request,
+                                  self.mk_bunches([first, second]),
+                                  JSONLinesFormatter())
+        d = producer.start()
+        self.assertEqual(self.request.producer, producer)
+        self.assertEqual(self.loaded, [first])
+        first.callback([{'a': 1}, {'b': 2}])
+        self.assertEqual(self.loaded, [first, second])
+        second.callback([{'c': 3}])
+        self.assertTrue(d.called)
+        self.assertEqual(''.join(self.request.written),
+                         '{"a": 1}\n{"b": 2}\n{"c": 3}\n')
+        self.assertTrue(self.request.finished)
+        self.assertEqual(self.request.producer, None)
+
+    def test_pause_and_resume(self):
+        producer = ExportProducer(self.request,
+                                  self.mk_bunches([succeed([{'a': 1}]),
+                                                   succeed([{'b': 2}])]),
+                                  JSONLinesFormatter())
+        producer.pauseProducing()
+        producer.start()
+        self.assertEqual(self.loaded, [])
+        producer.resumeProducing()
+        self.assertEqual(len(self.loaded), 2)
+        self.assertTrue(self.request.finished)
+
+    def test_stop(self):
+        first = Deferred()
+        producer = ExportProducer(self.request,
+                                  self.mk_bunches([first, succeed([])]),
+                                  JSONLinesFormatter())
+        producer.start()
+        producer.pauseProducing()
+        first.callback([{'a': 1}])
+        producer.stopProducing()
+        self.assertEqual(self.loaded, [first])
+        self.assertFalse(self.request.finished)
+        self.assertEqual(self.request.producer, None)
+
+    def test_failure(self):
+        producer = ExportProducer(self.request,
+                                  self.mk_bunches([fail(ValueError("oops"))]),
+                                  JSONLinesFormatter())
+        producer.start()
+        self.assertFalse(self.request.finished)
+        self.assertTrue(self.request.connection_lost)
+        [failure] = self.flushLoggedErrors(ValueError)
+
+    def test_csv(self):
+        producer = ExportProducer(
+            self.request, self.mk_bunches([succeed([
+                {'message_id': 'abc', 'content': u'caf\xe9',
+                 'timestamp': datetime(2013, 1, 2, 3, 4, 5)},
+                {'message_id': 'def', 'content': None}])]),
+            CSVFormatter(['message_id', 'content', 'timestamp']))
+        producer.start()
+        self.assertEqual(''.join(self.request.written).splitlines(), [
+            'message_id,content,timestamp',
+            'abc,caf\xc3\xa9,2013-01-02 03:04:05.000000',
+            'def,,',
+        ])
@@ -9,6 +9,8 @@ from twisted.internet.defer import inlineCallbacks, returnValue
 from vumi.message import TransportMessage
 from vumi.application.tests.test_base import ApplicationTestCase
 from vumi.components import MessageStore
+from vumi.components.message_store_cache import (
+    MessageStoreCache, MessageStoreCacheException)
 
 
 class TestMessageStoreCache(ApplicationTestCase):
@@ -151,6 +153,35 @@ class TestMessageStoreCache(ApplicationTestCase):
         count = yield self.cache.count_to_addrs(self.batch_id)
         self.assertEqual(count, 10)
 
+    @inlineCallbacks
+    def test_message_batch_id(self):
+        self.assertEqual((False, None),
+                         (yield self.cache.get_message_batch_id('msg1')))
+        yield self.cache.set_message_batch_id('msg1', self.batch_id)
+        yield self.cache.set_message_batch_id('msg2', None)
+        self.assertEqual((True, self.batch_id),
+                         (yield self.cache.get_message_batch_id('msg1')))
+        self.assertEqual((True, None),
+                         (yield self.cache.get_message_batch_id('msg2')))
+        ttl = yield self.redis.ttl(self.cache.message_batch_key('msg1'))
+        self.assertTrue(0 < ttl <= self.cache.DEFAULT_MESSAGE_BATCH_TTL)
+
+    @inlineCallbacks
+    def test_reconcile_checkpoints(self):
+        self.assertEqual(None, (yield self.cache.get_reconcile_checkpoint(
+            self.batch_id, 'inbound')))
+        yield self.cache.set_reconcile_checkpoint(
+            self.batch_id, 'inbound', 'key2')
+        yield self.cache.set_reconcile_checkpoint(
+            self.batch_id, 'outbound', 'key1')
+        self.assertEqual('key2', (yield self.cache.get_reconcile_checkpoint(
+            self.batch_id, 'inbound')))
+        self.assertEqual('key1', (yield self.cache.get_reconcile_checkpoint(
+            self.batch_id, 'outbound')))
+        yield self.cache.clear_reconcile_checkpoints(self.batch_id)
+        self.assertEqual(None, (yield self.cache.get_reconcile_checkpoint(
+            self.batch_id, 'inbound')))
+
     @inlineCallbacks
     def test_add_event(self):
         msg = self.mkmsg_out()
@@ -303,6 +334,18 @@ class TestMessageStoreCache(ApplicationTestCase):
             (yield self.cache.count_outbound_throughput(self.batch_id,
                 sample_time=10)), 2)
 
+    @inlineCallbacks
+    def test_count_throughput_beyond_history(self):
+        self.cache.throughput_history = 20
+        now = datetime.now()
+        for i in range(5):
+            msg_in = self.mkmsg_in()
+            msg_in['timestamp'] = now - timedelta(seconds=i * 10)
+            yield self.cache.add_inbound_message(self.batch_id, msg_in)
+        self.assertEqual(
+            (yield self.cache.count_inbound_throughput(self.batch_id,
+                sample_time=100)), 5)
+
     def test_get_query_token(self):
         cache = self.store.cache
         # different ordering in the dict should result in the same token.
@@ -342,3 +385,227 @@ class TestMessageStoreCache(ApplicationTestCase):
         self.assertEqual(
             (yield self.cache.count_query_results(self.batch_id, token)),
             10)
+
+    @inlineCallbacks
+    def test_store_query_results_unknown_keys(self):
+        self.cache.SEARCH_KEYS_CHUNK_SIZE = 3
+        now = datetime.now()
+        message_ids = []
+        for i in range(5):
+            msg_out = self.mkmsg_out(content='hello-%s' % (i,))
+            msg_out['timestamp'] = now - timedelta(seconds=i * 10)
+            yield self.cache.add_outbound_message(self.batch_id, msg_out)
+            message_ids.append(msg_out['message_id'])
+
+        token = yield self.cache.start_query(self.batch_id, 'outbound', [
+            {'key': 'msg.content', 'pattern': 'hello', 'flags': ''}])
+        yield self.cache.store_query_results(self.batch_id, token,
+            message_ids + ['unknown'], 'outbound')
+        self.assertEqual(
+            (yield self.cache.get_query_results(self.batch_id, token)),
+            message_ids)
+        self.assertFalse((yield self.redis.exists(
+            self.cache.search_keys_key(self.batch_id, token))))
+
+
+class TestTruncatingMessageStoreCache(TestMessageStoreCache):
+    """
+    Run the same tests against a cache that truncates its sets, with limits
+    too large for the tests above to notice.
+    """
+
+    @inlineCallbacks
+    def setUp(self):
+        yield super(TestTruncatingMessageStoreCache, self).setUp()
+        self.cache = self.store.cache = MessageStoreCache(
+            self.redis, max_keys=1000, max_age=3600)
+        yield self.cache.batch_start(self.batch_id)
+
+    def truncate(self, **kw):
+        self.cache.max_keys = kw.get('max_keys')
+        self.cache.max_age = kw.get('max_age')
+
+    @inlineCallbacks
+    def test_truncate_inbound_by_count(self):
+        self.truncate(max_keys=3)
+        messages = yield self.add_messages(
+            self.batch_id, self.cache.add_inbound_message, count=5)
+        self.assertEqual(
+            (yield self.cache.get_inbound_message_keys(self.batch_id)),
+            [m['message_id'] for m in messages[:3]])
+        self.assertEqual(
+            (yield self.cache.get_from_addrs(self.batch_id)),
+            ['from-0', 'from-1', 'from-2'])
+        self.assertEqual(
+            (yield self.cache.count_inbound_message_keys(self.batch_id)), 5)
+        self.assertEqual(
+            (yield self.cache.count_from_addrs(self.batch_id)), 5)
+        self.assertEqual(
+            (yield self.cache.count_inbound_throughput(self.batch_id)), 5)
+        self.assertEqual(
+            (yield self.cache.count_inbound_throughput(self.batch_id,
+                sample_time=1)), 2)
+
+    @inlineCallbacks
+    def test_truncate_outbound_by_age(self):
+        self.truncate(max_age=30)
+        now = datetime.now()
+        for i in range(10):
+            msg_out = self.mkmsg_out(to_addr='to-%s' % (i % 4,))
+            msg_out['timestamp'] = now + timedelta(seconds=i * 10)
+            yield self.cache.add_outbound_message(self.batch_id, msg_out)
+        self.assertEqual(
+            len((yield self.cache.get_outbound_message_keys(self.batch_id))),
+            4)
+        self.assertEqual(
+            (yield self.cache.count_outbound_message_keys(self.batch_id)), 10)
+        self.assertEqual(
+            (yield self.cache.count_to_addrs(self.batch_id)), 4)
+        self.assertEqual(
+            (yield self.cache.count_outbound_throughput(self.batch_id,
+                sample_time=60)), 7)
+        # Re-adding a message we still have doesn't count it again.
+        yield self.cache.add_outbound_message(self.batch_id, msg_out)
+        self.assertEqual(
+            (yield self.cache.count_outbound_message_keys(self.batch_id)), 10)
+
+    @inlineCallbacks
+    def test_truncate_events(self):
+        self.truncate(max_keys=2)
+        msg_out = self.mkmsg_out()
+        now = datetime.now()
+        acks = []
+        for i in range(4):
+            ack = self.mkmsg_ack(user_message_id=msg_out['message_id'])
+            ack['timestamp'] = now + timedelta(seconds=i)
+            yield self.cache.add_event(self.batch_id, ack)
+            acks.append(ack)
+        self.assertEqual(
+            (yield self.redis.zcard(self.cache.recent_event_key(
+                self.batch_id))), 2)
+        status = yield self.cache.get_event_status(self.batch_id)
+        self.assertEqual(status['ack'], 4)
+        # The most recent events are still deduplicated.
+        yield self.cache.add_event(self.batch_id, acks[-1])
+        status = yield self.cache.get_event_status(self.batch_id)
+        self.assertEqual(status['ack'], 4)
+
+    @inlineCallbacks
+    def test_count_throughput_beyond_history(self):
+        self.cache.throughput_history = 20
+        yield self.cache.add_inbound_message(self.batch_id, self.mkmsg_in())
+        yield self.assertFailure(
+            self.cache.count_inbound_throughput(self.batch_id,
+                                                sample_time=100),
+            MessageStoreCacheException)
+
+    @inlineCallbacks
+    def test_throughput_history(self):
+        self.cache.throughput_history = 20
+        now = datetime.now()
+        for i in range(5):
+            msg_in = self.mkmsg_in()
+            msg_in['timestamp'] = now + timedelta(seconds=i * 10)
+            yield self.cache.add_inbound_message(self.batch_id, msg_in)
+        buckets = yield self.redis.hkeys(
+            self.cache.throughput_key(self.batch_id, 'inbound'))
+        self.assertEqual(3, len(buckets))
+
+    @inlineCallbacks
+    def test_throughput_ignores_old_messages(self):
+        self.cache.throughput_history = 20
+        now = datetime.fromtimestamp(1000)
+        for seconds in [0, 10, -100, 5]:
+            msg_in = self.mkmsg_in()
+            msg_in['timestamp'] = now + timedelta(seconds=seconds)
+            yield self.cache.add_inbound_message(self.batch_id, msg_in)
+        throughput_key = self.cache.throughput_key(self.batch_id, 'inbound')
+        buckets = yield self.redis.hkeys(throughput_key)
+        self.assertEqual(3, len(buckets))
+        self.assertEqual(
+            (yield self.cache.count_inbound_throughput(self.batch_id,
+                                                       sample_time=20)), 3)
+
+        # Buckets left over from before the most recent bucket was kept
+        # aren't returned either.
+        timestamp = self.cache.get_timestamp(now)
+        yield self.redis.hset(throughput_key, str(int(timestamp) - 100), 1)
+        series = yield self.cache.get_inbound_throughput_series(self.batch_id)
+        self.assertEqual(11, len(series))
+        self.assertEqual(3, sum(count for _, count in series))
+
+    @inlineCallbacks
+    def test_throughput_history_gap(self):
+        self.cache.throughput_history = 20
+        now = datetime.fromtimestamp(1000)
+        for seconds in [0, 10, 100]:
+            msg_in = self.mkmsg_in()
+            msg_in['timestamp'] = now + timedelta(seconds=seconds)
+            yield self.cache.add_inbound_message(self.batch_id, msg_in)
+        timestamp = self.cache.get_timestamp(now)
+        self.assertEqual(
+            (yield self.redis.hgetall(
+                self.cache.throughput_key(self.batch_id, 'inbound'))),
+            {str(int(timestamp) + 100): '1'})
+
+
+class TestMessageStoreCacheThroughput(TestMessageStoreCache):
+    """
+    Run the same tests against a cache with per-minute throughput buckets.
+    """
+
+    @inlineCallbacks
+    def setUp(self):
+        yield super(TestMessageStoreCacheThroughput, self).setUp()
+        self.cache = self.store.cache = MessageStoreCache(
+            self.redis, throughput_resolution=60)
+        yield self.cache.batch_start(self.batch_id)
+
+    @inlineCallbacks
+    def test_count_inbound_throughput(self):
+        now = datetime.fromtimestamp(600)
+        for i in range(10):
+            msg_in = self.mkmsg_in()
+            msg_in['timestamp'] = now - timedelta(seconds=i * 20)
+            yield self.cache.add_inbound_message(self.batch_id, msg_in)
+
+        # Everything in the buckets starting at 540 and 600 is counted.
+        self.assertEqual(
+            (yield self.cache.count_inbound_throughput(self.batch_id,
+                sample_time=1)), 4)
+        self.assertEqual(
+            (yield self.cache.count_inbound_throughput(self.batch_id,
+                sample_time=60)), 4)
+        self.assertEqual(
+            (yield self.cache.count_inbound_throughput(self.batch_id,
+                sample_time=0)), 1)
+
+    @inlineCallbacks
+    def test_count_outbound_throughput(self):
+        now = datetime.fromtimestamp(600)
+        for i in range(10):
+            msg_out = self.mkmsg_out()
+            msg_out['timestamp'] = now - timedelta(seconds=i * 20)
+            yield self.cache.add_outbound_message(self.batch_id, msg_out)
+
+        self.assertEqual(
+            (yield self.cache.count_outbound_throughput(self.batch_id)), 10)
+        self.assertEqual(
+            (yield self.cache.count_outbound_throughput(self.batch_id,
+                sample_time=60)), 4)
+
+    @inlineCallbacks
+    def test_get_throughput_series(self):
+        self.assertEqual(
+            (yield self.cache.get_inbound_throughput_series(self.batch_id)),
+            [])
+        for seconds in [600, 610, 720, 490]:
+            msg_in = self.mkmsg_in()
+            msg_in['timestamp'] = datetime.fromtimestamp(seconds)
+            yield self.cache.add_inbound_message(self.batch_id, msg_in)
+        self.assertEqual(
+            (yield self.cache.get_inbound_throughput_series(self.batch_id)),
+            [(480, 1), (540, 0), (600, 2), (660, 0), (720, 1)])
+        self.assertEqual(
+            (yield self.cache.get_outbound_throughput_series(self.batch_id)),
+            [])
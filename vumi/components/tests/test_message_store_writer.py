@@ -0,0 +1,196 @@
+"""Tests for vumi.components.message_store_writer."""
+
+from twisted.trial.unittest import TestCase
+from twisted.internet.defer import Deferred, inlineCallbacks, succeed
+from twisted.internet.task import Clock
+
+from vumi.components.message_store_writer import MessageStoreWriter
+from vumi.blinkenlights.metrics import MetricManager
+from vumi.tests.utils import LogCatcher
+
+
+class RecordingStore(object):
+    """Just enough of a MessageStore to see what a writer does with it."""
+
+    def __init__(self):
+        self.bulk_adds = []
+        self.adds = []
+        self.fail_with = None
+        self.pause = None
+
+    def add_outbound_message(self, msg, tag=None, batch_id=None):
+        self.adds.append(('outbound', msg))
+        return succeed(None)
+
+    def add_inbound_message(self, msg, tag=None, batch_id=None):
+        self.adds.append(('inbound', msg))
+        return succeed(None)
+
+    def add_event(self, event):
+        self.adds.append(('event', event))
+        return succeed(None)
+
+    def bulk_add(self, outbound=(), inbound=(), events=()):
+        self.bulk_adds.append((outbound, inbound, events))
+        results = [(True, None)] * (len(outbound) + len(inbound) + len(events))
+        if self.fail_with is not None:
+            results[0] = (False, self.fail_with)
+        d = self.pause if self.pause is not None else succeed(None)
+        return d.addCallback(lambda _: results)
+
+
+class TestMessageStoreWriter(TestCase):
+
+    def setUp(self):
+        self.store = RecordingStore()
+        self.clock = Clock()
+
+    def mk_writer(self, **kw):
+        writer = MessageStoreWriter(self.store, **kw)
+        writer.clock = self.clock
+        writer.start()
+        self.addCleanup(writer.stop)
+        return writer
+
+    def test_unknown_durability(self):
+        self.assertRaises(ValueError, MessageStoreWriter, self.store,
+                          durability='eventually')
+
+    @inlineCallbacks
+    def test_sync(self):
+        writer = self.mk_writer(durability='sync')
+        yield writer.add_outbound_message('out', tag=('pool', 'tag'))
+        yield writer.add_inbound_message('in')
+        yield writer.add_event('ack')
+        self.assertEqual([('outbound', 'out'), ('inbound', 'in'),
+                          ('event', 'ack')], self.store.adds)
+        self.assertEqual([], self.store.bulk_adds)
+
+    def test_flush_on_interval(self):
+        writer = self.mk_writer(durability='buffered', flush_interval=1.0)
+        writer.add_outbound_message('out', tag=('pool', 'tag'))
+        writer.add_event('ack')
+        writer.add_inbound_message('in', batch_id='batch')
+        self.assertEqual(3, len(writer))
+        self.clock.advance(0.5)
+        self.assertEqual([], self.store.bulk_adds)
+
+        self.clock.advance(0.5)
+        self.assertEqual([([('out', ('pool', 'tag'), None)],
+                           [('in', None, 'batch')],
+                           ['ack'])], self.store.bulk_adds)
+        self.assertEqual(0, len(writer))
+
+    def test_flush_on_size(self):
+        writer = self.mk_writer(flush_size=2)
+        writer.add_outbound_message('out1')
+        self.assertEqual([], self.store.bulk_adds)
+        writer.add_outbound_message('out2')
+        self.assertEqual(
+            [([('out1', None, None), ('out2', None, None)], [], [])],
+            self.store.bulk_adds)
+
+    def test_flush_on_next_turn(self):
+        writer = self.mk_writer(flush_interval=10.0)
+        d1 = writer.add_outbound_message('out')
+        d2 = writer.add_event('ack')
+        self.assertFalse(d1.called)
+
+        self.clock.advance(0)
+        self.assertEqual([([('out', None, None)], [], ['ack'])],
+                         self.store.bulk_adds)
+        self.assertTrue(d1.called and d2.called)
+
+    def test_flush_on_next_turn_groups_writes(self):
+        self.store.pause = Deferred()
+        writer = self.mk_writer(flush_interval=10.0)
+        writer.add_outbound_message('out1')
+        self.clock.advance(0)
+        d2 = writer.add_outbound_message('out2')
+        d3 = writer.add_outbound_message('out3')
+        self.clock.advance(0)
+        self.assertEqual(1, len(self.store.bulk_adds))
+
+        self.store.pause.callback(None)
+        self.assertEqual([([('out2', None, None), ('out3', None, None)],
+                           [], [])], self.store.bulk_adds[1:])
+        self.assertTrue(d2.called and d3.called)
+
+    def test_buffered(self):
+        writer = self.mk_writer(durability='buffered', flush_size=10,
+                                max_queue_size=20)
+        d = writer.add_outbound_message('out')
+        self.assertTrue(d.called)
+        self.assertEqual(1, len(writer))
+
+    def test_buffered_queue_full(self):
+        self.store.pause = Deferred()
+        writer = self.mk_writer(durability='buffered', flush_size=2,
+                                max_queue_size=3)
+        writer.add_outbound_message('out1')
+        writer.add_outbound_message('out2')
+        self.assertEqual(1, len(self.store.bulk_adds))
+        self.assertTrue(writer.add_outbound_message('out3').called)
+        self.assertTrue(writer.add_outbound_message('out4').called)
+        d = writer.add_outbound_message('out5')
+        self.assertFalse(d.called)
+
+        self.store.pause.callback(None)
+        self.assertTrue(d.called)
+        self.assertEqual(2, len(self.store.bulk_adds))
+        self.assertEqual(0, len(writer))
+
+    def test_concurrent_flushes_are_shared(self):
+        self.store.pause = Deferred()
+        writer = self.mk_writer()
+        writer.add_outbound_message('out1')
+        writer.flush()
+        writer.add_outbound_message('out2')
+        d1 = writer.flush()
+        d2 = writer.flush()
+        self.assertEqual(1, len(self.store.bulk_adds))
+
+        self.store.pause.callback(None)
+        self.assertTrue(d1.called and d2.called)
+        self.assertEqual(2, len(self.store.bulk_adds))
+
+    @inlineCallbacks
+    def test_failed_write(self):
+        self.store.fail_with = ValueError("Riak is sad")
+        writer = self.mk_writer()
+        d1 = writer.add_outbound_message('out1')
+        d2 = writer.add_outbound_message('out2')
+        yield writer.flush()
+        yield self.assertFailure(d1, ValueError)
+        self.assertTrue(d2.called)
+
+    @inlineCallbacks
+    def test_failed_buffered_write(self):
+        self.store.fail_with = ValueError("Riak is sad")
+        writer = self.mk_writer(durability='buffered')
+        yield writer.add_outbound_message('out1')
+        with LogCatcher() as lc:
+            yield writer.flush()
+            [err] = lc.errors
+        self.assertEqual(err['why'], "Buffered message store write failed.")
+        [failure] = self.flushLoggedErrors(ValueError)
+
+    @inlineCallbacks
+    def test_stop_flushes(self):
+        writer = MessageStoreWriter(self.store)
+        writer.clock = self.clock
+        writer.start()
+        d = writer.add_event('ack')
+        yield writer.stop()
+        self.assertTrue(d.called)
+        self.assertEqual([([], [], ['ack'])], self.store.bulk_adds)
+
+    def test_metrics(self):
+        metrics = MetricManager('prefix.')
+        writer = self.mk_writer(metrics=metrics)
+        writer.add_outbound_message('out1')
+        writer.add_outbound_message('out2')
+        writer.flush()
+        self.assertEqual([2], [v for _t, v in
+                               metrics['message_store.queue_depth'].poll()])
+        self.assertEqual(1, len(metrics['message_store.flush_latency'].poll()))
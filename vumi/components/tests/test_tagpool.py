@@ -5,9 +5,11 @@
 import json
 
 from twisted.trial.unittest import TestCase
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import (
+    inlineCallbacks, gatherResults, maybeDeferred)
 
-from vumi.components.tagpool import TagpoolManager, TagpoolError
+from vumi.components.tagpool import (
+    TagpoolManager, TagpoolError, _fake_owner_entry)
 from vumi.tests.utils import PersistenceMixin
 
 
@@ -39,6 +41,20 @@ class TestTxTagpoolManager(TestCase, PersistenceMixin):
         yield self.tpm.declare_tags([tag2, tag3])
         self.assertEqual((yield self.tpm.acquire_tag("poolA")), tag3)
 
+    @inlineCallbacks
+    def test_declare_tags_in_batches(self):
+        tags = [("poolA", "tag%d" % i) for i in range(5)]
+        tags.append(("poolB", "tag0"))
+        self.tpm.BATCH_SIZE = 2
+        progress = []
+        yield self.tpm.declare_tags(
+            tags, progress=lambda *args: progress.append(args))
+        self.assertEqual(sorted(progress), [
+            ("poolA", 2, 5), ("poolA", 4, 5), ("poolA", 5, 5),
+            ("poolB", 1, 1)])
+        self.assertEqual((yield self.tpm.free_tags("poolA")), tags[:5])
+        self.assertEqual((yield self.tpm.free_tags("poolB")), tags[5:])
+
     @inlineCallbacks
     def test_declare_unicode_tag(self):
         tag = (u"poöl", u"tág")
@@ -52,6 +68,24 @@ class TestTxTagpoolManager(TestCase, PersistenceMixin):
         yield self.tpm.purge_pool('poolA')
         self.assertEqual((yield self.tpm.acquire_tag('poolA')), None)
 
+    @inlineCallbacks
+    def test_purge_pool_in_batches(self):
+        tkey = self.pool_key_generator("poolA")
+        tags = [("poolA", "tag%d" % i) for i in range(5)]
+        yield self.tpm.declare_tags(tags)
+        yield self.tpm.acquire_tag("poolA", "me")
+        yield self.tpm.release_tag(tags[0])
+        self.tpm.BATCH_SIZE = 2
+        progress = []
+        yield self.tpm.purge_pool(
+            "poolA", progress=lambda *args: progress.append(args))
+        self.assertEqual(progress, [
+            ("poolA", 2, 5), ("poolA", 4, 5), ("poolA", 5, 5)])
+        self.assertEqual((yield self.tpm.free_tags("poolA")), [])
+        self.assertEqual((yield self.tpm.list_pools()), set())
+        self.assertEqual((yield self.tpm.acquired_by(tags[0])), (None, None))
+        self.assertEqual((yield self.redis.keys(tkey("*"))), [])
+
     @inlineCallbacks
     def test_purge_unicode_pool(self):
         tag = (u"poöl", u"tág")
@@ -93,10 +127,8 @@ class TestTxTagpoolManager(TestCase, PersistenceMixin):
         self.assertEqual((yield self.tpm.acquire_tag("poolA")), tag1)
         self.assertEqual((yield self.tpm.acquire_tag("poolB")), None)
         redis = self.redis
-        self.assertEqual((yield redis.lrange(tkey("free:list"), 0, -1)),
+        self.assertEqual((yield redis.zrange(tkey("free:zset"), 0, -1)),
                          ["tag2"])
-        self.assertEqual((yield redis.smembers(tkey("free:set"))),
-                         set(["tag2"]))
         self.assertEqual((yield redis.smembers(tkey("inuse:set"))),
                          set(["tag1"]))
 
@@ -107,6 +139,47 @@ class TestTxTagpoolManager(TestCase, PersistenceMixin):
         self.assertEqual((yield self.tpm.acquire_tag(tag[0])), tag)
         self.assertEqual((yield self.tpm.acquire_tag(tag[0])), None)
 
+    @inlineCallbacks
+    def test_acquire_tags(self):
+        tkey = self.pool_key_generator("poolA")
+        tags = [("poolA", "tag%d" % i) for i in range(5)]
+        yield self.tpm.declare_tags(tags)
+        self.assertEqual((yield self.tpm.acquire_tags("poolA", 3, "me")),
+                         tags[:3])
+        self.assertEqual((yield self.tpm.acquire_tags("poolA", 3)),
+                         tags[3:])
+        self.assertEqual((yield self.tpm.acquire_tags("poolA", 3)), [])
+        self.assertEqual((yield self.tpm.acquire_tags("poolB", 3)), [])
+        self.assertEqual((yield self.redis.zrange(tkey("free:zset"), 0, -1)),
+                         [])
+        self.assertEqual(sorted((yield self.tpm.owned_tags("me"))),
+                         [list(tag) for tag in tags[:3]])
+
+    @inlineCallbacks
+    def test_concurrent_acquire_tag(self):
+        tags = [("poolA", "tag%d" % i) for i in range(5)]
+        yield self.tpm.declare_tags(tags)
+        acquired = yield gatherResults([
+            maybeDeferred(self.tpm.acquire_tag, "poolA")
+            for i in range(10)])
+        self.assertEqual(sorted(filter(None, acquired)), tags)
+
+    @inlineCallbacks
+    def test_legacy_pool(self):
+        tkey = self.pool_key_generator("poolA")
+        tags = [("poolA", "tag%d" % i) for i in range(4)]
+        # Pools used to keep their free tags in a list and a set.
+        for _pool, local_tag in reversed(tags):
+            yield self.redis.sadd(tkey("free:set"), local_tag)
+            yield self.redis.lpush(tkey("free:list"), local_tag)
+        self.assertEqual(sorted((yield self.tpm.free_tags("poolA"))), tags)
+        self.assertEqual((yield self.tpm.acquire_specific_tag(tags[1])),
+                         tags[1])
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")), tags[0])
+        self.assertEqual((yield self.tpm.free_tags("poolA")), tags[2:])
+        self.assertEqual((yield self.redis.exists(tkey("free:list"))), False)
+        self.assertEqual((yield self.redis.exists(tkey("free:set"))), False)
+
     @inlineCallbacks
     def test_acquire_specific_tag(self):
         tkey = self.pool_key_generator("poolA")
@@ -118,10 +191,8 @@ class TestTxTagpoolManager(TestCase, PersistenceMixin):
         free_local_tags = [t[1] for t in tags]
         free_local_tags.remove("tag5")
         redis = self.redis
-        self.assertEqual((yield redis.lrange(tkey("free:list"), 0, -1)),
+        self.assertEqual((yield redis.zrange(tkey("free:zset"), 0, -1)),
                          free_local_tags)
-        self.assertEqual((yield redis.smembers(tkey("free:set"))),
-                         set(free_local_tags))
         self.assertEqual((yield redis.smembers(tkey("inuse:set"))),
                          set(["tag5"]))
 
@@ -141,13 +212,27 @@ class TestTxTagpoolManager(TestCase, PersistenceMixin):
         yield self.tpm.acquire_tag("poolA")
         yield self.tpm.release_tag(tag1)
         redis = self.redis
-        self.assertEqual((yield redis.lrange(tkey("free:list"), 0, -1)),
+        self.assertEqual((yield redis.zrange(tkey("free:zset"), 0, -1)),
                          ["tag3", "tag1"])
-        self.assertEqual((yield redis.smembers(tkey("free:set"))),
-                         set(["tag1", "tag3"]))
         self.assertEqual((yield redis.smembers(tkey("inuse:set"))),
                          set(["tag2"]))
 
+    @inlineCallbacks
+    def test_release_tag_removes_owned_tag(self):
+        tag = ("poolA", "tag1")
+        yield self.tpm.declare_tags([tag])
+        yield self.tpm.acquire_tag("poolA", u"mé")
+        yield self.tpm.release_tag(tag)
+        self.assertEqual((yield self.tpm.owned_tags(u"mé")), [])
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")), tag)
+
+    @inlineCallbacks
+    def test_release_free_tag(self):
+        tag1, tag2 = ("poolA", "tag1"), ("poolA", "tag2")
+        yield self.tpm.declare_tags([tag1, tag2])
+        yield self.tpm.release_tag(tag1)
+        self.assertEqual((yield self.tpm.free_tags("poolA")), [tag1, tag2])
+
     @inlineCallbacks
     def test_release_unicode_tag(self):
         tag = (u"poöl", u"tág")
@@ -279,6 +364,25 @@ class TestTxTagpoolManager(TestCase, PersistenceMixin):
         my_tags = yield self.tpm.owned_tags(u"me")
         self.assertEqual(my_tags, [tags[0]])
 
+    @inlineCallbacks
+    def test_owned_tag_entry(self):
+        # Owner entries are written by cjson in redis and by
+        # _fake_owner_entry() in FakeRedis, which should agree.
+        yield self.tpm.declare_tags([[u"poöl", u"a/tág"]])
+        yield self.tpm.acquire_tag(u"poöl", owner="me")
+        entries = yield self.redis.smembers(self.tpm._owner_tag_list_key("me"))
+        self.assertEqual(list(entries),
+                         [u'["poöl","a\\/tág"]'.encode('utf-8')])
+
+    def test_fake_owner_entry(self):
+        # These are what cjson.encode({pool, tag}) returns.
+        self.assertEqual(_fake_owner_entry('pool', 'tag'), '["pool","tag"]')
+        self.assertEqual(_fake_owner_entry('a/b', 'c"\\\n\t\x01\x7f'),
+                         r'["a\/b","c\"\\\n\t\u0001\u007f"]')
+        self.assertEqual(
+            _fake_owner_entry(u'poöl'.encode('utf-8'), u'tág'.encode('utf-8')),
+            u'["poöl","tág"]'.encode('utf-8'))
+
 
 class TestTagpoolManager(TestTxTagpoolManager):
     sync_persistence = True
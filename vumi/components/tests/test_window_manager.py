@@ -1,5 +1,5 @@
 from twisted.trial.unittest import TestCase
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, gatherResults, Deferred
 from twisted.internet.task import Clock
 
 from vumi.components.window_manager import WindowManager, WindowException
@@ -83,6 +83,29 @@ class WindowManagerTestCase(TestCase, PersistenceMixin):
         next_flight_key = yield self.wm.get_next_key(self.window_id)
         self.assertTrue(next_flight_key)
 
+    @inlineCallbacks
+    def test_concurrent_fetching_from_window(self):
+        for i in range(20):
+            yield self.wm.add(self.window_id, i)
+
+        flight_keys = yield gatherResults([
+            self.wm.get_next_key(self.window_id) for i in range(20)])
+        self.assertEqual(len(filter(None, flight_keys)), 10)
+        yield self.assert_in_flight(self.window_id, 10)
+        yield self.assert_count_waiting(self.window_id, 10)
+
+    @inlineCallbacks
+    def test_remove_key(self):
+        yield self.wm.add(self.window_id, 1)
+        key = yield self.wm.get_next_key(self.window_id)
+        yield self.wm.remove_key(self.window_id, key)
+        self.assertEqual(
+            (yield self.redis.get(self.wm.window_key(self.window_id, key))),
+            None)
+        self.assertEqual(
+            (yield self.wm.get_expired_flight_keys(self.window_id)), [])
+        yield self.assert_in_flight(self.window_id, 0)
+
     @inlineCallbacks
     def test_set_and_external_id(self):
         yield self.wm.set_external_id(self.window_id, "flight_key",
@@ -213,6 +236,92 @@ class WindowManagerTestCase(TestCase, PersistenceMixin):
         self.assertEqual((yield self.wm.get_windows()), [])
         self.assertEqual(set(cleanup_callbacks), set(window_ids))
 
+    def test_monitor_windows_while_dispatching(self):
+        drains = []
+
+        def drain_window(window_id, key_callback):
+            drains.append(Deferred())
+            return drains[-1]
+
+        self.patch(self.wm, '_drain_window', drain_window)
+        self.wm._key_callback = lambda window_id, key: None
+
+        self.wm.wake(self.window_id)
+        swept = []
+        d = self.wm._monitor_windows(self.wm._key_callback, False)
+        d.addCallback(swept.append)
+        # The sweep waits for the running dispatch instead of draining the
+        # window alongside it.
+        self.assertEqual(len(drains), 1)
+        drains[0].callback(None)
+        self.assertEqual(len(drains), 2)
+        self.assertEqual(swept, [])
+        drains[1].callback(None)
+        self.assertEqual(len(swept), 1)
+
+    @inlineCallbacks
+    def test_monitor_windows_logs_errors(self):
+        yield self.wm.create_window('window_id_2')
+
+        def remove_window(window_id):
+            if window_id == self.window_id:
+                raise WindowException('Window not empty')
+            return self.redis.zrem(self.wm.WINDOW_KEY, window_id)
+
+        self.patch(self.wm, 'remove_window', remove_window)
+        yield self.wm._monitor_windows(lambda window_id, key: None, True)
+        self.assertEqual(1, len(self.flushLoggedErrors(WindowException)))
+        self.assertEqual((yield self.wm.get_windows()), [self.window_id])
+
+    @inlineCallbacks
+    def test_monitor_dispatches_on_add_and_remove(self):
+        key_callbacks = []
+        self.wm.monitor(lambda window_id, key: key_callbacks.append(key),
+                        cleanup=False)
+
+        keys = []
+        for i in range(12):
+            keys.append((yield self.wm.add(self.window_id, i)))
+        yield self.wm.wake(self.window_id)
+        # Only the first ten fit in the window.
+        self.assertEqual(key_callbacks, keys[:10])
+
+        yield self.wm.remove_key(self.window_id, keys[0])
+        yield self.wm.wake(self.window_id)
+        self.assertEqual(key_callbacks, keys[:11])
+
+    def test_wake_while_dispatching(self):
+        drains = []
+
+        def drain_window(window_id, key_callback):
+            drains.append(Deferred())
+            return drains[-1]
+
+        self.patch(self.wm, '_drain_window', drain_window)
+        self.wm._key_callback = lambda window_id, key: None
+
+        d1 = self.wm.wake(self.window_id)
+        d2 = self.wm.wake(self.window_id)
+        d3 = self.wm.wake(self.window_id)
+        self.assertEqual(len(drains), 1)
+        self.assertFalse(d1.called)
+
+        # The later wakes share a single extra pass.
+        drains[0].callback(None)
+        self.assertTrue(d1.called)
+        self.assertFalse(d2.called or d3.called)
+        self.assertEqual(len(drains), 2)
+
+        drains[1].errback(ValueError("Dispatch failed"))
+        self.assertTrue(d2.called and d3.called)
+        self.assertEqual(len(drains), 2)
+        self.assertEqual(self.wm._dispatching, {})
+        self.assertEqual(1, len(self.flushLoggedErrors(ValueError)))
+
+    def test_wake_without_monitor(self):
+        self.assertTrue(self.wm.wake(self.window_id).called)
+        self.assertEqual(self.wm._dispatching, {})
+
 
 class ConcurrentWindowManagerTestCase(TestCase, PersistenceMixin):
 
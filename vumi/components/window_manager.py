@@ -3,10 +3,97 @@ import json
 import uuid
 
 from twisted.internet import reactor
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import (
+    Deferred, inlineCallbacks, returnValue, gatherResults, succeed)
 from twisted.internet.task import LoopingCall
 
 from vumi import log
+from vumi.persist.redis_base import RedisScript
+
+
+def _fake_add(fake_redis, keys, args):
+    [data_key, window_key], [key, data] = keys, args
+    fake_redis.set.sync(fake_redis, data_key, data)
+    fake_redis.lpush.sync(fake_redis, window_key, key)
+
+
+# Stores the data before queueing its key, so that the key can't be
+# popped from the window before the data is available.
+ADD = RedisScript("""
+redis.call('SET', KEYS[1], ARGV[2])
+redis.call('LPUSH', KEYS[2], ARGV[1])
+""", _fake_add)
+
+
+def _fake_get_next_key(fake_redis, keys, args):
+    [window_key, inflight_key, stats_key] = keys
+    [window_size, clock_time] = args
+    if fake_redis.llen.sync(fake_redis, inflight_key) >= int(window_size):
+        return None
+    next_key = fake_redis.rpoplpush.sync(fake_redis, window_key, inflight_key)
+    if next_key is not None:
+        fake_redis.zadd.sync(fake_redis, stats_key, **{next_key: clock_time})
+    return next_key
+
+
+# Moves the next waiting key into flight if there's room in the window,
+# recording when it was sent.
+GET_NEXT_KEY = RedisScript("""
+if redis.call('LLEN', KEYS[2]) >= tonumber(ARGV[1]) then
+    return nil
+end
+local next_key = redis.call('RPOPLPUSH', KEYS[1], KEYS[2])
+if next_key then
+    redis.call('ZADD', KEYS[3], ARGV[2], next_key)
+end
+return next_key
+""", _fake_get_next_key)
+
+
+def _fake_remove_key(fake_redis, keys, args):
+    [inflight_key, data_key, key_stats_key, external_key, internal_prefix,
+     stats_key], [key] = keys, args
+    fake_redis.lrem.sync(fake_redis, inflight_key, key, 1)
+    fake_redis.delete.sync(fake_redis, data_key)
+    fake_redis.delete.sync(fake_redis, key_stats_key)
+    external_id = fake_redis.get.sync(fake_redis, external_key)
+    if external_id is not None:
+        fake_redis.delete.sync(fake_redis, external_key)
+        fake_redis.delete.sync(fake_redis, internal_prefix + external_id)
+    fake_redis.zrem.sync(fake_redis, stats_key, key)
+
+
+# Removes a key from flight along with its data, timestamp and external id
+# mappings. The internal id mapping's key is built from the prefix in
+# KEYS[5] because it depends on the external id.
+REMOVE_KEY = RedisScript("""
+redis.call('LREM', KEYS[1], 1, ARGV[1])
+redis.call('DEL', KEYS[2], KEYS[3])
+local external_id = redis.call('GET', KEYS[4])
+if external_id then
+    redis.call('DEL', KEYS[4], KEYS[5] .. external_id)
+end
+redis.call('ZREM', KEYS[6], ARGV[1])
+""", _fake_remove_key)
+
+
+def _fake_clear_expired(fake_redis, keys, args):
+    [stats_key, inflight_key], [max_timestamp] = keys, args
+    expired = fake_redis.zrangebyscore.sync(
+        fake_redis, stats_key, '-inf', max_timestamp)
+    for key in expired:
+        fake_redis.lrem.sync(fake_redis, inflight_key, key, 1)
+    return len(expired)
+
+
+# Takes keys that have been in flight for too long out of flight.
+CLEAR_EXPIRED_FLIGHT_KEYS = RedisScript("""
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+for _, key in ipairs(expired) do
+    redis.call('LREM', KEYS[2], 1, key)
+end
+return #expired
+""", _fake_clear_expired)
 
 
 class WindowException(Exception):
@@ -30,11 +117,16 @@ class WindowManager(object):
         self.gc.clock = self.clock
         self.gc.start(gc_interval)
         self._monitor = None
+        self._key_callback = None
+        # Maps the ids of windows currently being dispatched to the
+        # Deferreds waiting for the next dispatch pass.
+        self._dispatching = {}
 
     def noop(self, *args, **kwargs):
         pass
 
     def stop(self):
+        self._key_callback = None
         if self._monitor and self._monitor.running:
             self._monitor.stop()
 
@@ -89,42 +181,21 @@ class WindowManager(object):
     @inlineCallbacks
     def add(self, window_id, data, key=None):
         key = key or uuid.uuid4().get_hex()
-        # The redis.set() has to complete before redis.lpush(),
-        # otherwise the key can be popped from the window before the
-        # data is available.
-        yield self.redis.set(self.window_key(window_id, key),
-                             json.dumps(data))
-        yield self.redis.lpush(self.window_key(window_id), key)
+        yield self.redis.run_script(ADD, [
+            self.window_key(window_id, key),
+            self.window_key(window_id),
+        ], [key, json.dumps(data)])
+        self.wake(window_id)
         returnValue(key)
 
     @inlineCallbacks
     def get_next_key(self, window_id):
-
-        window_key = self.window_key(window_id)
-        inflight_key = self.flight_key(window_id)
-
-        waiting_list = yield self.count_waiting(window_id)
-        if waiting_list == 0:
-            return
-
-        flight_size = yield self.count_in_flight(window_id)
-        room_available = self.window_size - flight_size
-
-        if room_available > 0:
-            log.debug('Window %s has space for %s' % (window_key,
-                                                        room_available))
-            next_key = yield self.redis.rpoplpush(window_key, inflight_key)
-            if next_key:
-                yield self._set_timestamp(window_id, next_key)
-                returnValue(next_key)
-
-    def _set_timestamp(self, window_id, flight_key):
-        return self.redis.zadd(self.stats_key(window_id), **{
-                flight_key: self.get_clocktime(),
-        })
-
-    def _clear_timestamp(self, window_id, flight_key):
-        return self.redis.zrem(self.stats_key(window_id), flight_key)
+        next_key = yield self.redis.run_script(GET_NEXT_KEY, [
+            self.window_key(window_id),
+            self.flight_key(window_id),
+            self.stats_key(window_id),
+        ], [self.window_size, self.get_clocktime()])
+        returnValue(next_key)
 
     def count_waiting(self, window_id):
         window_key = self.window_key(window_id)
@@ -142,9 +213,10 @@ class WindowManager(object):
     def clear_expired_flight_keys(self):
         windows = yield self.get_windows()
         for window_id in windows:
-            expired_keys = yield self.get_expired_flight_keys(window_id)
-            for key in expired_keys:
-                yield self.redis.lrem(self.flight_key(window_id), key, 1)
+            yield self.redis.run_script(CLEAR_EXPIRED_FLIGHT_KEYS, [
+                self.stats_key(window_id),
+                self.flight_key(window_id),
+            ], [self.get_clocktime() - self.flight_lifetime])
 
     @inlineCallbacks
     def get_data(self, window_id, key):
@@ -153,11 +225,15 @@ class WindowManager(object):
 
     @inlineCallbacks
     def remove_key(self, window_id, key):
-        yield self.redis.lrem(self.flight_key(window_id), key, 1)
-        yield self.redis.delete(self.window_key(window_id, key))
-        yield self.redis.delete(self.stats_key(window_id, key))
-        yield self.clear_external_id(window_id, key)
-        yield self._clear_timestamp(window_id, key)
+        yield self.redis.run_script(REMOVE_KEY, [
+            self.flight_key(window_id),
+            self.window_key(window_id, key),
+            self.stats_key(window_id, key),
+            self.map_key(window_id, 'external', key),
+            self.map_key(window_id, 'internal', ''),
+            self.stats_key(window_id),
+        ], [key])
+        self.wake(window_id)
 
     @inlineCallbacks
     def set_external_id(self, window_id, flight_key, external_id):
@@ -183,28 +259,96 @@ class WindowManager(object):
 
     def monitor(self, key_callback, interval=10, cleanup=True,
                 cleanup_callback=None):
-
+        """
+        Call `key_callback(window_id, key)` for keys as they're let into
+        flight.
+
+        Adding a key to a window or removing one from flight wakes the
+        window's dispatcher straight away. Every `interval` seconds all
+        windows are swept as well, to pick up keys added by other window
+        managers or let into flight by expired keys, and empty windows are
+        removed if `cleanup` is set.
+        """
         if self._monitor is not None:
             raise WindowException('Monitor already started')
 
+        self._key_callback = key_callback
         self._monitor = LoopingCall(lambda: self._monitor_windows(
             key_callback, cleanup, cleanup_callback))
         self._monitor.clock = self.get_clock()
         self._monitor.start(interval)
 
+    def wake(self, window_id):
+        """
+        Dispatch any keys there's room for in `window_id` if the window is
+        being monitored.
+
+        Only one dispatcher runs per window. Waking a window that's already
+        being dispatched makes the dispatcher check the window again when
+        it's done instead of starting another one. Calls made while waiting
+        share the same pass.
+
+        Returns a Deferred that fires once the window has been checked.
+        """
+        if self._key_callback is None:
+            return succeed(None)
+        return self._wake(window_id, self._key_callback)
+
+    def _wake(self, window_id, key_callback):
+        d = Deferred()
+        if window_id in self._dispatching:
+            self._dispatching[window_id].append(d)
+            return d
+        self._dispatching[window_id] = [d]
+        self._dispatch_window(window_id, key_callback)
+        return d
+
     @inlineCallbacks
+    def _dispatch_window(self, window_id, key_callback):
+        while self._dispatching[window_id]:
+            waiters, self._dispatching[window_id] = (
+                self._dispatching[window_id], [])
+            try:
+                yield self._drain_window(window_id, key_callback)
+            except Exception:
+                log.err(None, 'Error dispatching window %s' % (window_id,))
+            for d in waiters:
+                d.callback(None)
+        del self._dispatching[window_id]
+
+    @inlineCallbacks
+    def _drain_window(self, window_id, key_callback):
+        key = (yield self.get_next_key(window_id))
+        while key:
+            yield key_callback(window_id, key)
+            key = (yield self.get_next_key(window_id))
+
     def _monitor_windows(self, key_callback, cleanup=True,
                          cleanup_callback=None):
-        windows = yield self.get_windows()
-        for window_id in windows:
-            key = (yield self.get_next_key(window_id))
-            while key:
-                yield key_callback(window_id, key)
-                key = (yield self.get_next_key(window_id))
-
-            # Remove empty windows if required
-            if cleanup and not ((yield self.count_waiting(window_id)) or
-                                (yield self.count_in_flight(window_id))):
-                if cleanup_callback:
-                    cleanup_callback(window_id)
-                yield self.remove_window(window_id)
+        # Errors are logged rather than returned so that they don't stop
+        # the monitor's LoopingCall.
+        def monitor_window(window_id):
+            d = self._monitor_window(window_id, key_callback, cleanup,
+                                     cleanup_callback)
+            d.addErrback(log.err, 'Error monitoring window %s' % (window_id,))
+            return d
+
+        d = self.get_windows()
+        d.addCallback(lambda windows: gatherResults(
+            [monitor_window(window_id) for window_id in windows]))
+        d.addErrback(log.err, 'Error monitoring windows')
+        return d
+
+    @inlineCallbacks
+    def _monitor_window(self, window_id, key_callback, cleanup,
+                        cleanup_callback):
+        # This goes through the window's dispatcher so that we don't drain
+        # a window that's already being dispatched.
+        yield self._wake(window_id, key_callback)
+
+        # Remove empty windows if required
+        if cleanup and not ((yield self.count_waiting(window_id)) or
+                            (yield self.count_in_flight(window_id))):
+            if cleanup_callback:
+                cleanup_callback(window_id)
+            yield self.remove_window(window_id)
@@ -13,7 +13,8 @@ class BaseConnector(object):
     individually all over the place.
     """
     def __init__(self, worker, connector_name, prefetch_count=None,
-                 middlewares=None):
+                 middlewares=None, concurrency=None, ack_batch_size=None,
+                 max_outstanding=None):
         self.name = connector_name
         self.worker = worker
         self._consumers = {}
@@ -21,6 +22,10 @@ class BaseConnector(object):
         self._endpoint_handlers = {}
         self._default_handlers = {}
         self._prefetch_count = prefetch_count
+        self._concurrency = concurrency
+        self._ack_batch_size = ack_batch_size
+        self._max_outstanding = max_outstanding
+        self._flow_paused = False
         self._middlewares = MiddlewareStack(middlewares
                                             if middlewares is not None else [])
 
@@ -53,13 +58,37 @@ class BaseConnector(object):
     @inlineCallbacks
     def _setup_publisher(self, mtype):
         publisher = yield self.worker.publish_to(self._rkey(mtype))
+        publisher.max_outstanding = self._max_outstanding
+        publisher.add_flow_listener(self._publisher_flow_changed)
         self._publishers[mtype] = publisher
         returnValue(publisher)
 
+    def _publisher_flow_changed(self, blocked):
+        # Stop consuming while any of our publishers are blocked, but don't
+        # unpause consumers that something else paused.
+        if any(p.blocked for p in self._publishers.itervalues()):
+            if not (self._flow_paused or self.paused):
+                self._flow_paused = True
+                self.pause()
+        elif self._flow_paused:
+            self._flow_paused = False
+            self.unpause()
+
     def _set_prefetch_count(self, consumer):
         if self._prefetch_count is not None:
             consumer.channel.basic_qos(0, self._prefetch_count, False)
 
+    def _set_concurrency(self, consumer):
+        concurrency = self._concurrency or 1
+        ack_batch_size = self._ack_batch_size or 1
+        if self._prefetch_count:
+            # There's no point in having more messages in flight than the
+            # broker will give us, and if we hold back acks for more than the
+            # prefetch window we'll only send them when processing stalls.
+            concurrency = min(concurrency, self._prefetch_count)
+            ack_batch_size = min(ack_batch_size, self._prefetch_count)
+        consumer.set_concurrency(concurrency, ack_batch_size)
+
     @inlineCallbacks
     def _setup_consumer(self, mtype, msg_class, default_handler):
         def handler(msg):
@@ -71,6 +100,7 @@ class BaseConnector(object):
         self._consumers[mtype] = consumer
         self._set_default_endpoint_handler(mtype, default_handler)
         self._set_prefetch_count(consumer)
+        self._set_concurrency(consumer)
         returnValue(consumer)
 
     def _set_endpoint_handler(self, mtype, handler, endpoint_name):
@@ -97,6 +127,15 @@ class BaseConnector(object):
         d = self._middlewares.apply_publish(mtype, msg, self.name)
         return d.addCallback(self._publishers[mtype].publish_message)
 
+    def _publish_messages(self, mtype, msgs, endpoint_name):
+        def apply_publish(msg):
+            if endpoint_name is not None:
+                msg.set_routing_endpoint(endpoint_name)
+            return self._middlewares.apply_publish(mtype, msg, self.name)
+
+        d = gatherResults([apply_publish(msg) for msg in msgs])
+        return d.addCallback(self._publishers[mtype].publish_message_batch)
+
 
 class ReceiveInboundConnector(BaseConnector):
     def setup(self):
@@ -128,6 +167,9 @@ class ReceiveInboundConnector(BaseConnector):
     def publish_outbound(self, msg, endpoint_name=None):
         return self._publish_message('outbound', msg, endpoint_name)
 
+    def publish_outbound_batch(self, msgs, endpoint_name=None):
+        return self._publish_messages('outbound', msgs, endpoint_name)
+
 
 class ReceiveOutboundConnector(BaseConnector):
     def setup(self):
@@ -149,5 +191,11 @@ class ReceiveOutboundConnector(BaseConnector):
     def publish_inbound(self, msg, endpoint_name=None):
         return self._publish_message('inbound', msg, endpoint_name)
 
+    def publish_inbound_batch(self, msgs, endpoint_name=None):
+        return self._publish_messages('inbound', msgs, endpoint_name)
+
     def publish_event(self, msg, endpoint_name=None):
         return self._publish_message('event', msg, endpoint_name)
+
+    def publish_event_batch(self, msgs, endpoint_name=None):
+        return self._publish_messages('event', msgs, endpoint_name)
@@ -1,5 +1,6 @@
 # -*- test-case-name: vumi.tests.test_message -*-
 
+import re
 import json
 from uuid import uuid4
 from datetime import datetime
@@ -12,19 +13,55 @@ from vumi.utils import to_kwargs
 # This is the date format we work with internally
 VUMI_DATE_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
 
+# Anything that might parse with VUMI_DATE_FORMAT. Checking this first means
+# we only call the (slow, exception-raising) strptime() on values that are
+# likely to be timestamps rather than on every string in the message.
+VUMI_DATE_RE = re.compile(
+    r"^\d{4}-\d{1,2}-\d{1,2} \d{1,2}:\d{1,2}:\d{1,2}\.\d{1,6}$")
+
+# The module used to encode and decode JSON. See :func:`set_json_backend`.
+_json_backend = json
+
+
+def parse_vumi_date(value):
+    """
+    Parse ``value`` as a :data:`VUMI_DATE_FORMAT` timestamp.
+
+    Returns a :class:`datetime` or ``None`` if ``value`` is not a timestamp.
+    """
+    if not isinstance(value, basestring) or not VUMI_DATE_RE.match(value):
+        return None
+    try:
+        if len(value) == 26:
+            # This is what JSONMessageEncoder produces, so we can avoid
+            # strptime() entirely.
+            return datetime(
+                int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                int(value[11:13]), int(value[14:16]), int(value[17:19]),
+                int(value[20:26]))
+        return datetime.strptime(value, VUMI_DATE_FORMAT)
+    except ValueError:
+        return None
+
 
 def date_time_decoder(json_object):
-    for key, value in json_object.items():
-        try:
-            json_object[key] = datetime.strptime(value,
-                    VUMI_DATE_FORMAT)
-        except ValueError:
-            continue
-        except TypeError:
-            continue
+    for key, value in json_object.iteritems():
+        dt = parse_vumi_date(value)
+        if dt is not None:
+            json_object[key] = dt
     return json_object
 
 
+def encode_date_time(obj):
+    """
+    Encode a :class:`datetime` for JSON. Used as the ``default`` callable
+    for ``json.dumps``.
+    """
+    if isinstance(obj, datetime):
+        return obj.strftime(VUMI_DATE_FORMAT)
+    raise TypeError("%r is not JSON serializable" % (obj,))
+
+
 class JSONMessageEncoder(json.JSONEncoder):
     """A JSON encoder that is able to serialize datetime"""
     def default(self, obj):
@@ -33,12 +70,30 @@ class JSONMessageEncoder(json.JSONEncoder):
         return super(JSONMessageEncoder, self).default(obj)
 
 
+def set_json_backend(backend=None):
+    """
+    Set the JSON module used by :func:`from_json` and :func:`to_json`.
+
+    :param backend:
+        A module with the same ``loads(s, object_hook=...)`` and
+        ``dumps(obj, default=...)`` interface as the standard library
+        :mod:`json` module (``simplejson``, for example). If ``None``, the
+        standard library :mod:`json` module is used.
+
+    Returns the previous backend.
+    """
+    global _json_backend
+    old_backend = _json_backend
+    _json_backend = json if backend is None else backend
+    return old_backend
+
+
 def from_json(json_string):
-    return json.loads(json_string, object_hook=date_time_decoder)
+    return _json_backend.loads(json_string, object_hook=date_time_decoder)
 
 
 def to_json(obj):
-    return json.dumps(obj, cls=JSONMessageEncoder)
+    return _json_backend.dumps(obj, default=encode_date_time)
 
 
 class Message(object):
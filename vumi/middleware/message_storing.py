@@ -5,6 +5,8 @@ from twisted.internet.defer import inlineCallbacks, returnValue
 from vumi.middleware.base import BaseMiddleware
 from vumi.middleware.tagger import TaggingMiddleware
 from vumi.components.message_store import MessageStore
+from vumi.components.message_store_writer import MessageStoreWriter
+from vumi.blinkenlights.metrics import MetricManager
 from vumi.persist.txriak_manager import TxRiakManager
 from vumi.persist.txredis_manager import TxRedisManager
 
@@ -35,6 +37,25 @@ class StoringMiddleware(BaseMiddleware):
     :param dict riak:
         Riak configuration parameters. Must contain at least
         a bucket_prefix key.
+    :param dict cache_retention:
+        Options for the redis cache, such as how many of the most recent
+        keys to keep for each batch. Accepts `max_keys`, `max_age`,
+        `throughput_history` and `throughput_resolution` options, as
+        described in
+        :class:`vumi.components.message_store_cache.MessageStoreCache`.
+    :param dict write_behind:
+        If given, writes are buffered and flushed to the message store in
+        bulk. Accepts `durability`, `max_queue_size`, `flush_size` and
+        `flush_interval` options, as described in
+        :class:`vumi.components.message_store_writer.MessageStoreWriter`.
+        By default every write is completed before the message is passed on.
+        With the default `flush` durability, writes are only batched when
+        several messages are processed at once (see
+        `amqp_consumer_concurrency`). Use `buffered` durability to pass
+        messages on before they are written.
+    :param string metrics_prefix:
+        If given along with `write_behind`, the write queue's depth and
+        flush latency are published as metrics with this prefix.
     """
 
     @inlineCallbacks
@@ -43,23 +64,40 @@ class StoringMiddleware(BaseMiddleware):
         r_config = self.config.get('redis_manager', {})
         self.redis = yield TxRedisManager.from_config(r_config)
         manager = TxRiakManager.from_config(self.config.get('riak_manager'))
-        self.store = MessageStore(manager,
-                                  self.redis.sub_manager(store_prefix))
+        self.store = MessageStore(
+            manager, self.redis.sub_manager(store_prefix),
+            cache_retention=self.config.get('cache_retention'))
+
+        self.metrics = None
+        wb_config = self.config.get('write_behind')
+        if wb_config is None:
+            self.writer = MessageStoreWriter(self.store, durability='sync')
+        else:
+            metrics_prefix = self.config.get('metrics_prefix')
+            if metrics_prefix is not None:
+                self.metrics = yield self.worker.start_publisher(
+                    MetricManager, metrics_prefix)
+            self.writer = MessageStoreWriter.from_config(
+                self.store, wb_config, metrics=self.metrics)
+        self.writer.start()
 
     @inlineCallbacks
     def teardown_middleware(self):
+        yield self.writer.stop()
+        if self.metrics is not None:
+            self.metrics.stop()
         yield self.redis.close_manager()
 
     @inlineCallbacks
     def handle_inbound(self, message, connector_name):
         tag = TaggingMiddleware.map_msg_to_tag(message)
-        yield self.store.add_inbound_message(message, tag=tag)
+        yield self.writer.add_inbound_message(message, tag=tag)
         returnValue(message)
 
     @inlineCallbacks
     def handle_outbound(self, message, connector_name):
         tag = TaggingMiddleware.map_msg_to_tag(message)
-        yield self.store.add_outbound_message(message, tag=tag)
+        yield self.writer.add_outbound_message(message, tag=tag)
         returnValue(message)
 
     @inlineCallbacks
@@ -72,5 +110,5 @@ class StoringMiddleware(BaseMiddleware):
             date = transport_metadata['date']
             if not isinstance(date, basestring):
                 transport_metadata['date'] = date.isoformat()
-        yield self.store.add_event(event)
+        yield self.writer.add_event(event)
         returnValue(event)
@@ -122,3 +122,24 @@ class StoringMiddlewareTestCase(TestCase, PersistenceMixin):
         response = yield self.mw.handle_event(ack, "dummy_connector")
         self.assertTrue(isinstance(response, TransportEvent))
         yield self.assert_outbound_stored(msg, events=[event_id])
+
+    @inlineCallbacks
+    def test_handle_outbound_write_behind(self):
+        yield self.mw.teardown_middleware()
+        from vumi.middleware.message_storing import StoringMiddleware
+        config = self.mk_config({'write_behind': {'durability': 'buffered'}})
+        self.mw = StoringMiddleware("dummy_storer", config, object())
+        yield self.mw.setup_middleware()
+        self.store = self.mw.store
+
+        batch_id = yield self.store.batch_start([("pool", "tag")])
+        msg = self.mk_msg()
+        TaggingMiddleware.add_tag_to_msg(msg, ["pool", "tag"])
+        yield self.mw.handle_outbound(msg, "dummy_connector")
+        ack = self.mk_ack(user_message_id=msg['message_id'])
+        yield self.mw.handle_event(ack, "dummy_connector")
+        self.assertEqual(2, len(self.mw.writer))
+
+        yield self.mw.writer.flush()
+        yield self.assert_outbound_stored(msg, batch_id,
+                                          events=[ack['event_id']])
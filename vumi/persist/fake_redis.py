@@ -1,6 +1,7 @@
 # -*- test-case-name: vumi.persist.tests.test_fake_redis -*-
 
 import fnmatch
+import hashlib
 from functools import wraps
 from itertools import takewhile, dropwhile
 
@@ -25,6 +26,25 @@ def maybe_async(func):
     return wrapper
 
 
+# FakeRedis can't run Lua, so scripts register an equivalent Python
+# implementation here, keyed by the SHA1 of their Lua source. See
+# vumi.persist.redis_base.RedisScript.
+_script_impls = {}
+
+
+def register_script_impl(lua, impl):
+    """Register a Python implementation of a Lua script.
+
+    :param str lua:
+        The Lua source of the script.
+    :param impl:
+        A function called as ``impl(fake_redis, keys, args)`` when the script
+        is run. It should use the ``.sync`` versions of the FakeRedis
+        operations and return what the Lua script would.
+    """
+    _script_impls[hashlib.sha1(lua).hexdigest()] = impl
+
+
 class FakeRedis(object):
     """In process and memory implementation of redis-like data store.
 
@@ -114,6 +134,12 @@ class FakeRedis(object):
             return 1
         return 0
 
+    @maybe_async
+    def setex(self, key, seconds, value):
+        self.set.sync(self, key, value)
+        self.expire.sync(self, key, seconds)
+        return True
+
     @maybe_async
     def delete(self, key):
         existed = (key in self._data)
@@ -192,6 +218,10 @@ class FakeRedis(object):
     def hvals(self, key):
         return map(self._encode, self._data.get(key, {}).values())
 
+    @maybe_async
+    def hkeys(self, key):
+        return map(self._encode, self._data.get(key, {}).keys())
+
     @maybe_async
     def hincrby(self, key, field, amount=1):
         value = self._data.get(key, {}).get(field, "0")
@@ -303,6 +333,60 @@ class FakeRedis(object):
         zval = self._data.get(key, Zset())
         return zval.zscore(value)
 
+    @maybe_async
+    def zremrangebyrank(self, key, start, stop):
+        zval = self._data.get(key, Zset())
+        return zval.zremrangebyrank(start, stop)
+
+    @maybe_async
+    def zremrangebyscore(self, key, min, max):
+        zval = self._data.get(key, Zset())
+        return zval.zremrangebyscore(min, max)
+
+    @maybe_async
+    def zinterstore(self, dest, keys, aggregate=None):
+        if isinstance(keys, dict):
+            keys, weights = keys.keys(), keys.values()
+        else:
+            weights = [1] * len(keys)
+        aggregate_func = {'SUM': sum, 'MIN': min, 'MAX': max}[
+            (aggregate or 'SUM').upper()]
+
+        scores = []
+        for key in keys:
+            value = self._data.get(key)
+            if isinstance(value, Zset):
+                scores.append(dict((v, s) for s, v in value._zval))
+            else:
+                # Members of plain sets have a score of 1.
+                scores.append(dict.fromkeys(value or (), 1.0))
+        members = set(scores[0]).intersection(*scores[1:])
+
+        zval = Zset()
+        zval._zval = sorted(
+            (aggregate_func([float(s[member] * weight)
+                             for s, weight in zip(scores, weights)]), member)
+            for member in members)
+        self._data.pop(dest, None)
+        if members:
+            self._data[dest] = zval
+        return len(members)
+
+    # HyperLogLog operations
+
+    # We count exactly using a plain set, which is close enough.
+
+    @maybe_async
+    def pfadd(self, key, *values):
+        sval = self._data.setdefault(key, set())
+        old_len = len(sval)
+        sval.update(map(self._encode, values))
+        return int(len(sval) != old_len)
+
+    @maybe_async
+    def pfcount(self, key):
+        return len(self._data.get(key, ()))
+
     # List operations
     @maybe_async
     def llen(self, key):
@@ -369,6 +453,44 @@ class FakeRedis(object):
         del lval[:start]
         del lval[stop:]
 
+    # Scripting operations
+
+    @maybe_async
+    def eval(self, script, numkeys, *keys_and_args):
+        return self.evalsha.sync(
+            self, hashlib.sha1(script).hexdigest(), numkeys, *keys_and_args)
+
+    @maybe_async
+    def evalsha(self, sha, numkeys, *keys_and_args):
+        impl = _script_impls.get(sha)
+        if impl is None:
+            raise NotImplementedError(
+                "No fake implementation registered for script %s" % (sha,))
+        keys_and_args = list(keys_and_args)
+        return impl(self, keys_and_args[:numkeys], keys_and_args[numkeys:])
+
+    # Pipelining
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    @maybe_async
+    def _execute_pipeline(self, calls):
+        results = []
+        error = None
+        for name, args, kw in calls:
+            try:
+                result = getattr(self, name).sync(self, *args, **kw)
+            except Exception, e:
+                result = e
+                error = error or e
+            results.append(result)
+        if error is not None:
+            # Like the Python redis module, we raise the first error only
+            # after making all the calls.
+            raise error
+        return results
+
     # Expiry operations
 
     @maybe_async
@@ -396,6 +518,31 @@ class FakeRedis(object):
         return 0
 
 
+class FakePipeline(object):
+    """Queues calls to a :class:`FakeRedis` until they're executed.
+
+    Pipelines share their :class:`FakeRedis` operations and the calls are
+    made one after the other, so they are trivially atomic here.
+    """
+
+    def __init__(self, fake_redis):
+        self._redis = fake_redis
+        self._calls = []
+
+    def __getattr__(self, name):
+        # Check that the operation exists before queueing it.
+        getattr(self._redis, name)
+
+        def queue_call(*args, **kw):
+            self._calls.append((name, args, kw))
+            return self
+        return queue_call
+
+    def execute(self):
+        calls, self._calls = self._calls, []
+        return self._redis._execute_pipeline(calls)
+
+
 class Zset(object):
     """A Redis-like ordered set implementation."""
 
@@ -420,6 +567,20 @@ class Zset(object):
     def zcard(self):
         return len(self._zval)
 
+    def _zrem_values(self, values):
+        values = set(values)
+        new_zval = [val for val in self._zval if val[1] not in values]
+        removed = len(self._zval) - len(new_zval)
+        self._zval = new_zval
+        return removed
+
+    def zremrangebyrank(self, start, stop):
+        return self._zrem_values(v for v, k in self.zrange(start, stop))
+
+    def zremrangebyscore(self, min, max):
+        return self._zrem_values(
+            v for v, k in self.zrangebyscore(min, max))
+
     def zrange(self, start, stop, desc=False, score_cast_func=float):
         stop += 1  # redis start/stop are element indexes
         if stop == 0:
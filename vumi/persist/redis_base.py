@@ -1,10 +1,11 @@
 # -*- test-case-name: vumi.persist.tests.test_redis_base -*-
 
 import os
+import hashlib
 from functools import wraps
 
 from vumi.persist.ast_magic import make_function
-from vumi.persist.fake_redis import FakeRedis
+from vumi.persist.fake_redis import FakeRedis, register_script_impl
 
 
 def make_callfunc(name, redis_call):
@@ -13,6 +14,10 @@ def make_callfunc(name, redis_call):
 
         def _f(k, v):
             if k in redis_call.key_args:
+                if isinstance(v, dict):
+                    return dict((self._key(vk), vv) for vk, vv in v.items())
+                if isinstance(v, (list, tuple)):
+                    return [self._key(vk) for vk in v]
                 return self._key(v)
             return v
 
@@ -29,8 +34,10 @@ def make_callfunc(name, redis_call):
         return result
 
     fargs = ['self'] + list(redis_call.args)
-    return make_function(name, func, fargs, redis_call.vararg,
-                         redis_call.kwarg, redis_call.defaults)
+    callfunc = make_function(name, func, fargs, redis_call.vararg,
+                             redis_call.kwarg, redis_call.defaults)
+    callfunc.redis_call = redis_call
+    return callfunc
 
 
 class RedisCall(object):
@@ -44,6 +51,78 @@ class RedisCall(object):
         self.key_args = key_args
 
 
+class RedisScript(object):
+    """A Lua script that is run atomically on the redis server.
+
+    :param str lua:
+        The Lua source of the script. Scripts should only return integers,
+        strings, nil or flat lists of these, because not all clients can
+        handle nested replies.
+    :param fake_impl:
+        A Python function with the same behaviour as the script, for use with
+        :class:`FakeRedis`. See
+        :func:`vumi.persist.fake_redis.register_script_impl`.
+    """
+
+    def __init__(self, lua, fake_impl):
+        self.lua = lua
+        self.sha = hashlib.sha1(lua).hexdigest()
+        register_script_impl(lua, fake_impl)
+
+
+class Pipeline(object):
+    """Redis calls queued on a manager to be sent all at once.
+
+    A pipeline has the same redis call methods as the manager it was created
+    from, but they only queue the call and return `None`. Calling
+    :meth:`execute` sends all the queued calls together and returns their
+    results, in order, the same way the manager returns the result of a
+    single call.
+
+    Pipelines are not transactions. Other clients may run commands between
+    the pipelined ones, so use :meth:`Manager.run_script` where atomicity is
+    required.
+    """
+
+    def __init__(self, manager):
+        self._manager = manager
+        self._calls = []
+
+    def __len__(self):
+        return len(self._calls)
+
+    def __getattr__(self, name):
+        callfunc = getattr(type(self._manager), name, None)
+        if getattr(callfunc, 'redis_call', None) is None:
+            # Not a redis call, so probably a helper such as ._key().
+            return getattr(self._manager, name)
+        return callfunc.im_func.__get__(self, type(self))
+
+    def _make_redis_call(self, call, *args, **kw):
+        self._calls.append((call, args, kw, None))
+
+    def _filter_redis_results(self, func, results):
+        call, args, kw, _ = self._calls[-1]
+        self._calls[-1] = (call, args, kw, func)
+
+    def execute(self):
+        """Send all queued calls and return a list of their results.
+
+        If any call fails, the first error is raised once all the calls
+        have been made.
+        """
+        calls, self._calls = self._calls, []
+        filters = [f_func for _call, _args, _kw, f_func in calls]
+
+        def filter_results(results):
+            return [f_func(result) if f_func is not None else result
+                    for f_func, result in zip(filters, results)]
+
+        results = self._manager._execute_pipeline(
+            [(call, args, kw) for call, args, kw, _f_func in calls])
+        return self._manager._filter_redis_results(filter_results, results)
+
+
 class CallMakerMetaclass(type):
     def __new__(meta, classname, bases, class_dict):
         new_class_dict = {}
@@ -179,6 +258,46 @@ class Manager(object):
         raise NotImplementedError("Sub-classes of Manager should implement"
                                   " ._filter_redis_results()")
 
+    def pipeline(self):
+        """Return a :class:`Pipeline` for sending several calls at once.
+
+        Calls made on the pipeline are queued until its `execute()` method
+        is called, which makes all of them in a single round trip::
+
+            pipe = manager.pipeline()
+            pipe.hsetnx('status', 'ack', 0)
+            pipe.hsetnx('status', 'nack', 0)
+            results = yield pipe.execute()
+        """
+        return Pipeline(self)
+
+    def _execute_pipeline(self, calls):
+        """Make a list of `(call, args, kw)` redis API calls in one round
+        trip using the underlying client library.
+        """
+        raise NotImplementedError("Sub-classes of Manager should implement"
+                                  " ._execute_pipeline()")
+
+    def run_script(self, script, keys=(), args=()):
+        """Run a :class:`RedisScript` atomically on the redis server.
+
+        :param RedisScript script:
+            The script to run.
+        :param list keys:
+            Keys the script operates on. These are prefixed with this
+            manager's key prefix and are available as `KEYS` in the script.
+        :param list args:
+            Other arguments, available as `ARGV` in the script.
+        """
+        keys = [self._key(key) for key in keys]
+        return self._run_script(script, keys, list(args))
+
+    def _run_script(self, script, keys, args):
+        """Run a script using the underlying client library.
+        """
+        raise NotImplementedError("Sub-classes of Manager should implement"
+                                  " ._run_script()")
+
     def _key(self, key):
         """
         Generate a key using this manager's key prefix
@@ -230,6 +349,7 @@ class Manager(object):
     hgetall = RedisCall(['key'])
     hlen = RedisCall(['key'])
     hvals = RedisCall(['key'])
+    hkeys = RedisCall(['key'])
     hincrby = RedisCall(['key', 'field', 'amount'], defaults=[1])
     hexists = RedisCall(['key', 'field'])
 
@@ -255,6 +375,15 @@ class Manager(object):
         'withscores'], defaults=['-inf', '+inf', None, None, False])
     zscore = RedisCall(['key', 'value'])
     zcount = RedisCall(['key', 'min', 'max'])
+    zremrangebyrank = RedisCall(['key', 'start', 'stop'])
+    zremrangebyscore = RedisCall(['key', 'min', 'max'])
+    zinterstore = RedisCall(['dest', 'keys', 'aggregate'], defaults=[None],
+                            key_args=['dest', 'keys'])
+
+    # HyperLogLog operations
+
+    pfadd = RedisCall(['key'], vararg='values')
+    pfcount = RedisCall(['key'])
 
     # List operations
 
@@ -47,9 +47,35 @@ class RedisManager(Manager):
     def _make_redis_call(self, call, *args, **kw):
         """Make a redis API call using the underlying client library.
         """
-        return getattr(self._client, call)(*args, **kw)
+        return self._client_call(self._client, call, args, kw)
+
+    def _client_call(self, client, call, args, kw):
+        if call == 'setex' and not isinstance(self._client, FakeRedis):
+            # redis.Redis.setex() takes the expiry time after the value.
+            key, seconds, value = args
+            args = (key, value, seconds)
+        return getattr(client, call)(*args, **kw)
+
+    def _execute_pipeline(self, calls):
+        """Make a list of redis API calls in one round trip using the
+        underlying client library.
+        """
+        pipe = self._client.pipeline(transaction=False)
+        for call, args, kw in calls:
+            self._client_call(pipe, call, args, kw)
+        return pipe.execute()
 
     def _filter_redis_results(self, func, results):
         """Filter results of a redis call.
         """
         return func(results)
+
+    def _run_script(self, script, keys, args):
+        """Run a script using the underlying client library.
+        """
+        try:
+            return self._client.evalsha(
+                script.sha, len(keys), *(keys + args))
+        except redis.exceptions.NoScriptError:
+            # The server hasn't seen this script yet, so send it the source.
+            return self._client.eval(script.lua, len(keys), *(keys + args))
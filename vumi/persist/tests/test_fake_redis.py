@@ -1,8 +1,22 @@
 # -*- coding: utf-8 -*-
+import hashlib
+
 from twisted.trial.unittest import TestCase
 from twisted.internet.defer import inlineCallbacks
 
-from vumi.persist.fake_redis import FakeRedis
+from vumi.persist.fake_redis import FakeRedis, register_script_impl
+
+
+SWAP_LUA = "return redis.call('GETSET', KEYS[1], ARGV[1])"
+
+
+def fake_swap(fake_redis, keys, args):
+    old_value = fake_redis.get.sync(fake_redis, keys[0])
+    fake_redis.set.sync(fake_redis, keys[0], args[0])
+    return old_value
+
+
+register_script_impl(SWAP_LUA, fake_swap)
 
 
 class FakeRedisTestCase(TestCase):
@@ -60,6 +74,14 @@ class FakeRedisTestCase(TestCase):
         yield self.assert_redis_op(False, 'setnx', "mykey", "other")
         yield self.assert_redis_op("value", 'get', "mykey")
 
+    @inlineCallbacks
+    def test_setex(self):
+        yield self.assert_redis_op(True, 'setex', "mykey", 10, "value")
+        yield self.assert_redis_op("value", 'get', "mykey")
+        yield self.assert_redis_op(9, 'ttl', "mykey")
+        self.redis.clock.advance(10)
+        yield self.assert_redis_op(None, 'get', "mykey")
+
     @inlineCallbacks
     def test_incr_with_by_param(self):
         yield self.redis.set("inc", 1)
@@ -156,6 +178,23 @@ class FakeRedisTestCase(TestCase):
         yield self.assert_redis_op(0.1, 'zscore', 'set', 'one')
         yield self.assert_redis_op(0.2, 'zscore', 'set', 'two')
 
+    @inlineCallbacks
+    def test_zinterstore(self):
+        yield self.redis.zadd('zset', one=1.0, two=2.0, three=3.0)
+        yield self.redis.sadd('set', 'one', 'three', 'four')
+        yield self.assert_redis_op(2, 'zinterstore', 'dest', ['zset', 'set'])
+        self.assertEqual((yield self.redis.zrange('dest', 0, -1,
+                                                  withscores=True)),
+                         [('one', 2.0), ('three', 4.0)])
+        yield self.assert_redis_op(2, 'zinterstore', 'dest',
+                                   {'zset': 1, 'set': 0})
+        self.assertEqual((yield self.redis.zrange('dest', 0, -1,
+                                                  withscores=True)),
+                         [('one', 1.0), ('three', 3.0)])
+        yield self.assert_redis_op(0, 'zinterstore', 'dest',
+                                   ['zset', 'missing'])
+        self.assertEqual((yield self.redis.exists('dest')), False)
+
     @inlineCallbacks
     def test_hgetall_returns_copy(self):
         yield self.redis.hset("hash", "foo", "1")
@@ -191,6 +230,26 @@ class FakeRedisTestCase(TestCase):
         self.assert_redis_op(1, 'hsetnx', 'key', 'other-field', 2)
         self.assertEqual((yield self.redis.hget('key', 'other-field')), '2')
 
+    @inlineCallbacks
+    def test_pipeline(self):
+        yield self.redis.set('inc', 1)
+        pipe = self.redis.pipeline()
+        pipe.incr('inc').hsetnx('hash', 'field', 1)
+        pipe.hsetnx('hash', 'field', 2)
+        self.assertEqual((yield self.redis.get('inc')), '1')
+        self.assertEqual((yield pipe.execute()), [2, 1, 0])
+        self.assertEqual((yield self.redis.get('inc')), '2')
+        self.assertEqual((yield self.redis.hget('hash', 'field')), '1')
+
+    @inlineCallbacks
+    def test_pipeline_error(self):
+        yield self.redis.set('string', 'a')
+        pipe = self.redis.pipeline()
+        pipe.hget('string', 'field')
+        pipe.set('foo', 'bar')
+        self.assertRaises(Exception, pipe.execute)
+        self.assertEqual((yield self.redis.get('foo')), 'bar')
+
     @inlineCallbacks
     def test_sadd(self):
         yield self.assert_redis_op(1, 'sadd', 'set', 1)
@@ -300,6 +359,18 @@ class FakeRedisTestCase(TestCase):
         yield self.assert_redis_op(0, 'persist', "tempval")
         yield self.assert_redis_op(1, 'expire', "tempval", 10)
 
+    @inlineCallbacks
+    def test_eval(self):
+        yield self.redis.set("swap", "old")
+        yield self.assert_redis_op('old', 'eval', SWAP_LUA, 1, "swap", "new")
+        yield self.assert_redis_op('new', 'get', "swap")
+
+    @inlineCallbacks
+    def test_evalsha(self):
+        sha = hashlib.sha1(SWAP_LUA).hexdigest()
+        yield self.assert_redis_op(None, 'evalsha', sha, 1, "swap", "new")
+        yield self.assert_redis_op('new', 'get', "swap")
+
     @inlineCallbacks
     def test_type(self):
         yield self.assert_redis_op('none', 'type', 'unknown_key')
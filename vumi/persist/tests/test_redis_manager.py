@@ -3,6 +3,18 @@
 from twisted.trial.unittest import TestCase
 
 from vumi.tests.utils import import_skip
+from vumi.persist.redis_base import RedisScript
+
+
+def fake_incr_pair(fake_redis, keys, args):
+    return [fake_redis.incr.sync(fake_redis, key, int(args[0]))
+            for key in keys]
+
+
+INCR_PAIR = RedisScript("""
+return {redis.call('INCRBY', KEYS[1], ARGV[1]),
+        redis.call('INCRBY', KEYS[2], ARGV[1])}
+""", fake_incr_pair)
 
 
 class RedisManagerTestCase(TestCase):
@@ -38,3 +50,41 @@ class RedisManagerTestCase(TestCase):
         self.manager.set('foo', 'baz')
         self.assertEqual(['foo'], self.manager.keys())
         self.assertEqual('baz', self.manager.get('foo'))
+
+    def test_setex(self):
+        self.assertEqual(None, self.manager.get('foo'))
+        self.manager.setex('foo', 30, 'bar')
+        self.assertEqual('bar', self.manager.get('foo'))
+        self.assertTrue(0 < self.manager.ttl('foo') <= 30)
+
+    def test_run_script(self):
+        self.assertEqual([2, 2], self.manager.run_script(
+            INCR_PAIR, ['foo', 'bar'], [2]))
+        self.assertEqual([5, 5], self.manager.run_script(
+            INCR_PAIR, ['foo', 'bar'], [3]))
+        self.assertEqual('5', self.manager.get('foo'))
+        self.assertEqual(['bar', 'foo'], sorted(self.manager.keys()))
+
+    def test_pipeline(self):
+        self.manager.set('foo', '1')
+        pipe = self.manager.pipeline()
+        self.assertEqual(None, pipe.incr('foo'))
+        pipe.setex('bar', 30, 'baz')
+        pipe.hsetnx('hash', 'field', 'a')
+        pipe.hsetnx('hash', 'field', 'b')
+        pipe.keys()
+        self.assertEqual(5, len(pipe))
+        results = pipe.execute()
+        self.assertEqual([2, True, 1, 0], results[:4])
+        self.assertEqual(['bar', 'foo', 'hash'], sorted(results[4]))
+        self.assertEqual(0, len(pipe))
+        self.assertEqual('baz', self.manager.get('bar'))
+        self.assertTrue(0 < self.manager.ttl('bar') <= 30)
+
+    def test_zinterstore(self):
+        self.manager.zadd('zset', one=1.0, two=2.0)
+        self.manager.sadd('set', 'two', 'three')
+        self.assertEqual(1, self.manager.zinterstore(
+            'dest', {'zset': 1, 'set': 0}))
+        self.assertEqual([('two', 2.0)], self.manager.zrange(
+            'dest', 0, -1, withscores=True))
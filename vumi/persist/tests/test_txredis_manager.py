@@ -4,6 +4,18 @@ from twisted.trial.unittest import TestCase
 from twisted.internet.defer import inlineCallbacks
 
 from vumi.persist.txredis_manager import TxRedisManager
+from vumi.persist.redis_base import RedisScript
+
+
+def fake_incr_pair(fake_redis, keys, args):
+    return [fake_redis.incr.sync(fake_redis, key, int(args[0]))
+            for key in keys]
+
+
+INCR_PAIR = RedisScript("""
+return {redis.call('INCRBY', KEYS[1], ARGV[1]),
+        redis.call('INCRBY', KEYS[2], ARGV[1])}
+""", fake_incr_pair)
 
 
 class RedisManagerTestCase(TestCase):
@@ -37,3 +49,56 @@ class RedisManagerTestCase(TestCase):
         yield self.manager.set('foo', 'baz')
         self.assertEqual(['foo'], (yield self.manager.keys()))
         self.assertEqual('baz', (yield self.manager.get('foo')))
+
+    @inlineCallbacks
+    def test_run_script(self):
+        self.assertEqual([2, 2], (yield self.manager.run_script(
+            INCR_PAIR, ['foo', 'bar'], [2])))
+        self.assertEqual([5, 5], (yield self.manager.run_script(
+            INCR_PAIR, ['foo', 'bar'], [3])))
+        self.assertEqual('5', (yield self.manager.get('foo')))
+        self.assertEqual(['bar', 'foo'], sorted((yield self.manager.keys())))
+
+    @inlineCallbacks
+    def test_pipeline(self):
+        yield self.manager.set('foo', '1')
+        pipe = self.manager.pipeline()
+        self.assertEqual(None, pipe.incr('foo'))
+        pipe.hsetnx('hash', 'field', 'a')
+        pipe.hsetnx('hash', 'field', 'b')
+        pipe.keys()
+        self.assertEqual(4, len(pipe))
+        results = yield pipe.execute()
+        self.assertEqual([2, 1, 0], results[:3])
+        self.assertEqual(['foo', 'hash'], sorted(results[3]))
+        self.assertEqual(0, len(pipe))
+        self.assertEqual('a', (yield self.manager.hget('hash', 'field')))
+
+    @inlineCallbacks
+    def test_pipeline_empty(self):
+        self.assertEqual([], (yield self.manager.pipeline().execute()))
+
+    @inlineCallbacks
+    def test_zinterstore(self):
+        yield self.manager.zadd('zset', one=1.0, two=2.0)
+        yield self.manager.sadd('set', 'two', 'three')
+        self.assertEqual(1, (yield self.manager.zinterstore(
+            'dest', {'zset': 1, 'set': 0})))
+        self.assertEqual([('two', 2.0)], (yield self.manager.zrange(
+            'dest', 0, -1, withscores=True)))
+
+    @inlineCallbacks
+    def test_multiple_values(self):
+        yield self.manager.hmset('hash', {'a': '1', 'b': '2', 'c': '3'})
+        self.assertEqual(2, (yield self.manager.hdel('hash', 'a', 'b')))
+        self.assertEqual(['c'], (yield self.manager.hkeys('hash')))
+        self.assertEqual(1, (yield self.manager.pfadd('hll', 'a', 'b')))
+        self.assertEqual(2, (yield self.manager.pfcount('hll')))
+
+    @inlineCallbacks
+    def test_zrangebyscore_limit(self):
+        yield self.manager.zadd('zset', one=1.0, two=2.0, three=3.0)
+        self.assertEqual(['one', 'two'], (yield self.manager.zrangebyscore(
+            'zset', '-inf', '+inf', 0, 2)))
+        self.assertEqual([('two', 2.0)], (yield self.manager.zrangebyscore(
+            'zset', '-inf', '+inf', 1, 1, withscores=True)))
@@ -45,6 +45,24 @@ class VumiRedis(txr.Redis):
         d.addCallback(lambda r: r.get(field) if r else None)
         return d
 
+    def sadd(self, key, *values):
+        # txredis only adds one member at a time.
+        self._send('SADD', key, *values)
+        return self.getResponse()
+
+    def hdel(self, key, *fields):
+        # txredis only deletes one field at a time.
+        self._send('HDEL', key, *fields)
+        return self.getResponse()
+
+    def pfadd(self, key, *values):
+        self._send('PFADD', key, *values)
+        return self.getResponse()
+
+    def pfcount(self, key):
+        self._send('PFCOUNT', key)
+        return self.getResponse()
+
     def lrem(self, key, value, num=0):
         return super(VumiRedis, self).lrem(key, value, count=num)
 
@@ -79,23 +97,42 @@ class VumiRedis(txr.Redis):
         pieces = zip(args[::2], args[1::2])
         pieces.extend(kwargs.iteritems())
         orig_zadd = super(VumiRedis, self).zadd
-        deferreds = [orig_zadd(key, member, score) for member, score in pieces]
+        # txredis sends str(score), which drops float precision.
+        deferreds = [orig_zadd(key, member, repr(score))
+                     for member, score in pieces]
         d = DeferredList(deferreds, fireOnOneErrback=True)
         d.addCallback(lambda results: sum([result for success, result
                                             in results if success]))
         return d
 
+    def eval(self, script, numkeys, *keys_and_args):
+        self._send('EVAL', script, numkeys, *keys_and_args)
+        return self.getResponse()
+
+    def evalsha(self, sha, numkeys, *keys_and_args):
+        self._send('EVALSHA', sha, numkeys, *keys_and_args)
+        return self.getResponse()
+
     def zrange(self, key, start, end, desc=False, withscores=False):
         return super(VumiRedis, self).zrange(key, start, end,
                                              withscores=withscores,
                                              reverse=desc)
 
+    # txredis only sends LIMIT if the offset is non-zero, so we build the
+    # command ourselves.
+
     def zrangebyscore(self, key, min, max, start=None, num=None,
                      withscores=False, score_cast_func=float):
-        d = super(VumiRedis, self).zrangebyscore(key, min, max,
-                        offset=start, count=num, withscores=withscores)
+        args = ['ZRANGEBYSCORE', key, min, max]
+        if start is not None and num is not None:
+            args.extend(['LIMIT', start, num])
+        if withscores:
+            args.append('WITHSCORES')
+        self._send(*args)
+        d = self.getResponse()
         if withscores:
-            d.addCallback(lambda r: [(v, score_cast_func(s)) for v, s in r])
+            d.addCallback(lambda r: [(v, score_cast_func(s))
+                                     for v, s in zip(r[::2], r[1::2])])
         return d
 
 
@@ -161,3 +198,39 @@ class TxRedisManager(Manager):
         """Filter results of a redis call.
         """
         return results.addCallback(func)
+
+    def _execute_pipeline(self, calls):
+        """Make a list of redis API calls in one round trip using the
+        underlying client library.
+
+        txredis writes each command as soon as it is called and matches
+        replies to commands in order, so making all the calls without
+        waiting for replies pipelines them.
+        """
+        if isinstance(self._client, FakeRedis):
+            pipe = self._client.pipeline(transaction=False)
+            for call, args, kw in calls:
+                getattr(pipe, call)(*args, **kw)
+            return pipe.execute()
+        d = DeferredList([self._make_redis_call(call, *args, **kw)
+                          for call, args, kw in calls], consumeErrors=True)
+
+        def check_results(results):
+            for success, result in results:
+                if not success:
+                    return result
+            return [result for _success, result in results]
+        return d.addCallback(check_results)
+
+    def _run_script(self, script, keys, args):
+        """Run a script using the underlying client library.
+        """
+        def _no_script(failure):
+            failure.trap(txr.ResponseError)
+            if not str(failure.value).startswith('NOSCRIPT'):
+                return failure
+            # The server hasn't seen this script yet, so send it the source.
+            return self._client.eval(script.lua, len(keys), *(keys + args))
+
+        d = self._client.evalsha(script.sha, len(keys), *(keys + args))
+        return d.addErrback(_no_script)
@@ -0,0 +1,115 @@
+import sys
+import json
+import time
+from datetime import datetime
+
+from twisted.python import usage
+
+from vumi.message import (
+    TransportUserMessage, VUMI_DATE_FORMAT, JSONMessageEncoder,
+    set_json_backend)
+from vumi.utils import to_kwargs
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["messages", "m", "10000",
+         "Total number of messages to encode and decode."],
+        ["backend", "b", None,
+         "Name of an alternative JSON module to benchmark (e.g. simplejson)."],
+    ]
+
+    longdesc = """Benchmarks vumi.message JSON encoding and decoding"""
+
+
+def legacy_date_time_decoder(json_object):
+    """
+    The original decoder, which calls strptime() on every value.
+    """
+    for key, value in json_object.items():
+        try:
+            json_object[key] = datetime.strptime(value, VUMI_DATE_FORMAT)
+        except ValueError:
+            continue
+        except TypeError:
+            continue
+    return json_object
+
+
+def legacy_to_json(msg):
+    return json.dumps(msg.payload, cls=JSONMessageEncoder)
+
+
+def legacy_from_json(json_string):
+    return TransportUserMessage(_process_fields=False, **to_kwargs(
+        json.loads(json_string, object_hook=legacy_date_time_decoder)))
+
+
+def current_to_json(msg):
+    return msg.to_json()
+
+
+def current_from_json(json_string):
+    return TransportUserMessage.from_json(json_string)
+
+
+class CodecBenchmark(object):
+    """
+    Encodes and decodes messages with the legacy and current codecs.
+    """
+
+    def __init__(self, options):
+        self.messages = int(options['messages'])
+        self.backend = options['backend']
+
+    def make_message(self, i):
+        return TransportUserMessage(
+            to_addr="1234", from_addr="5678", transport_name="bench",
+            transport_type="sms", content="Message %d" % (i,),
+            transport_metadata={'foo': 'bar', 'seq': i},
+            helper_metadata={'tag': {'tag': ['pool', 'tag%d' % (i,)]},
+                             'go': {'user_account': 'account'}})
+
+    def time_codec(self, name, encode, decode, msgs):
+        start = time.time()
+        json_strings = [encode(msg) for msg in msgs]
+        encode_done = time.time()
+        decoded = [decode(json_string) for json_string in json_strings]
+        decode_done = time.time()
+
+        for msg, decoded_msg in zip(msgs, decoded):
+            if not (msg == decoded_msg):
+                raise RuntimeError("Message %r does not equal decoded"
+                                   " message %r" % (msg, decoded_msg))
+
+        encode_time = encode_done - start
+        decode_time = decode_done - encode_done
+        print "%s:" % (name,)
+        print "  Encode took %.2f seconds (%.2f msgs/s)" % (
+            encode_time, self.messages / encode_time)
+        print "  Decode took %.2f seconds (%.2f msgs/s)" % (
+            decode_time, self.messages / decode_time)
+
+    def run(self):
+        msgs = [self.make_message(i) for i in range(self.messages)]
+        self.time_codec("Legacy", legacy_to_json, legacy_from_json, msgs)
+        self.time_codec("Current", current_to_json, current_from_json, msgs)
+        if self.backend is not None:
+            old_backend = set_json_backend(__import__(self.backend))
+            try:
+                self.time_codec("Current (%s)" % (self.backend,),
+                                current_to_json, current_from_json, msgs)
+            finally:
+                set_json_backend(old_backend)
+
+
+if __name__ == '__main__':
+    try:
+        options = Options()
+        options.parseOptions()
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0])
+        sys.exit(1)
+
+    CodecBenchmark(options).run()
@@ -0,0 +1,111 @@
+import sys
+import time
+
+from twisted.python import usage
+
+from vumi.components.message_store_cache import MessageStoreCache
+from vumi.persist.redis_manager import RedisManager
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["results", "n", "100000",
+         "Number of keys in the search result."],
+        ["host", None, "localhost", "Redis host."],
+        ["port", None, "6379", "Redis port."],
+        ["db", None, "0", "Redis database number."],
+        ["key-prefix", None, "benchmark_query_results",
+         "Prefix for all keys written. They are deleted afterwards."],
+    ]
+
+    optFlags = [
+        ["fake-redis", None, "Use an in-process FakeRedis."],
+    ]
+
+    longdesc = """Benchmarks storing ordered search results in the
+    MessageStoreCache"""
+
+
+def legacy_store_query_results(cache, batch_id, token, keys, direction,
+                               ttl=None):
+    """
+    The original store_query_results(), which looked up and stored each
+    key's timestamp separately.
+    """
+    ttl = ttl or cache.DEFAULT_SEARCH_RESULT_TTL
+    result_key = cache.search_result_key(batch_id, token)
+    score_set_key = cache.inbound_key(batch_id)
+    for key in keys:
+        timestamp = cache.redis.zscore(score_set_key, key)
+        cache.redis.zadd(result_key, **{key.encode('utf-8'): timestamp})
+    cache.redis.expire(result_key, ttl)
+    cache.redis.srem(cache.search_token_key(batch_id), token)
+
+
+class QueryResultsBenchmark(object):
+    """
+    Stores a large search result for a batch using both the legacy and
+    current implementations.
+    """
+
+    BATCH_ID = 'batch'
+
+    def __init__(self, options):
+        self.results = int(options['results'])
+        config = {'key_prefix': options['key-prefix']}
+        if options['fake-redis']:
+            config['FAKE_REDIS'] = 'yes'
+        else:
+            config.update({
+                'host': options['host'],
+                'port': int(options['port']),
+                'db': int(options['db']),
+            })
+        self.redis = RedisManager.from_config(config)
+        self.cache = MessageStoreCache(self.redis)
+
+    def populate(self):
+        keys = [u'message-%d' % (i,) for i in xrange(self.results)]
+        pipe = self.redis.pipeline()
+        for i, key in enumerate(keys):
+            pipe.zadd(self.cache.inbound_key(self.BATCH_ID), **{
+                key.encode('utf-8'): 1000000 + i})
+        pipe.execute()
+        return keys
+
+    def time_store(self, name, store_func, keys):
+        token = self.cache.start_query(self.BATCH_ID, 'inbound', [
+            {'key': 'msg.content', 'pattern': name, 'flags': ''}])
+        start = time.time()
+        store_func(self.cache, self.BATCH_ID, token, keys, 'inbound')
+        taken = time.time() - start
+
+        stored = self.cache.count_query_results(self.BATCH_ID, token)
+        if stored != len(keys):
+            raise RuntimeError("Expected %d results, stored %d." % (
+                len(keys), stored))
+        print "%s:" % (name,)
+        print "  Storing took %.2f seconds (%.2f keys/s)" % (
+            taken, len(keys) / taken)
+
+    def run(self):
+        try:
+            keys = self.populate()
+            print "Storing a search result of %d keys" % (len(keys),)
+            self.time_store("Legacy", legacy_store_query_results, keys)
+            self.time_store("Current", MessageStoreCache.store_query_results,
+                            keys)
+        finally:
+            self.redis._purge_all()
+
+
+if __name__ == '__main__':
+    try:
+        options = Options()
+        options.parseOptions()
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0])
+        sys.exit(1)
+
+    QueryResultsBenchmark(options).run()
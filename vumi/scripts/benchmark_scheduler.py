@@ -0,0 +1,143 @@
+import sys
+import time
+
+from twisted.python import usage
+from twisted.internet import reactor
+from twisted.internet.defer import maybeDeferred, inlineCallbacks
+from twisted.internet.task import LoopingCall
+
+from vumi.persist.redis_manager import RedisManager
+from vumi.persist.txredis_manager import TxRedisManager
+from vumi.transports.scheduler import Scheduler
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["scheduled", "n", "20000",
+         "Number of scheduled payloads in the backlog."],
+        ["tick", "t", "0.01",
+         "Seconds between reactor latency samples."],
+        ["host", None, "localhost", "Redis host."],
+        ["port", None, "6379", "Redis port."],
+        ["db", None, "0", "Redis database number."],
+        ["key-prefix", None, "benchmark_scheduler",
+         "Prefix for all keys written. They are deleted afterwards."],
+    ]
+
+    longdesc = """Benchmarks reactor latency while a Scheduler delivers a
+    large backlog, using both a blocking and a non-blocking redis manager"""
+
+
+class LatencySampler(object):
+    """
+    Measures how late a frequent timed call runs, which is how long the
+    reactor was kept from doing anything else.
+    """
+
+    def __init__(self, tick):
+        self.tick = tick
+        self.lags = []
+        self.loop = LoopingCall(self.sample)
+
+    def start(self):
+        self.last = time.time()
+        self.loop.start(self.tick, now=False)
+
+    def stop(self):
+        # The reactor may not have run a single sample if it was blocked
+        # the whole time, so count the time since the last one too.
+        self.sample()
+        self.loop.stop()
+
+    def sample(self):
+        now = time.time()
+        self.lags.append(max(0, now - self.last - self.tick))
+        self.last = now
+
+    def report(self):
+        lags = sorted(self.lags) or [0]
+        print "  Reactor latency: median %.1f ms, max %.1f ms" % (
+            lags[len(lags) // 2] * 1000, lags[-1] * 1000)
+
+
+class SchedulerBenchmark(object):
+    """
+    Fills a Scheduler with due payloads and times delivering them while
+    sampling reactor latency.
+    """
+
+    def __init__(self, options):
+        self.scheduled = int(options['scheduled'])
+        self.tick = float(options['tick'])
+        self.config = {
+            'key_prefix': options['key-prefix'],
+            'host': options['host'],
+            'port': int(options['port']),
+            'db': int(options['db']),
+        }
+
+    def populate(self, redis):
+        scheduler = Scheduler(redis, None)
+        now = time.time()
+        for i in xrange(self.scheduled):
+            scheduler.schedule(0, {'message': i}, now=now - 1)
+
+    @inlineCallbacks
+    def time_delivery(self, name, redis):
+        self.populate(self.sync_redis)
+        delivered = []
+        scheduler = Scheduler(
+            redis, lambda scheduled_at, payload: delivered.append(payload))
+        sampler = LatencySampler(self.tick)
+
+        sampler.start()
+        start = time.time()
+        yield scheduler.deliver_scheduled()
+        taken = time.time() - start
+        sampler.stop()
+
+        if len(delivered) != self.scheduled:
+            raise RuntimeError("Expected %d payloads, delivered %d." % (
+                self.scheduled, len(delivered)))
+        print "%s:" % (name,)
+        print "  Delivery took %.2f seconds (%.2f payloads/s)" % (
+            taken, self.scheduled / taken)
+        sampler.report()
+
+    @inlineCallbacks
+    def run(self):
+        self.sync_redis = RedisManager.from_config(self.config)
+        async_redis = yield TxRedisManager.from_config(self.config)
+        try:
+            print "Delivering a backlog of %d scheduled payloads" % (
+                self.scheduled,)
+            yield self.time_delivery("Blocking (RedisManager)",
+                                     self.sync_redis)
+            yield self.time_delivery("Non-blocking (TxRedisManager)",
+                                     async_redis)
+        finally:
+            self.sync_redis._purge_all()
+            yield async_redis.close_manager()
+
+
+if __name__ == '__main__':
+    try:
+        options = Options()
+        options.parseOptions()
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0])
+        sys.exit(1)
+
+    bench = SchedulerBenchmark(options)
+
+    def _eb(f):
+        f.printTraceback()
+
+    def _main():
+        d = maybeDeferred(bench.run)
+        d.addErrback(_eb)
+        d.addBoth(lambda _: reactor.stop())
+
+    reactor.callLater(0, _main)
+    reactor.run()
@@ -0,0 +1,115 @@
+import sys
+import time
+import binascii
+
+from twisted.python import usage
+from smpp.pdu_builder import DeliverSM
+
+from vumi.transports.smpp.clientserver.client import (
+    EsmeTransceiver, EsmeCallbacks)
+from vumi.transports.smpp.clientserver.config import ClientConfig
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["pdus", "p", "1000",
+         "Number of deliver_sm PDUs in each burst."],
+        ["bursts", "b", "10",
+         "Number of bursts to replay."],
+        ["read-size", "r", "65536",
+         "Number of bytes passed to dataReceived() at a time."],
+    ]
+
+    longdesc = """Benchmarks SMPP PDU framing in EsmeTransceiver"""
+
+
+class LegacyFramingEsme(EsmeTransceiver):
+    """
+    An EsmeTransceiver that frames PDUs the way it used to, by re-slicing a
+    string buffer for every PDU.
+    """
+
+    def __init__(self, *args, **kw):
+        EsmeTransceiver.__init__(self, *args, **kw)
+        self.datastream = ''
+
+    def pop_data(self):
+        data = None
+        if len(self.datastream) >= 16:
+            command_length = int(binascii.b2a_hex(self.datastream[0:4]), 16)
+            if len(self.datastream) >= command_length:
+                data = self.datastream[0:command_length]
+                self.datastream = self.datastream[command_length:]
+        return data
+
+    def dataReceived(self, data):
+        self.datastream += data
+        data = self.pop_data()
+        while data is not None:
+            self._queue_pdu(data)
+            data = self.pop_data()
+
+
+class FramingBenchmark(object):
+    """
+    Replays bursts of deliver_sm PDUs through EsmeTransceiver.dataReceived().
+    """
+
+    def __init__(self, options):
+        self.pdus = int(options['pdus'])
+        self.bursts = int(options['bursts'])
+        self.read_size = int(options['read-size'])
+
+    def make_burst(self):
+        return ''.join(
+            DeliverSM(i, short_message="Message %d" % (i,)).get_bin()
+            for i in range(1, self.pdus + 1))
+
+    def make_esme(self, esme_class):
+        config = ClientConfig(host="127.0.0.1", port="0",
+                              system_id="bench", password="password",
+                              log_pdus=False)
+        esme = esme_class(config, None, EsmeCallbacks())
+        esme.received = 0
+
+        def queue_pdu(data):
+            esme.received += 1
+        esme._queue_pdu = queue_pdu
+        return esme
+
+    def time_framing(self, name, esme_class, burst):
+        esme = self.make_esme(esme_class)
+        reads = [burst[i:i + self.read_size]
+                 for i in range(0, len(burst), self.read_size)]
+        start = time.time()
+        for _ in range(self.bursts):
+            for data in reads:
+                esme.dataReceived(data)
+        taken = time.time() - start
+
+        expected = self.pdus * self.bursts
+        if esme.received != expected:
+            raise RuntimeError("Expected %d PDUs, framed %d." % (
+                expected, esme.received))
+        print "%s:" % (name,)
+        print "  Framing took %.2f seconds (%.2f PDUs/s)" % (
+            taken, expected / taken)
+
+    def run(self):
+        burst = self.make_burst()
+        print "Replaying %d bursts of %d PDUs (%d bytes each)" % (
+            self.bursts, self.pdus, len(burst))
+        self.time_framing("Legacy", LegacyFramingEsme, burst)
+        self.time_framing("Current", EsmeTransceiver, burst)
+
+
+if __name__ == '__main__':
+    try:
+        options = Options()
+        options.parseOptions()
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0])
+        sys.exit(1)
+
+    FramingBenchmark(options).run()
@@ -0,0 +1,110 @@
+import sys
+import time
+
+from twisted.python import usage
+from smpp.pdu import unpack_pdu
+from smpp.pdu_builder import (
+    BindTransceiver, BindTransceiverResp, SubmitSM, SubmitSMResp, DeliverSM,
+    DeliverSMResp, EnquireLink, EnquireLinkResp, QuerySM)
+
+from vumi.transports.smpp.clientserver.client import (
+    EsmeTransceiver, EsmeCallbacks)
+from vumi.transports.smpp.clientserver.config import ClientConfig
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["iterations", "i", "10000",
+         "Number of times to encode and decode each PDU type."],
+    ]
+
+    longdesc = """Benchmarks SMPP PDU encoding and decoding by PDU type"""
+
+
+SAMPLE_PDUS = [
+    BindTransceiver(1, system_id="bench", password="password"),
+    BindTransceiverResp(1, system_id="bench"),
+    SubmitSM(2, short_message="Hello world", source_addr="1234",
+             destination_addr="27761234567"),
+    SubmitSMResp(2, "3rd_party_id"),
+    DeliverSM(3, short_message="Hello back", source_addr="27761234567",
+              destination_addr="1234"),
+    DeliverSMResp(3),
+    EnquireLink(4),
+    EnquireLinkResp(4),
+    QuerySM(5, "3rd_party_id", source_addr="1234"),
+]
+
+
+class FakeTransport(object):
+    def write(self, data):
+        pass
+
+
+def legacy_send_pdu(esme, pdu):
+    """
+    The original send_pdu(), which unpacked every PDU it sent.
+    """
+    data = pdu.get_bin()
+    unpacked = unpack_pdu(data)
+    command_id = unpacked['header']['command_id']
+    if command_id not in ('enquire_link', 'enquire_link_resp'):
+        '%s' % unpacked  # The log message was always built.
+    esme.transport.write(data)
+
+
+class PDUBenchmark(object):
+    """
+    Times encoding, decoding and sending each sample PDU type.
+    """
+
+    def __init__(self, options):
+        self.iterations = int(options['iterations'])
+
+    def make_esme(self):
+        config = ClientConfig(host="127.0.0.1", port="0",
+                              system_id="bench", password="password",
+                              log_pdus=False)
+        esme = EsmeTransceiver(config, None, EsmeCallbacks())
+        esme.transport = FakeTransport()
+        return esme
+
+    def time_calls(self, func, arg):
+        start = time.time()
+        for _ in xrange(self.iterations):
+            func(arg)
+        return time.time() - start
+
+    def rate(self, taken):
+        return self.iterations / taken if taken else float('inf')
+
+    def run(self):
+        esme = self.make_esme()
+        send_pdu = esme.send_pdu
+
+        def legacy_send(pdu):
+            return legacy_send_pdu(esme, pdu)
+
+        print "%-22s %12s %12s %14s %12s" % (
+            "PDU type", "encode/s", "decode/s", "legacy send/s", "send/s")
+        for pdu in SAMPLE_PDUS:
+            data = pdu.get_bin()
+            encode = self.time_calls(lambda pdu: pdu.get_bin(), pdu)
+            decode = self.time_calls(unpack_pdu, data)
+            legacy = self.time_calls(legacy_send, pdu)
+            current = self.time_calls(send_pdu, pdu)
+            print "%-22s %12.0f %12.0f %14.0f %12.0f" % (
+                pdu.obj['header']['command_id'], self.rate(encode),
+                self.rate(decode), self.rate(legacy), self.rate(current))
+
+
+if __name__ == '__main__':
+    try:
+        options = Options()
+        options.parseOptions()
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0])
+        sys.exit(1)
+
+    PDUBenchmark(options).run()
@@ -0,0 +1,171 @@
+import sys
+import json
+import time
+import uuid
+
+from twisted.python import usage
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    maybeDeferred, inlineCallbacks, returnValue, gatherResults)
+
+from vumi.components.window_manager import WindowManager
+from vumi.persist.txredis_manager import TxRedisManager
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["messages", "m", "10000",
+         "Number of messages to send through the window."],
+        ["window-size", "w", "100",
+         "Number of messages allowed in flight at once."],
+        ["host", None, "localhost", "Redis host."],
+        ["port", None, "6379", "Redis port."],
+        ["db", None, "0", "Redis database number."],
+        ["key-prefix", None, "benchmark_window_manager",
+         "Prefix for all keys written. They are deleted afterwards."],
+    ]
+
+    optFlags = [
+        ["fake-redis", None, "Use an in-process FakeRedis."],
+    ]
+
+    longdesc = """Benchmarks sending messages through a WindowManager"""
+
+
+class LegacyWindowManager(WindowManager):
+    """
+    A WindowManager that adds, fetches and removes keys the way it used to,
+    with a separate redis round trip for each step.
+    """
+
+    @inlineCallbacks
+    def add(self, window_id, data, key=None):
+        key = key or uuid.uuid4().get_hex()
+        yield self.redis.set(self.window_key(window_id, key),
+                             json.dumps(data))
+        yield self.redis.lpush(self.window_key(window_id), key)
+        returnValue(key)
+
+    @inlineCallbacks
+    def get_next_key(self, window_id):
+        window_key = self.window_key(window_id)
+        inflight_key = self.flight_key(window_id)
+
+        waiting_list = yield self.count_waiting(window_id)
+        if waiting_list == 0:
+            return
+
+        flight_size = yield self.count_in_flight(window_id)
+        room_available = self.window_size - flight_size
+
+        if room_available > 0:
+            next_key = yield self.redis.rpoplpush(window_key, inflight_key)
+            if next_key:
+                yield self.redis.zadd(self.stats_key(window_id), **{
+                    next_key: self.get_clocktime(),
+                })
+                returnValue(next_key)
+
+    @inlineCallbacks
+    def remove_key(self, window_id, key):
+        yield self.redis.lrem(self.flight_key(window_id), key, 1)
+        yield self.redis.delete(self.window_key(window_id, key))
+        yield self.redis.delete(self.stats_key(window_id, key))
+        yield self.clear_external_id(window_id, key)
+        yield self.redis.zrem(self.stats_key(window_id), key)
+
+
+class WindowBenchmark(object):
+    """
+    Queues messages in a window and then sends them, acking each message
+    as soon as it's in flight, using both the legacy and current
+    implementations.
+    """
+
+    WINDOW_ID = 'window'
+
+    def __init__(self, options):
+        self.messages = int(options['messages'])
+        self.window_size = int(options['window-size'])
+        self.config = {'key_prefix': options['key-prefix']}
+        if options['fake-redis']:
+            self.config['FAKE_REDIS'] = 'yes'
+        else:
+            self.config.update({
+                'host': options['host'],
+                'port': int(options['port']),
+                'db': int(options['db']),
+            })
+
+    @inlineCallbacks
+    def send_next(self, wm):
+        key = yield wm.get_next_key(self.WINDOW_ID)
+        if key is None:
+            returnValue(0)
+        yield wm.get_data(self.WINDOW_ID, key)
+        yield wm.remove_key(self.WINDOW_ID, key)
+        returnValue(1)
+
+    @inlineCallbacks
+    def time_window(self, name, wm_class, redis):
+        wm = wm_class(redis, window_size=self.window_size)
+        yield wm.create_window(self.WINDOW_ID)
+
+        start = time.time()
+        yield gatherResults([wm.add(self.WINDOW_ID, {'message': i})
+                             for i in xrange(self.messages)])
+        added = time.time()
+
+        sent = 0
+        while sent < self.messages:
+            results = yield gatherResults([
+                self.send_next(wm) for _ in xrange(self.window_size)])
+            if not any(results):
+                raise RuntimeError("Window stalled after %d messages." % (
+                    sent,))
+            sent += sum(results)
+        done = time.time()
+
+        yield wm.remove_window(self.WINDOW_ID)
+        add_time = added - start
+        send_time = done - added
+        print "%s:" % (name,)
+        print "  Adding took %.2f seconds (%.2f msgs/s)" % (
+            add_time, self.messages / add_time)
+        print "  Sending took %.2f seconds (%.2f msgs/s)" % (
+            send_time, self.messages / send_time)
+
+    @inlineCallbacks
+    def run(self):
+        redis = yield TxRedisManager.from_config(self.config)
+        try:
+            print "Sending %d messages through a window of %d" % (
+                self.messages, self.window_size)
+            yield self.time_window("Legacy", LegacyWindowManager, redis)
+            yield self.time_window("Current", WindowManager, redis)
+        finally:
+            yield redis._purge_all()
+            yield redis.close_manager()
+
+
+if __name__ == '__main__':
+    try:
+        options = Options()
+        options.parseOptions()
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0])
+        sys.exit(1)
+
+    bench = WindowBenchmark(options)
+
+    def _eb(f):
+        f.printTraceback()
+
+    def _main():
+        d = maybeDeferred(bench.run)
+        d.addErrback(_eb)
+        d.addBoth(lambda _: reactor.stop())
+
+    reactor.callLater(0, _main)
+    reactor.run()
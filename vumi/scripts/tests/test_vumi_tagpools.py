@@ -45,6 +45,7 @@ class CreatePoolCmdTestCase(TagPoolBaseTestCase):
             'Creating pool shortcode ...',
             '  Setting metadata ...',
             '  Declaring 1000 tag(s) ...',
+            '    1000 of 1000 tag(s) done ...',
             '  Done.',
             ])
         self.assertEqual(cfg.tagpool.get_metadata("shortcode"),
@@ -53,6 +54,21 @@ class CreatePoolCmdTestCase(TagPoolBaseTestCase):
                          [("shortcode", str(d)) for d in range(10001, 11001)])
         self.assertEqual(cfg.tagpool.inuse_tags("shortcode"), [])
 
+    def test_create_pool_in_batches(self):
+        cfg = make_cfg(["create-pool", "shortcode"])
+        cfg.tagpool.BATCH_SIZE = 400
+        cfg.run()
+        self.assertEqual(cfg.output, [
+            'Creating pool shortcode ...',
+            '  Setting metadata ...',
+            '  Declaring 1000 tag(s) ...',
+            '    400 of 1000 tag(s) done ...',
+            '    800 of 1000 tag(s) done ...',
+            '    1000 of 1000 tag(s) done ...',
+            '  Done.',
+            ])
+        self.assertEqual(len(cfg.tagpool.free_tags("shortcode")), 1000)
+
     def test_create_pool_explicit_tags(self):
         cfg = make_cfg(["create-pool", "xmpp"])
         cfg.run()
@@ -60,6 +76,7 @@ class CreatePoolCmdTestCase(TagPoolBaseTestCase):
             'Creating pool xmpp ...',
             '  Setting metadata ...',
             '  Declaring 1 tag(s) ...',
+            '    1 of 1 tag(s) done ...',
             '  Done.',
             ])
         self.assertEqual(cfg.tagpool.get_metadata("xmpp"),
@@ -88,6 +105,7 @@ class PurgePoolCmdTestCase(TagPoolBaseTestCase):
         cfg.run()
         self.assertEqual(cfg.output, [
             'Purging pool foo ...',
+            '    2 of 2 tag(s) done ...',
             '  Done.',
             ])
         self.assertEqual(cfg.tagpool.free_tags("foo"), [])
@@ -28,7 +28,7 @@ class CreatePoolCmd(PoolSubCmd):
         cfg.emit("  Setting metadata ...")
         cfg.tagpool.set_metadata(self.pool, metadata)
         cfg.emit("  Declaring %d tag(s) ..." % len(tags))
-        cfg.tagpool.declare_tags(tags)
+        cfg.tagpool.declare_tags(tags, progress=cfg.emit_progress)
         cfg.emit("  Done.")
 
 
@@ -44,7 +44,7 @@ class UpdatePoolMetadataCmd(PoolSubCmd):
 class PurgePoolCmd(PoolSubCmd):
     def run(self, cfg):
         cfg.emit("Purging pool %s ..." % self.pool)
-        cfg.tagpool.purge_pool(self.pool)
+        cfg.tagpool.purge_pool(self.pool, progress=cfg.emit_progress)
         cfg.emit("  Done.")
 
 
@@ -155,6 +155,9 @@ class ConfigHolder(object):
     def emit(self, s):
         print s
 
+    def emit_progress(self, pool, done, total):
+        self.emit("    %d of %d tag(s) done ..." % (done, total))
+
     def tags(self, pool):
         tags = self.pools[pool]['tags']
         if isinstance(tags, basestring):
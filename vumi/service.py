@@ -1,12 +1,14 @@
 # -*- test-case-name: vumi.tests.test_service -*-
 
 import json
+from collections import deque
 from copy import deepcopy
 
 from twisted.python import log
 from twisted.application.service import MultiService
 from twisted.application.internet import TCPClient
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, Deferred, maybeDeferred)
 from twisted.internet import protocol, reactor
 from twisted.web.resource import Resource
 import txamqp
@@ -75,9 +77,17 @@ class AmqpFactory(protocol.ReconnectingClientFactory):
 
 
 class WorkerAMQClient(AMQClient):
+    def __init__(self, *args, **kw):
+        AMQClient.__init__(self, *args, **kw)
+        self._publishers = []
+        self._connection_blocked = False
+
     @inlineCallbacks
     def connectionMade(self):
         AMQClient.connectionMade(self)
+        # We register as a producer so the transport tells us when the broker
+        # isn't reading as fast as we're writing.
+        self.transport.registerProducer(self, True)
         yield self.authenticate(self.vumi_options['username'],
                                 self.vumi_options['password'])
         # authentication was successful
@@ -154,9 +164,26 @@ class WorkerAMQClient(AMQClient):
         yield self._declare_exchange(publisher, channel)
         # start!
         yield publisher.start(channel)
+        self._publishers.append(publisher)
+        if self._connection_blocked:
+            publisher.set_connection_blocked(True)
         # return the publisher
         returnValue(publisher)
 
+    def _set_connection_blocked(self, blocked):
+        self._connection_blocked = blocked
+        for publisher in self._publishers:
+            publisher.set_connection_blocked(blocked)
+
+    def pauseProducing(self):
+        self._set_connection_blocked(True)
+
+    def resumeProducing(self):
+        self._set_connection_blocked(False)
+
+    def stopProducing(self):
+        pass
+
 
 class Worker(MultiService, object):
     """
@@ -285,6 +312,13 @@ class Consumer(object):
     message_class = Message
     start_paused = False
 
+    # The maximum number of messages processed concurrently and the number
+    # of processed messages to acknowledge with a single basic_ack. The
+    # defaults process and acknowledge messages strictly one at a time. See
+    # :meth:`set_concurrency`.
+    max_in_flight = 1
+    ack_batch_size = 1
+
     @inlineCallbacks
     def start(self, channel, queue):
         self.channel = channel
@@ -292,17 +326,27 @@ class Consumer(object):
         self.keep_consuming = True
         self._testing = hasattr(channel, 'message_processed')
         self.paused = self.start_paused
+        self._in_flight = 0
+        self._slot_d = None
+        # [delivery_tag, processed] pairs in delivery order.
+        self._delivered = deque()
 
         @inlineCallbacks
         def read_messages():
             log.msg("Consumer starting...")
             try:
                 while self.keep_consuming:
+                    if self._in_flight >= self.max_in_flight:
+                        self._slot_d = Deferred()
+                        yield self._slot_d
                     message = yield self.queue.get()
                     if isinstance(message, QueueCloseMarker):
                         log.msg("Queue closed.")
                         return
-                    yield self.consume(message)
+                    if self.is_batching():
+                        self._consume_in_flight(message)
+                    else:
+                        yield self.consume(message)
             except txamqp.queue.Closed, e:
                 log.err("Queue has closed", e)
 
@@ -310,6 +354,74 @@ class Consumer(object):
         yield None
         returnValue(self)
 
+    def set_concurrency(self, max_in_flight, ack_batch_size=1):
+        """
+        Process up to `max_in_flight` messages concurrently and acknowledge
+        processed messages `ack_batch_size` at a time.
+
+        Messages are acknowledged in delivery order using a single basic_ack
+        with `multiple` set, so a slow message holds back acknowledgements
+        for those delivered after it. As with sequential consumption, a
+        message that isn't acknowledged because processing failed or
+        returned `False` is covered by the next acknowledgement. Pending
+        acknowledgements are always sent once no messages are being
+        processed, so `max_in_flight` should not be more than the channel's
+        prefetch count.
+        """
+        self.max_in_flight = max(1, max_in_flight)
+        self.ack_batch_size = max(1, ack_batch_size)
+        self._release_slot()
+
+    def is_batching(self):
+        return self.max_in_flight > 1 or self.ack_batch_size > 1
+
+    def _release_slot(self):
+        slot_d = getattr(self, '_slot_d', None)
+        if slot_d is not None and self._in_flight < self.max_in_flight:
+            self._slot_d = None
+            slot_d.callback(None)
+
+    def _consume_in_flight(self, message):
+        entry = [message.delivery_tag, False]
+        self._delivered.append(entry)
+        self._in_flight += 1
+
+        def _processed(result):
+            if self._testing:
+                self.channel.message_processed()
+            if result is False:
+                log.msg('Received %s as a return value consume_message. '
+                        'Not acknowledging AMQ message' % result)
+            entry[1] = True
+            self._in_flight -= 1
+            self._ack_processed()
+            self._release_slot()
+
+        d = maybeDeferred(self.message_class.from_json, message.content.body)
+        d.addCallback(self.consume_message)
+        d.addErrback(lambda f: log.err(f, "Error consuming message"))
+        d.addCallback(_processed)
+        return d
+
+    def _ack_processed(self, force=False):
+        """
+        Acknowledge the longest run of processed messages at the front of the
+        delivery queue if it is big enough or nothing else is in flight.
+        """
+        processed = 0
+        for _delivery_tag, done in self._delivered:
+            if not done:
+                break
+            processed += 1
+        if processed == 0:
+            return
+        if not (force or self._in_flight == 0 or
+                processed >= self.ack_batch_size):
+            return
+        for _ in range(processed):
+            delivery_tag, _done = self._delivered.popleft()
+        self.channel.basic_ack(delivery_tag, True)
+
     def pause(self):
         self.paused = True
         return self.channel.channel_flow(active=False)
@@ -341,6 +453,8 @@ class Consumer(object):
     def stop(self):
         log.msg("Consumer stopping...")
         self.keep_consuming = False
+        if self._delivered:
+            self._ack_processed(force=True)
         # This actually closes the channel on the server
         yield self.channel.channel_close()
         # This just marks the channel as closed on the client
@@ -374,6 +488,16 @@ class Publisher(object):
     auto_delete = False
     delivery_mode = 2  # save to disk
 
+    # Flow control. If `max_outstanding` publishes are waiting to complete or
+    # the AMQP connection isn't keeping up with what we're writing, the
+    # publisher becomes blocked and its flow listeners are told to stop
+    # sending it messages until it catches up. `None` means no limit.
+    max_outstanding = None
+    outstanding = 0
+    blocked = False
+    _connection_blocked = False
+    _flow_listeners = ()
+
     def start(self, channel):
         log.msg("Started the publisher")
         self.channel = channel
@@ -462,15 +586,89 @@ class Publisher(object):
         d.addCallback(lambda r: message)
         return d
 
+    def publish_message_batch(self, messages, **kwargs):
+        """
+        Publish a list of messages to the same routing key, checking the
+        routing key only once.
+        """
+        d = self.publish_raw_batch(
+            [message.to_json() for message in messages], **kwargs)
+        d.addCallback(lambda r: messages)
+        return d
+
     def publish_json(self, data, **kw):
         """helper method"""
         return self.publish_raw(json.dumps(data, cls=json.JSONEncoder), **kw)
 
-    def publish_raw(self, data, **kwargs):
+    def _mk_content(self, data, delivery_mode):
         amq_message = Content(data)
-        amq_message['delivery mode'] = kwargs.pop('delivery_mode',
-                self.delivery_mode)
-        return self.publish(amq_message, **kwargs)
+        amq_message['delivery mode'] = delivery_mode
+        return amq_message
+
+    def publish_raw(self, data, **kwargs):
+        amq_message = self._mk_content(
+            data, kwargs.pop('delivery_mode', self.delivery_mode))
+        return self._track_outstanding(self.publish(amq_message, **kwargs))
+
+    def publish_raw_batch(self, data_list, **kwargs):
+        amq_messages = [
+            self._mk_content(
+                data, kwargs.get('delivery_mode', self.delivery_mode))
+            for data in data_list]
+        return self._track_outstanding(
+            self._publish_batch(amq_messages, **kwargs), len(amq_messages))
+
+    @inlineCallbacks
+    def _publish_batch(self, messages, **kwargs):
+        exchange_name = kwargs.get('exchange_name') or self.exchange_name
+        routing_key = kwargs.get('routing_key') or self.routing_key
+        require_bind = kwargs.get('require_bind', self.require_bind)
+        yield self.check_routing_key(routing_key, require_bind)
+        for message in messages:
+            yield self.channel.basic_publish(exchange=exchange_name,
+                                             content=message,
+                                             routing_key=routing_key)
+
+    def add_flow_listener(self, listener):
+        """
+        Call ``listener(blocked)`` whenever this publisher becomes blocked or
+        unblocked.
+        """
+        self._flow_listeners = list(self._flow_listeners) + [listener]
+
+    def set_connection_blocked(self, blocked):
+        """
+        Called by the AMQP client when the connection's write buffer fills up
+        or drains.
+        """
+        self._connection_blocked = blocked
+        self._check_flow()
+
+    def _check_flow(self):
+        if self._connection_blocked:
+            blocked = True
+        elif self.max_outstanding is None:
+            blocked = False
+        elif self.blocked:
+            # Wait for things to drain a bit before unblocking so that we
+            # don't flap between states.
+            blocked = self.outstanding > self.max_outstanding // 2
+        else:
+            blocked = self.outstanding >= self.max_outstanding
+        if blocked != self.blocked:
+            self.blocked = blocked
+            for listener in self._flow_listeners:
+                listener(blocked)
+
+    def _track_outstanding(self, d, count=1):
+        self.outstanding += count
+        self._check_flow()
+
+        def _published(r):
+            self.outstanding -= count
+            self._check_flow()
+            return r
+        return d.addBoth(_published)
 
 
 class WorkerCreator(object):
@@ -25,14 +25,19 @@ class BaseConnectorTestCase(VumiWorkerTestCase):
 
     @inlineCallbacks
     def mk_connector(self, worker=None, connector_name=None,
-                     prefetch_count=None, middlewares=None, setup=False):
+                     prefetch_count=None, middlewares=None, setup=False,
+                     concurrency=None, ack_batch_size=None,
+                     max_outstanding=None):
         if worker is None:
             worker = yield self.get_worker({}, DummyWorker)
         if connector_name is None:
             connector_name = "dummy_connector"
         connector = self.connector_class(worker, connector_name,
                                          prefetch_count=prefetch_count,
-                                         middlewares=middlewares)
+                                         middlewares=middlewares,
+                                         concurrency=concurrency,
+                                         ack_batch_size=ack_batch_size,
+                                         max_outstanding=max_outstanding)
         if setup:
             yield connector.setup()
         returnValue(connector)
@@ -93,6 +98,28 @@ class TestBaseConnector(BaseConnectorTestCase):
         conn, consumer = yield self.mk_consumer(prefetch_count=10)
         self.assertEqual(consumer.channel.qos_prefetch_count, 10)
 
+    @inlineCallbacks
+    def test_default_concurrency(self):
+        conn, consumer = yield self.mk_consumer(prefetch_count=10)
+        self.assertEqual(consumer.max_in_flight, 1)
+        self.assertEqual(consumer.ack_batch_size, 1)
+        self.assertFalse(consumer.is_batching())
+
+    @inlineCallbacks
+    def test_concurrency(self):
+        conn, consumer = yield self.mk_consumer(
+            prefetch_count=10, concurrency=5, ack_batch_size=3)
+        self.assertEqual(consumer.max_in_flight, 5)
+        self.assertEqual(consumer.ack_batch_size, 3)
+        self.assertTrue(consumer.is_batching())
+
+    @inlineCallbacks
+    def test_concurrency_limited_by_prefetch_count(self):
+        conn, consumer = yield self.mk_consumer(
+            prefetch_count=10, concurrency=50, ack_batch_size=30)
+        self.assertEqual(consumer.max_in_flight, 10)
+        self.assertEqual(consumer.ack_batch_size, 10)
+
     @inlineCallbacks
     def test_setup_raises(self):
         conn = yield self.mk_connector()
@@ -182,6 +209,62 @@ class TestBaseConnector(BaseConnectorTestCase):
         msgs = yield self.get_dispatched_outbound(connector_name='foo')
         self.assertEqual(msgs, [msg])
 
+    @inlineCallbacks
+    def test_publish_messages_with_endpoint(self):
+        conn = yield self.mk_connector(connector_name='foo')
+        yield conn._setup_publisher('outbound')
+        msg1 = self.mkmsg_out(content='one')
+        msg2 = self.mkmsg_out(content='two')
+        yield conn._publish_messages('outbound', [msg1, msg2],
+                                     'dummy_endpoint')
+        msgs = yield self.get_dispatched_outbound(connector_name='foo')
+        self.assertEqual(msgs, [msg1, msg2])
+        self.assertEqual(
+            [m['routing_metadata']['endpoint_name'] for m in msgs],
+            ['dummy_endpoint', 'dummy_endpoint'])
+
+    @inlineCallbacks
+    def test_middlewares_publish_messages(self):
+        worker = yield self.get_worker({}, DummyWorker)
+        middlewares = [RecordingMiddleware(str(i), {}, worker)
+                       for i in range(3)]
+        conn = yield self.mk_connector(
+            worker=worker, connector_name='foo', middlewares=middlewares)
+        yield conn._setup_publisher('outbound')
+        yield conn._publish_messages(
+            'outbound', [self.mkmsg_out(), self.mkmsg_out()], None)
+        msgs = yield self.get_dispatched_outbound(connector_name='foo')
+        self.assertEqual(len(msgs), 2)
+        for msg in msgs:
+            self.assertEqual(msg.payload.pop('record'),
+                             [[str(i), 'outbound', 'foo']
+                              for i in range(2, -1, -1)])
+
+    @inlineCallbacks
+    def test_publisher_max_outstanding(self):
+        conn = yield self.mk_connector(max_outstanding=5)
+        publisher = yield conn._setup_publisher('outbound')
+        self.assertEqual(publisher.max_outstanding, 5)
+
+    @inlineCallbacks
+    def test_publisher_flow_control(self):
+        conn, consumer = yield self.mk_consumer()
+        publisher = yield conn._setup_publisher('outbound')
+        consumer.unpause()
+        publisher.set_connection_blocked(True)
+        self.assertTrue(consumer.paused)
+        publisher.set_connection_blocked(False)
+        self.assertFalse(consumer.paused)
+
+    @inlineCallbacks
+    def test_publisher_flow_control_already_paused(self):
+        conn, consumer = yield self.mk_consumer()
+        publisher = yield conn._setup_publisher('outbound')
+        consumer.pause()
+        publisher.set_connection_blocked(True)
+        publisher.set_connection_blocked(False)
+        self.assertTrue(consumer.paused)
+
 
 class TestReceiveInboundConnector(BaseConnectorTestCase):
 
@@ -274,6 +357,14 @@ class TestReceiveInboundConnector(BaseConnectorTestCase):
         msgs = yield self.get_dispatched_outbound(connector_name='foo')
         self.assertEqual(msgs, [msg])
 
+    @inlineCallbacks
+    def test_publish_outbound_batch(self):
+        conn = yield self.mk_connector(connector_name='foo', setup=True)
+        batch = [self.mkmsg_out(content='one'), self.mkmsg_out(content='two')]
+        yield conn.publish_outbound_batch(batch)
+        msgs = yield self.get_dispatched_outbound(connector_name='foo')
+        self.assertEqual(msgs, batch)
+
 
 class TestReceiveOutboundConnector(BaseConnectorTestCase):
 
@@ -337,6 +428,14 @@ class TestReceiveOutboundConnector(BaseConnectorTestCase):
         msgs = yield self.get_dispatched_inbound(connector_name='foo')
         self.assertEqual(msgs, [msg])
 
+    @inlineCallbacks
+    def test_publish_inbound_batch(self):
+        conn = yield self.mk_connector(connector_name='foo', setup=True)
+        batch = [self.mkmsg_in(content='one'), self.mkmsg_in(content='two')]
+        yield conn.publish_inbound_batch(batch)
+        msgs = yield self.get_dispatched_inbound(connector_name='foo')
+        self.assertEqual(msgs, batch)
+
     @inlineCallbacks
     def test_publish_event(self):
         conn = yield self.mk_connector(connector_name='foo', setup=True)
@@ -1,8 +1,74 @@
+import json
+from datetime import datetime
+
 from twisted.trial.unittest import TestCase
 
 from vumi.tests.utils import RegexMatcher, UTCNearNow
 from vumi.message import (Message, TransportMessage, TransportEvent,
-                          TransportUserMessage)
+                          TransportUserMessage, JSONMessageEncoder,
+                          from_json, to_json, parse_vumi_date,
+                          set_json_backend)
+
+
+class JSONCodecTest(TestCase):
+
+    def test_parse_vumi_date(self):
+        self.assertEqual(datetime(2012, 1, 2, 3, 4, 5, 678),
+                         parse_vumi_date("2012-01-02 03:04:05.000678"))
+        self.assertEqual(datetime(2012, 1, 2, 3, 4, 5, 500000),
+                         parse_vumi_date("2012-01-02 03:04:05.5"))
+        self.assertEqual(None, parse_vumi_date("2012-01-02 03:04:05"))
+        self.assertEqual(None, parse_vumi_date("2012-13-02 03:04:05.000678"))
+        self.assertEqual(None, parse_vumi_date("hello"))
+        self.assertEqual(None, parse_vumi_date(12))
+        self.assertEqual(None, parse_vumi_date(None))
+
+    def test_to_json_wire_compatible(self):
+        obj = {
+            'timestamp': datetime(2012, 1, 2, 3, 4, 5, 678),
+            'nested': {'dt': datetime(2012, 1, 2), 'foo': [1, 'a']},
+        }
+        self.assertEqual(json.dumps(obj, cls=JSONMessageEncoder),
+                         to_json(obj))
+
+    def test_to_json_unserializable(self):
+        self.assertRaises(TypeError, to_json, {'foo': object()})
+
+    def test_from_json(self):
+        data = json.dumps({
+            'timestamp': "2012-01-02 03:04:05.000678",
+            'content': "2012-01-02",
+            'nested': {'dt': "2012-01-02 00:00:00.000000", 'num': 5},
+            'list': [{'dt': "2012-01-02 00:00:00.000000"}],
+        })
+        self.assertEqual({
+            'timestamp': datetime(2012, 1, 2, 3, 4, 5, 678),
+            'content': "2012-01-02",
+            'nested': {'dt': datetime(2012, 1, 2), 'num': 5},
+            'list': [{'dt': datetime(2012, 1, 2)}],
+        }, from_json(data))
+
+    def test_set_json_backend(self):
+        calls = []
+
+        class RecordingBackend(object):
+            def loads(self, *args, **kw):
+                calls.append('loads')
+                return json.loads(*args, **kw)
+
+            def dumps(self, *args, **kw):
+                calls.append('dumps')
+                return json.dumps(*args, **kw)
+
+        old_backend = set_json_backend(RecordingBackend())
+        self.addCleanup(set_json_backend, old_backend)
+        msg = TransportUserMessage(
+            to_addr='+27831234567', from_addr='12345',
+            transport_name='sphex', transport_type='sms')
+        self.assertEqual(msg, TransportUserMessage.from_json(msg.to_json()))
+        self.assertEqual(['dumps', 'loads'], calls)
+        self.assertEqual(RecordingBackend, type(set_json_backend(None)))
+        self.assertEqual(json, set_json_backend(old_backend))
 
 
 class MessageTest(TestCase):
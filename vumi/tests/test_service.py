@@ -1,5 +1,7 @@
 from twisted.trial.unittest import TestCase
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, Deferred, succeed
+from twisted.internet import reactor
+from twisted.internet.task import deferLater
 
 from vumi.service import Worker, WorkerCreator
 from vumi.tests.utils import (fake_amq_message, get_stubbed_worker)
@@ -47,6 +49,186 @@ class ServiceTestCase(TestCase):
         self.assertEquals(published_msg.properties, {'delivery mode': 2})
 
 
+class PublisherTestCase(TestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.worker = get_stubbed_worker(Worker)
+        self.broker = self.worker._amqp_client.broker
+        self.publisher = yield self.worker.publish_to('test.routing.key')
+        self.flow_changes = []
+        self.publisher.add_flow_listener(self.flow_changes.append)
+
+    def get_dispatched(self):
+        return [msg.body for msg in self.broker.get_dispatched(
+            'vumi', 'test.routing.key')]
+
+    @inlineCallbacks
+    def test_publish_message_batch(self):
+        msgs = [Message(key="value1"), Message(key="value2")]
+        result = yield self.publisher.publish_message_batch(msgs)
+        self.assertEqual(result, msgs)
+        self.assertEqual(self.get_dispatched(),
+                         ['{"key": "value1"}', '{"key": "value2"}'])
+        self.assertEqual(self.publisher.outstanding, 0)
+
+    @inlineCallbacks
+    def test_publish_raw_batch_checks_routing_key_once(self):
+        checks = []
+
+        def check_routing_key(routing_key, require_bind):
+            checks.append(routing_key)
+            return succeed(None)
+
+        self.publisher.check_routing_key = check_routing_key
+        yield self.publisher.publish_raw_batch(['a', 'b', 'c'])
+        self.assertEqual(checks, ['test.routing.key'])
+        self.assertEqual(self.get_dispatched(), ['a', 'b', 'c'])
+
+    @inlineCallbacks
+    def test_max_outstanding(self):
+        pending = []
+
+        def check_routing_key(routing_key, require_bind):
+            d = Deferred()
+            pending.append(d)
+            return d
+
+        self.publisher.check_routing_key = check_routing_key
+        self.publisher.max_outstanding = 4
+        self.publisher.publish_raw('a')
+        self.publisher.publish_raw_batch(['b', 'c'])
+        self.assertFalse(self.publisher.blocked)
+        self.publisher.publish_raw('d')
+        self.assertTrue(self.publisher.blocked)
+        self.assertEqual(self.flow_changes, [True])
+        self.assertEqual(self.publisher.outstanding, 4)
+        # We stay blocked until we're down to half the limit.
+        yield pending.pop(0).callback(None)
+        self.assertTrue(self.publisher.blocked)
+        yield pending.pop(0).callback(None)
+        self.assertFalse(self.publisher.blocked)
+        self.assertEqual(self.flow_changes, [True, False])
+        self.assertEqual(self.get_dispatched(), ['a', 'b', 'c'])
+
+    def test_connection_blocked(self):
+        self.worker._amqp_client.pauseProducing()
+        self.assertTrue(self.publisher.blocked)
+        self.worker._amqp_client.resumeProducing()
+        self.assertFalse(self.publisher.blocked)
+        self.assertEqual(self.flow_changes, [True, False])
+
+    @inlineCallbacks
+    def test_new_publisher_on_blocked_connection(self):
+        self.worker._amqp_client.pauseProducing()
+        publisher = yield self.worker.publish_to('test.other.key')
+        self.assertTrue(publisher.blocked)
+
+
+class ConcurrentConsumerTestCase(TestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.worker = get_stubbed_worker(Worker)
+        self.broker = self.worker._amqp_client.broker
+        self.pending = []
+        self.consumer = yield self.worker.consume(
+            'test.routing.key', self.handle_message)
+
+    def handle_message(self, msg):
+        d = Deferred()
+        self.pending.append((msg['n'], d))
+        return d
+
+    def publish(self, *numbers):
+        for n in numbers:
+            self.broker.publish_message(
+                'vumi', 'test.routing.key', Message(n=n))
+        return self.wait()
+
+    def wait(self):
+        return deferLater(reactor, 0, lambda: None)
+
+    def unacked(self):
+        return len(self.consumer.channel.unacked)
+
+    def finish(self, n, result=None):
+        [d] = [d for m, d in self.pending if m == n]
+        self.pending.remove((n, d))
+        d.callback(result)
+
+    @inlineCallbacks
+    def test_sequential_by_default(self):
+        yield self.publish(1, 2, 3)
+        self.assertEqual([1], [n for n, _ in self.pending])
+        self.finish(1)
+        yield self.wait()
+        self.assertEqual([2], [n for n, _ in self.pending])
+        self.assertEqual(2, self.unacked())
+
+    @inlineCallbacks
+    def test_max_in_flight(self):
+        self.consumer.set_concurrency(2)
+        yield self.publish(1, 2, 3)
+        self.assertEqual([1, 2], [n for n, _ in self.pending])
+        self.finish(2)
+        yield self.wait()
+        self.assertEqual([1, 3], [n for n, _ in self.pending])
+        # Message 2 can't be acked before message 1.
+        self.assertEqual(3, self.unacked())
+        self.finish(1)
+        self.assertEqual(1, self.unacked())
+        self.finish(3)
+        self.assertEqual(0, self.unacked())
+
+    @inlineCallbacks
+    def test_set_concurrency_releases_waiting_reader(self):
+        self.consumer.set_concurrency(1, ack_batch_size=2)
+        yield self.publish(1, 2, 3)
+        self.assertEqual([1], [n for n, _ in self.pending])
+        self.consumer.set_concurrency(3, ack_batch_size=2)
+        yield self.wait()
+        self.assertEqual([1, 2, 3], [n for n, _ in self.pending])
+
+    @inlineCallbacks
+    def test_ack_batch_size(self):
+        self.consumer.set_concurrency(4, ack_batch_size=2)
+        yield self.publish(1, 2, 3, 4)
+        self.finish(1)
+        self.assertEqual(4, self.unacked())
+        self.finish(2)
+        self.assertEqual(2, self.unacked())
+        self.finish(3)
+        self.assertEqual(2, self.unacked())
+        # Nothing else is in flight, so we ack immediately.
+        self.finish(4)
+        self.assertEqual(0, self.unacked())
+
+    @inlineCallbacks
+    def test_failed_message_does_not_stop_consumer(self):
+        self.consumer.set_concurrency(2)
+        yield self.publish(1, 2)
+        self.finish(1, False)
+        [(_, d)] = [p for p in self.pending if p[0] == 2]
+        self.pending.remove((2, d))
+        d.errback(ValueError("bad message"))
+        self.assertEqual(1, len(self.flushLoggedErrors(ValueError)))
+        yield self.publish(3)
+        self.assertEqual([3], [n for n, _d in self.pending])
+        self.finish(3)
+        self.assertEqual(0, self.unacked())
+
+    @inlineCallbacks
+    def test_stop_acks_processed_messages(self):
+        self.consumer.set_concurrency(3, ack_batch_size=3)
+        yield self.publish(1, 2, 3)
+        self.finish(1)
+        self.finish(2)
+        self.assertEqual(3, self.unacked())
+        yield self.consumer.stop()
+        self.assertEqual(1, self.unacked())
+
+
 class LoadableTestWorker(Worker):
     def poke(self):
         return "poke"
@@ -11,7 +11,7 @@ from twisted.internet.protocol import Protocol, Factory
 
 from vumi.utils import (normalize_msisdn, vumi_resource_path, cleanup_msisdn,
                         get_operator_name, http_request, http_request_full,
-                        get_first_word, redis_from_config)
+                        get_first_word, redis_from_config, LRUCache)
 from vumi.persist.fake_redis import FakeRedis
 from vumi.tests.utils import import_skip
 
@@ -75,6 +75,53 @@ class UtilsTestCase(TestCase):
             import_skip(e, 'redis')
 
 
+class LRUCacheTestCase(TestCase):
+
+    def test_eviction(self):
+        cache = LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache['c'] = 3
+        self.assertEqual(2, len(cache))
+        self.assertFalse('a' in cache)
+        self.assertEqual(2, cache.get('b'))
+        self.assertEqual(3, cache.get('c'))
+
+    def test_get_refreshes(self):
+        cache = LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(1, cache.get('a'))
+        cache['c'] = 3
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+
+    def test_set_refreshes(self):
+        cache = LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache['a'] = 4
+        cache['c'] = 3
+        self.assertEqual(4, cache.get('a'))
+        self.assertFalse('b' in cache)
+
+    def test_get_default(self):
+        cache = LRUCache(2)
+        self.assertEqual(None, cache.get('a'))
+        self.assertEqual('x', cache.get('a', 'x'))
+
+    def test_pop_and_clear(self):
+        cache = LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(1, cache.pop('a'))
+        self.assertEqual(None, cache.pop('a'))
+        cache.clear()
+        self.assertEqual(0, len(cache))
+        cache['c'] = 3
+        self.assertEqual(3, cache.get('c'))
+
+
 class FakeHTTP10(Protocol):
     def dataReceived(self, data):
         self.transport.write(self.factory.response_body)
@@ -50,6 +50,23 @@ class TestBaseConfig(TestCase):
         config = BaseConfig({'amqp_prefetch_count': 10})
         self.assertEqual(config.amqp_prefetch_count, 10)
 
+    def test_no_amqp_consumer_concurrency(self):
+        config = BaseConfig({})
+        self.assertEqual(config.amqp_consumer_concurrency, 1)
+        self.assertEqual(config.amqp_ack_batch_size, 1)
+
+    def test_amqp_consumer_concurrency(self):
+        config = BaseConfig({'amqp_consumer_concurrency': 10,
+                             'amqp_ack_batch_size': 5})
+        self.assertEqual(config.amqp_consumer_concurrency, 10)
+        self.assertEqual(config.amqp_ack_batch_size, 5)
+
+    def test_amqp_max_outstanding_publishes(self):
+        self.assertEqual(
+            BaseConfig({}).amqp_max_outstanding_publishes, None)
+        config = BaseConfig({'amqp_max_outstanding_publishes': 100})
+        self.assertEqual(config.amqp_max_outstanding_publishes, 100)
+
 
 class TestBaseWorker(VumiWorkerTestCase):
 
@@ -142,14 +159,18 @@ class TestBaseWorker(VumiWorkerTestCase):
 
     def test_get_static_config(self):
         cfg = self.worker.get_static_config()
-        self.assertEqual([f.name for f in cfg.fields], ['amqp_prefetch_count'])
+        self.assertEqual([f.name for f in cfg.fields], [
+            'amqp_prefetch_count', 'amqp_consumer_concurrency',
+            'amqp_ack_batch_size', 'amqp_max_outstanding_publishes'])
         self.assertEqual(cfg.amqp_prefetch_count, 20)
 
     @inlineCallbacks
     def test_get_config(self):
         msg = self.mkmsg_in()
         cfg = yield self.worker.get_config(msg)
-        self.assertEqual([f.name for f in cfg.fields], ['amqp_prefetch_count'])
+        self.assertEqual([f.name for f in cfg.fields], [
+            'amqp_prefetch_count', 'amqp_consumer_concurrency',
+            'amqp_ack_batch_size', 'amqp_max_outstanding_publishes'])
         self.assertEqual(cfg.amqp_prefetch_count, 20)
 
     def test__validate_config(self):
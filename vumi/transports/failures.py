@@ -1,13 +1,18 @@
 # -*- test-case-name: vumi.transports.tests.test_failures -*-
 
 import time
+import gzip
+import calendar
+import json
 from datetime import datetime
 from uuid import uuid4
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import inlineCallbacks, returnValue, DeferredList
 from twisted.internet.task import LoopingCall
 
+from vumi import log
 from vumi.service import Worker
+from vumi.components.delay_queue import DelayQueue
 from vumi.message import TransportMessage, to_json
 from vumi.persist.txredis_manager import TxRedisManager
 
@@ -57,46 +62,117 @@ class FailureWorker(Worker):
     Base class for transport failure handlers.
 
     Subclasses should implement :meth:`handle_failure`.
+
+    Retries are kept in a :class:`DelayQueue` and are published at least
+    once. A retry that isn't published within `retry_visibility_timeout`
+    seconds of being claimed is published again.
+
+    Failures are kept forever unless `failure_retention` is set. Then
+    permanent failures and delivered retries expire after that many
+    seconds. Every `failure_compaction_period` seconds, failures older
+    than that are removed from the index of failure keys. If
+    `failure_archive_path` is set, they are first appended to that file
+    as gzipped JSON lines. Archived failures don't expire, so compaction
+    removes them instead. The retention period should be well over
+    `retry_max_delay`, so that failures waiting to be retried are kept.
+
+    A count of failures is kept for each reason regardless of retention.
+
+    Retries stored in time buckets by older versions of this worker are
+    moved into the retry queue when the worker starts.
     """
 
-    GRANULARITY = 5  # seconds
     DELIVERY_PERIOD = 3
+    VISIBILITY_TIMEOUT = 60
 
     MAX_DELAY = 3600
     INITIAL_DELAY = 1
     DELAY_FACTOR = 3
 
+    RETENTION = None
+    COMPACTION_PERIOD = 3600
+    ARCHIVE_PATH = None
+
+    FAILURE_INDEX_KEY = "failure_index"
+    FAILURE_COUNTS_KEY = "failure_counts"
+    FAILURE_KEYS_PAGE_SIZE = 100
+    COMPACTION_BATCH_SIZE = 1000
+
+    OLD_RETRY_TIMESTAMPS_KEY = "retry_timestamps"
+    OLD_RETRY_BUCKET_PREFIX = "retry_keys."
+
     @inlineCallbacks
     def startWorker(self):
         self.configure_retries()
+        self.configure_retention()
         yield self.set_up_redis()
+        yield self.migrate_old_retries()
         retry_rkey = self.get_rkey('retry')
         failures_rkey = self.get_rkey('failures')
         self.retry_publisher = yield self.publish_to(retry_rkey)
         self.consumer = yield self.consume(failures_rkey, self.process_message,
                                            message_class=FailureMessage)
         self.start_retry_delivery()
+        self.start_compaction()
 
     @inlineCallbacks
     def stopWorker(self):
         if self.delivery_loop and self.delivery_loop.running:
             self.delivery_loop.stop()
             yield self.delivery_done
+        if self.compaction_loop and self.compaction_loop.running:
+            self.compaction_loop.stop()
+            yield self.compaction_done
         yield self.consumer.stop()
         yield self.redis.close_manager()
 
     def configure_retries(self):
-        for param in ['GRANULARITY', 'MAX_DELAY', 'INITIAL_DELAY',
-                      'DELAY_FACTOR', 'DELIVERY_PERIOD']:
+        for param in ['MAX_DELAY', 'INITIAL_DELAY', 'DELAY_FACTOR',
+                      'DELIVERY_PERIOD', 'VISIBILITY_TIMEOUT']:
             setattr(self, param, self.config.get('retry_' + param.lower(),
                                                  getattr(self, param)))
 
+    def configure_retention(self):
+        for param in ['RETENTION', 'COMPACTION_PERIOD', 'ARCHIVE_PATH']:
+            setattr(self, param, self.config.get('failure_' + param.lower(),
+                                                 getattr(self, param)))
+
     @inlineCallbacks
     def set_up_redis(self):
         r_config = self.config.get('redis_manager', {})
         redis = yield TxRedisManager.from_config(r_config)
         self.redis = redis.sub_manager("failures:%s" % (
                 self.config['transport_name'],))
+        self.retry_queue = DelayQueue(
+            self.redis.sub_manager("retries"),
+            visibility_timeout=self.VISIBILITY_TIMEOUT)
+
+    @inlineCallbacks
+    def migrate_old_retries(self):
+        """
+        Move retries from the time buckets used by older versions of this
+        worker into the retry queue. Each retry stays due at the time of
+        its bucket.
+
+        Returns the number of retries moved.
+        """
+        timestamps = yield self.redis.zrange(
+            self.OLD_RETRY_TIMESTAMPS_KEY, 0, -1)
+        migrated = 0
+        for timestamp in timestamps:
+            bucket_key = self.OLD_RETRY_BUCKET_PREFIX + timestamp
+            due = calendar.timegm(
+                time.strptime(timestamp, "%Y-%m-%dT%H:%M:%S"))
+            failure_keys = yield self.redis.smembers(bucket_key)
+            for failure_key in failure_keys:
+                yield self.store_retry(failure_key, 0, now=due)
+            yield self.redis.delete(bucket_key)
+            yield self.redis.zrem(self.OLD_RETRY_TIMESTAMPS_KEY, timestamp)
+            migrated += len(failure_keys)
+        yield self.redis.delete(self.OLD_RETRY_TIMESTAMPS_KEY)
+        if migrated:
+            log.msg("Moved %d retries into the retry queue." % (migrated,))
+        returnValue(migrated)
 
     def start_retry_delivery(self):
         self.delivery_loop = None
@@ -104,6 +180,13 @@ class FailureWorker(Worker):
             self.delivery_loop = LoopingCall(self.deliver_retries)
             self.delivery_done = self.delivery_loop.start(self.DELIVERY_PERIOD)
 
+    def start_compaction(self):
+        self.compaction_loop = None
+        if self.RETENTION and self.COMPACTION_PERIOD:
+            self.compaction_loop = LoopingCall(self.compact_failures)
+            self.compaction_done = self.compaction_loop.start(
+                self.COMPACTION_PERIOD)
+
     def get_rkey(self, route_name):
         return self.config['%s_routing_key' % route_name] % self.config
 
@@ -116,11 +199,51 @@ class FailureWorker(Worker):
         timestamp = timestamp.isoformat().split('.')[0]
         return ".".join(("failure", timestamp, failure_id))
 
-    def add_to_failure_set(self, key):
-        return self.redis.sadd("failure_keys", key)
+    def get_time(self):
+        return time.time()
+
+    @inlineCallbacks
+    def get_failure_keys(self, cursor=None, limit=None):
+        """
+        Return a page of failure keys, oldest first.
+
+        :param str cursor:
+            The cursor returned with the previous page, or `None` for the
+            first page.
+        :param int limit:
+            The most keys to return. Defaults to FAILURE_KEYS_PAGE_SIZE.
 
-    def get_failure_keys(self):
-        return self.redis.smembers("failure_keys")
+        Returns a `(next_cursor, keys)` tuple. `next_cursor` is `None` once
+        there are no more keys.
+        """
+        limit = limit or self.FAILURE_KEYS_PAGE_SIZE
+        min_score, offset = '-inf', 0
+        if cursor is not None:
+            min_score, offset = cursor.split(':')
+        keys_and_scores = yield self.redis.zrangebyscore(
+            self.FAILURE_INDEX_KEY, min_score, '+inf', int(offset), limit,
+            withscores=True)
+        keys = [key for key, _score in keys_and_scores]
+        if len(keys) < limit:
+            returnValue((None, keys))
+
+        # Several keys can have the same score, so the cursor is the last
+        # score returned and how many keys with that score to skip.
+        last_score = keys_and_scores[-1][1]
+        skip = len([score for _key, score in keys_and_scores
+                    if score == last_score])
+        if cursor is not None and float(min_score) == last_score:
+            skip += int(offset)
+        returnValue(('%r:%d' % (last_score, skip), keys))
+
+    @inlineCallbacks
+    def get_failure_counts(self):
+        """
+        Return a dict of how many failures there have been for each reason.
+        """
+        counts = yield self.redis.hgetall(self.FAILURE_COUNTS_KEY)
+        returnValue(dict((reason, int(count))
+                         for reason, count in counts.iteritems()))
 
     @inlineCallbacks
     def store_failure(self, message, reason, retry_delay=None):
@@ -141,70 +264,134 @@ class FailureWorker(Worker):
         key = self.failure_key()
         if not retry_delay:
             retry_delay = 0
-        yield self.redis.hmset(key, {
+        pipe = self.redis.pipeline()
+        pipe.hmset(key, {
                 "message": message_json,
                 "reason": reason,
                 "retry_delay": str(retry_delay),
                 })
-        yield self.add_to_failure_set(key)
+        ttl = self.failure_ttl()
+        if ttl and not retry_delay:
+            pipe.expire(key, ttl)
+        pipe.zadd(self.FAILURE_INDEX_KEY, **{key: self.get_time()})
+        pipe.hincrby(self.FAILURE_COUNTS_KEY, reason, 1)
+        yield pipe.execute()
         if retry_delay:
             yield self.store_retry(key, retry_delay)
         returnValue(key)
 
+    def failure_ttl(self):
+        """
+        Return the number of seconds failures expire after, or `None` if
+        they don't expire.
+
+        Failures don't expire if they're archived. Compaction selects
+        failures once they're past the retention period, so they'd
+        already be gone by the time it archived them.
+        """
+        if self.ARCHIVE_PATH:
+            return None
+        return self.RETENTION
+
     def get_failure(self, failure_key):
         return self.redis.hgetall(failure_key)
 
-    @inlineCallbacks
     def store_retry(self, failure_key, retry_delay, now=None):
-        timestamp = self.get_next_write_timestamp(retry_delay, now=now)
-        bucket_key = "retry_keys." + timestamp
-        yield self.redis.sadd(bucket_key, failure_key)
-        yield self.store_read_timestamp(timestamp)
-
-    def store_read_timestamp(self, timestamp):
-        score = time.mktime(time.strptime(timestamp, "%Y-%m-%dT%H:%M:%S"))
-        return self.redis.zadd('retry_timestamps', **{timestamp: score})
-
-    def get_next_write_timestamp(self, delta, now=None):
-        if now is None:
-            now = int(time.time())
-        timestamp = now + delta
-        timestamp += self.GRANULARITY - (timestamp % self.GRANULARITY)
-        return datetime.utcfromtimestamp(timestamp).isoformat().split('.')[0]
+        return self.retry_queue.add(failure_key, retry_delay, now=now)
 
     @inlineCallbacks
-    def get_next_read_timestamp(self):
-        now = int(time.time())
-        timestamp = datetime.utcfromtimestamp(now).isoformat().split('.')[0]
-        next_timestamp = yield self.redis.zrange('retry_timestamps', 0, 0)
-        if next_timestamp and next_timestamp[0] <= timestamp:
-            returnValue(next_timestamp[0])
-        returnValue(None)
-
-    @inlineCallbacks
-    def get_next_retry_key(self):
-        timestamp = yield self.get_next_read_timestamp()
-        if not timestamp:
-            return
-        bucket_key = "retry_keys." + timestamp
-        failure_key = yield self.redis.spop(bucket_key)
-        if (yield self.redis.scard(bucket_key)) < 1:
-            yield self.redis.zrem('retry_timestamps', timestamp)
-        returnValue(failure_key)
+    def claim_retry_keys(self, now=None):
+        """
+        Claim the keys of failures that are due to be retried.
+        """
+        claimed = yield self.retry_queue.claim(now=now)
+        returnValue([failure_key for failure_key, _ in claimed])
 
     @inlineCallbacks
     def deliver_retry(self, retry_key, publisher):
         failure = yield self.get_failure(retry_key)
+        if not failure:
+            log.warning("Failure %r expired before it could be retried." % (
+                retry_key,))
+            return
         published = yield publisher.publish_raw(failure['message'])
         returnValue(published)
 
     @inlineCallbacks
     def deliver_retries(self):
+        """
+        Deliver the retries that are due, a batch at a time.
+
+        Retries that fail to publish aren't acked, so they're claimed again
+        once the visibility timeout has passed.
+        """
         while True:
-            retry_key = yield self.get_next_retry_key()
-            if not retry_key:
+            retry_keys = yield self.claim_retry_keys()
+            results = yield DeferredList([
+                self.deliver_retry(retry_key, self.retry_publisher)
+                for retry_key in retry_keys], consumeErrors=True)
+            delivered = []
+            for retry_key, (success, result) in zip(retry_keys, results):
+                if success:
+                    delivered.append(retry_key)
+                else:
+                    log.err(result, "Error retrying failure %r" % (
+                        retry_key,))
+            yield self.retry_queue.ack(delivered)
+            ttl = self.failure_ttl()
+            if ttl and delivered:
+                pipe = self.redis.pipeline()
+                for retry_key in delivered:
+                    pipe.expire(retry_key, ttl)
+                yield pipe.execute()
+            if len(retry_keys) < self.retry_queue.claim_limit:
                 return
-            yield self.deliver_retry(retry_key, self.retry_publisher)
+
+    @inlineCallbacks
+    def compact_failures(self, now=None):
+        """
+        Remove failures older than the retention period, archiving them
+        first if an archive path is configured.
+
+        Returns the number of failures removed.
+        """
+        if now is None:
+            now = self.get_time()
+        max_score = now - self.RETENTION
+        removed = 0
+        while True:
+            keys = yield self.redis.zrangebyscore(
+                self.FAILURE_INDEX_KEY, '-inf', max_score, 0,
+                self.COMPACTION_BATCH_SIZE)
+            if not keys:
+                break
+            if self.ARCHIVE_PATH:
+                pipe = self.redis.pipeline()
+                for key in keys:
+                    pipe.hgetall(key)
+                failures = yield pipe.execute()
+                self.archive_failures(zip(keys, failures))
+            pipe = self.redis.pipeline()
+            for key in keys:
+                pipe.delete(key)
+                pipe.zrem(self.FAILURE_INDEX_KEY, key)
+            yield pipe.execute()
+            removed += len(keys)
+        returnValue(removed)
+
+    def archive_failures(self, failures):
+        """
+        Append `(key, failure)` pairs to the archive file as gzipped JSON
+        lines. Failures that have already expired are skipped.
+        """
+        archive = gzip.open(self.ARCHIVE_PATH, 'ab')
+        try:
+            for key, failure in failures:
+                if failure:
+                    failure = dict(failure, key=key)
+                    archive.write(json.dumps(failure) + '\n')
+        finally:
+            archive.close()
 
     def next_retry_delay(self, delay):
         if not delay:
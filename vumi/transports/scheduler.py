@@ -1,16 +1,16 @@
 # -*- test-case-name: vumi.transports.tests.test_scheduler -*-
 import time
-import iso8601
-import pytz
 import json
+import calendar
 from datetime import datetime
 from uuid import uuid4
 import warnings
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.internet.task import LoopingCall
 
-from vumi import message
+from vumi import message, log
+from vumi.components.delay_queue import DelayQueue
 
 
 warnings.warn("vumi.transport.scheduler is deprecated. A replacement is coming"
@@ -21,20 +21,48 @@ class Scheduler(object):
     """
     Base class for stuff that needs to be published to a given queue
     at a given time.
+
+    Scheduled payloads are kept in a :class:`DelayQueue` and are delivered
+    at least once. All redis access is asynchronous, so methods that touch
+    redis return Deferreds.
+
+    Payloads stored in time buckets by older versions of this class are
+    moved into the queue the first time due payloads are delivered.
+
+    :param TxRedisManager redis:
+        Redis manager object. Keys are written under a sub-manager named
+        after `prefix`.
+    :param callback:
+        Called with the time a payload was scheduled at and the payload
+        once it's due.
+    :param int granularity:
+        Deprecated and ignored.
+    :param int delivery_period:
+        Seconds between checks for due payloads.
     """
 
     def __init__(self, redis, callback, prefix='scheduler',
-                    granularity=5, delivery_period=3, json_encoder=None,
+                    granularity=None, delivery_period=3, json_encoder=None,
                     json_decoder=None):
         self.r_server = redis
         self.r_prefix = prefix
-        self.granularity = granularity
         self.delivery_period = delivery_period
-        self._scheduled_timestamps_key = self.r_key("scheduled_timestamps")
+        self.queue = DelayQueue(redis.sub_manager(prefix))
         self.callback = callback
         self.json_encoder = json_encoder or message.JSONMessageEncoder
         self.json_decoder = json_decoder or message.date_time_decoder
         self.loop = LoopingCall(self.deliver_scheduled)
+        self._old_scheduled_migrated = False
+        if granularity is not None:
+            log.warning("Scheduler 'granularity' parameter is deprecated.")
+
+    @classmethod
+    def from_redis_config(cls, config, callback, **kw):
+        """Create a `Scheduler` instance using `TxRedisManager`.
+        """
+        from vumi.persist.txredis_manager import TxRedisManager
+        d = TxRedisManager.from_config(config)
+        return d.addCallback(lambda m: cls(m, callback, **kw))
 
     @property
     def is_running(self):
@@ -48,12 +76,50 @@ class Scheduler(object):
         if self.loop.running:
             self.loop.stop()
 
-    def r_key(self, key):
+    def old_r_key(self, key):
         """
-        Prefix ``key`` with a worker-specific string.
+        Return the key used for `key` by older versions of this class.
         """
         return "#".join((self.r_prefix, key))
 
+    @inlineCallbacks
+    def migrate_old_scheduled(self):
+        """
+        Move payloads from the time buckets used by older versions of this
+        class into the queue. Each payload stays due at the time of its
+        bucket and keeps its scheduled key, less the old prefix.
+
+        Returns the number of payloads moved.
+        """
+        timestamps_key = self.old_r_key("scheduled_timestamps")
+        timestamps = yield self.r_server.zrange(timestamps_key, 0, -1)
+        old_prefix = self.old_r_key("")
+        migrated = 0
+        for timestamp in timestamps:
+            bucket_key = self.old_r_key("scheduled_keys." + timestamp)
+            due = calendar.timegm(
+                time.strptime(timestamp, "%Y-%m-%dT%H:%M:%S"))
+            old_keys = yield self.r_server.smembers(bucket_key)
+            for old_key in old_keys:
+                scheduled = yield self.r_server.hgetall(old_key)
+                if scheduled:
+                    scheduled_json = json.dumps({
+                        'payload': scheduled['payload'],
+                        'scheduled_at': scheduled['scheduled_at'],
+                    })
+                    yield self.queue.add(old_key[len(old_prefix):], 0,
+                                         scheduled_json, now=due)
+                    migrated += 1
+                yield self.r_server.delete(old_key)
+            yield self.r_server.delete(bucket_key)
+            yield self.r_server.zrem(timestamps_key, timestamp)
+        yield self.r_server.delete(timestamps_key)
+        yield self.r_server.delete(self.old_r_key("scheduled_keys"))
+        if migrated:
+            log.msg("Moved %d scheduled payloads into the queue." % (
+                migrated,))
+        returnValue(migrated)
+
     def scheduled_key(self):
         """
         Construct a unique scheduled key.
@@ -61,43 +127,16 @@ class Scheduler(object):
         timestamp = datetime.utcnow()
         unique_id = uuid4().get_hex()
         timestamp = timestamp.isoformat().split('.')[0]
-        return self.r_key(".".join(("scheduled", timestamp, unique_id)))
+        return ".".join(("scheduled", timestamp, unique_id))
 
+    @inlineCallbacks
     def get_scheduled(self, scheduled_key):
-        return self.r_server.hgetall(scheduled_key)
-
-    def get_next_write_timestamp(self, delta, now):
-        now = int(now)
-        return self.get_time_bucket(now + delta)
-
-    def get_time_bucket(self, timestamp):
-        timestamp += self.granularity - (timestamp % self.granularity)
-        return datetime.utcfromtimestamp(timestamp).isoformat().split('.')[0]
-
-    def get_read_timestamp(self, now):
-        now = int(now)
-        timestamp = datetime.utcfromtimestamp(now).replace(tzinfo=pytz.UTC)
-        next_timestamp = self.r_server.zrange(self._scheduled_timestamps_key,
-                                                0, 0)
-        if next_timestamp:
-            if iso8601.parse_date(next_timestamp[0]) <= timestamp:
-                return next_timestamp[0]
-        return None
-
-    def get_next_read_timestamp(self):
-        return self.get_read_timestamp(time.time())
-
-    def get_scheduled_key(self, time):
-        timestamp = self.get_time_bucket(time)
-        bucket_key = self.r_key("scheduled_keys." + timestamp)
-        # key of message to be delivered
-        scheduled_key = self.r_server.spop(bucket_key)
-        # if the set is empty, remove the timestamp entry from the
-        # scheduled timestamps key
-        if self.r_server.scard(bucket_key) < 1:
-            self.r_server.zrem(self._scheduled_timestamps_key, timestamp)
-        return scheduled_key
+        scheduled_json = yield self.queue.get_payload(scheduled_key)
+        if scheduled_json is None:
+            returnValue({})
+        returnValue(json.loads(scheduled_json))
 
+    @inlineCallbacks
     def schedule(self, delta, payload, now=None):
         """
         Store the payload in Redis and call `self.callback` after
@@ -110,58 +149,46 @@ class Scheduler(object):
                     seconds since epoch)
 
         If ``now`` is ``None`` then it will default to ``time.time()``
+
+        Returns the scheduled key.
         """
         # do this first as we want it to blow up before any keys
         # are set should the content not be JSON encodable
+        payload_json = json.dumps(payload, cls=self.json_encoder)
         if not now:
-            now = int(time.time())
+            now = time.time()
 
         key = self.scheduled_key()
-        self.add_to_scheduled_set(key)
-        bucket_key = self.store_scheduled(key, delta, now)
-        self.r_server.hmset(key, {
-            'payload': json.dumps(payload, cls=self.json_encoder),
+        yield self.queue.add(key, delta, json.dumps({
+            'payload': payload_json,
             'scheduled_at': datetime.utcnow().isoformat(),
-            'bucket_key': bucket_key,
-        })
-        return key, bucket_key
-
-    def add_to_scheduled_set(self, key):
-        self.r_server.sadd(self.r_key("scheduled_keys"), key)
-
-    def store_scheduled(self, scheduled_key, delta, now):
-        timestamp = self.get_next_write_timestamp(delta, now)
-        bucket_key = self.r_key("scheduled_keys." + timestamp)
-        self.r_server.sadd(bucket_key, scheduled_key)
-        self.store_read_timestamp(timestamp)
-        return bucket_key
-
-    def store_read_timestamp(self, timestamp):
-        score = time.mktime(time.strptime(timestamp, "%Y-%m-%dT%H:%M:%S"))
-        self.r_server.zadd(self._scheduled_timestamps_key, **{
-            timestamp: score
-        })
+        }), now=now)
+        returnValue(key)
 
+    @inlineCallbacks
     def get_all_scheduled_keys(self):
-        return self.r_server.smembers(self.r_key("scheduled_keys"))
+        keys = yield self.queue.get_item_ids()
+        returnValue(set(keys))
 
     @inlineCallbacks
     def deliver_scheduled(self, _time=None):
-        _time = _time or int(time.time())
+        """
+        Deliver everything that's due at `_time`, a batch at a time.
+        """
+        _time = _time or time.time()
+        if not self._old_scheduled_migrated:
+            yield self.migrate_old_scheduled()
+            self._old_scheduled_migrated = True
         while True:
-            scheduled_key = self.get_scheduled_key(_time - self.granularity)
-            if not scheduled_key:
+            scheduled = yield self.queue.claim(now=_time)
+            for scheduled_key, scheduled_json in scheduled:
+                scheduled_data = json.loads(scheduled_json)
+                payload = json.loads(scheduled_data['payload'],
+                                        object_hook=self.json_decoder)
+                yield self.callback(scheduled_data['scheduled_at'], payload)
+            yield self.queue.ack([key for key, _ in scheduled])
+            if len(scheduled) < self.queue.claim_limit:
                 return
-            scheduled_data = self.get_scheduled(scheduled_key)
-            scheduled_at = scheduled_data['scheduled_at']
-            payload = json.loads(scheduled_data['payload'],
-                                    object_hook=self.json_decoder)
-            yield self.callback(scheduled_at, payload)
-            self.clear_scheduled(scheduled_key)
 
     def clear_scheduled(self, key):
-        self.r_server.srem(self.r_key("scheduled_keys"), key)
-        message_data = self.get_scheduled(key)
-        bucket_key = message_data['bucket_key']
-        self.r_server.srem(bucket_key, key)
-        self.r_server.delete(key)
+        return self.queue.ack([key])
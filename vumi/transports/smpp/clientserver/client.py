@@ -2,11 +2,13 @@
 
 import json
 import uuid
+from collections import deque
 
 from twisted.internet import reactor
 from twisted.internet.protocol import Protocol, ReconnectingClientFactory
 from twisted.internet.task import LoopingCall
-from twisted.internet.defer import inlineCallbacks, returnValue, DeferredQueue
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, Deferred, succeed, maybeDeferred)
 
 import binascii
 from smpp.pdu import unpack_pdu
@@ -17,6 +19,9 @@ from smpp.pdu_inspector import (
     MultipartMessage, detect_multipart, multipart_key)
 
 from vumi import log
+from vumi.persist.redis_base import RedisScript
+from vumi.transports.smpp.clientserver.framing import (
+    PDUFramer, PDUFramingError)
 
 
 def unpacked_pdu_opts(unpacked_pdu):
@@ -40,11 +45,233 @@ def update_ussd_pdu(sm_pdu, continue_session, session_info=None):
     return sm_pdu
 
 
+def _fake_reserve_seq_block(fake_redis, keys, args):
+    [key], [block_size, max_seq] = keys, [int(arg) for arg in args]
+    last = fake_redis.incr.sync(fake_redis, key, block_size)
+    if last > max_seq:
+        fake_redis.set.sync(fake_redis, key, block_size)
+        last = block_size
+    return last
+
+
+RESERVE_SEQ_BLOCK = RedisScript("""
+local block_size = tonumber(ARGV[1])
+local last = redis.call('INCRBY', KEYS[1], block_size)
+if last > tonumber(ARGV[2]) then
+    redis.call('SET', KEYS[1], block_size)
+    last = block_size
+end
+return last
+""", _fake_reserve_seq_block)
+
+
+class SequenceNumberAllocator(object):
+    """Hands out SMPP sequence numbers from blocks reserved in redis.
+
+    Each reservation atomically claims the next `block_size` sequence numbers
+    from a shared counter (wrapping back to the start of the range when the
+    counter passes `MAX_SEQUENCE_NUMBER`) so that numbers can be handed out
+    locally without a redis round trip each. Requests made while a
+    reservation is in flight wait for it rather than making their own.
+
+    Sequence numbers are unique across all allocators sharing a counter until
+    the counter wraps, but are only increasing within a single allocator.
+    """
+
+    MAX_SEQUENCE_NUMBER = 0xFFFFFFFF
+
+    def __init__(self, redis, key='smpp_last_sequence_number',
+                 block_size=100):
+        self.redis = redis
+        self.key = key
+        self.block_size = block_size
+        self._next_seq = 1
+        self._last_seq = 0
+        self._waiting = None
+
+    def get_next_seq(self):
+        """Return a deferred that fires with the next sequence number.
+        """
+        if self._next_seq <= self._last_seq:
+            seq = self._next_seq
+            self._next_seq += 1
+            return succeed(seq)
+        d = Deferred()
+        if self._waiting is None:
+            self._waiting = deque([d])
+            self._reserve_block()
+        else:
+            self._waiting.append(d)
+        return d
+
+    def _reserve_block(self):
+        d = maybeDeferred(
+            self.redis.run_script, RESERVE_SEQ_BLOCK, [self.key],
+            [self.block_size, self.MAX_SEQUENCE_NUMBER])
+        d.addCallbacks(self._block_reserved, self._reservation_failed)
+
+    def _block_reserved(self, last_seq):
+        self._last_seq = int(last_seq)
+        self._next_seq = self._last_seq - self.block_size + 1
+        waiting = self._waiting
+        while waiting and self._next_seq <= self._last_seq:
+            seq = self._next_seq
+            self._next_seq += 1
+            waiting.popleft().callback(seq)
+        if waiting:
+            # Anything that doesn't fit in this block waits for the next one.
+            self._reserve_block()
+        else:
+            self._waiting = None
+
+    def _reservation_failed(self, failure):
+        waiting, self._waiting = self._waiting, None
+        for d in waiting:
+            d.errback(failure)
+
+
+class UnackedWindow(object):
+    """Tracks PDUs that have been sent but not yet responded to.
+
+    At most `max_size` PDUs may be outstanding at once, anything added
+    beyond that waits for a slot to become free. PDUs that have been
+    outstanding for longer than `timeout` seconds are removed by
+    :meth:`expire` so that lost responses don't hold slots forever.
+    """
+
+    def __init__(self, max_size, timeout, clock=reactor):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.clock = clock
+        self._pending = {}  # sequence number -> time added
+        self._waiting = deque()  # (sequence number, deferred)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __contains__(self, sequence_number):
+        return sequence_number in self._pending
+
+    def is_full(self):
+        return len(self._pending) >= self.max_size
+
+    def add(self, sequence_number):
+        """Add a sequence number to the window.
+
+        Returns a deferred that fires with the sequence number once it has
+        been added, which is immediately if the window isn't full.
+        """
+        if self.is_full():
+            self.expire()
+        if self._waiting or self.is_full():
+            d = Deferred()
+            self._waiting.append((sequence_number, d))
+            return d
+        self._pending[sequence_number] = self.clock.seconds()
+        return succeed(sequence_number)
+
+    def remove(self, sequence_number):
+        """Remove a sequence number from the window.
+
+        Returns `True` if the sequence number was outstanding, `False`
+        otherwise.
+        """
+        found = self._pending.pop(sequence_number, None) is not None
+        self._admit_waiting()
+        return found
+
+    def expire(self):
+        """Remove sequence numbers that have been outstanding for too long.
+
+        Returns a list of the expired sequence numbers.
+        """
+        cutoff = self.clock.seconds() - self.timeout
+        expired = sorted(seq for seq, added in self._pending.iteritems()
+                         if added <= cutoff)
+        for seq in expired:
+            del self._pending[seq]
+        self._admit_waiting()
+        return expired
+
+    def clear(self):
+        """Remove all outstanding sequence numbers."""
+        self._pending.clear()
+        self._admit_waiting()
+
+    def _admit_waiting(self):
+        while self._waiting and not self.is_full():
+            sequence_number, d = self._waiting.popleft()
+            self._pending[sequence_number] = self.clock.seconds()
+            d.callback(sequence_number)
+
+
+class PDUProcessor(object):
+    """Processes PDUs concurrently while keeping related PDUs in order.
+
+    Each PDU is queued with an ordering key. PDUs with the same key are
+    processed one at a time in the order they were queued, PDUs with
+    different keys may be processed concurrently, and PDUs with a key of
+    `None` are never held back by other PDUs. At most `max_concurrent` PDUs
+    are processed at once.
+
+    :param process:
+        Function called with each PDU. May return a deferred.
+    :param int max_concurrent:
+        The maximum number of PDUs to process at once.
+    """
+
+    def __init__(self, process, max_concurrent=1):
+        self.process = process
+        self.max_concurrent = max_concurrent
+        self._processing = 0
+        self._ready = deque()  # (key, pdu) that can start once there's room
+        self._blocked = {}  # key -> deque of PDUs waiting for the same key
+        self._depth = 0
+
+    def queue_depth(self):
+        """Number of PDUs queued but not yet being processed."""
+        return self._depth
+
+    def put(self, key, pdu):
+        self._depth += 1
+        if key is not None and key in self._blocked:
+            self._blocked[key].append(pdu)
+        else:
+            if key is not None:
+                self._blocked[key] = deque()
+            self._ready.append((key, pdu))
+        self._start_ready()
+
+    def _start_ready(self):
+        while self._ready and self._processing < self.max_concurrent:
+            key, pdu = self._ready.popleft()
+            self._depth -= 1
+            self._processing += 1
+            d = maybeDeferred(self.process, pdu)
+            d.addErrback(log.err)
+            d.addCallback(self._processed, key)
+
+    def _processed(self, _result, key):
+        self._processing -= 1
+        if key is not None:
+            blocked = self._blocked[key]
+            if blocked:
+                self._ready.append((key, blocked.popleft()))
+            else:
+                del self._blocked[key]
+        self._start_ready()
+
+
 class EsmeTransceiver(Protocol):
     BIND_PDU = BindTransceiver
     CONNECTED_STATE = 'BOUND_TRX'
 
+    # PDUs we don't log even when `log_pdus` is set, because there are lots
+    # of them and they're not very interesting.
+    UNLOGGED_PDUS = ('enquire_link', 'enquire_link_resp')
+
     callLater = reactor.callLater
+    clock = reactor
 
     def __init__(self, config, redis, esme_callbacks):
         self.config = config
@@ -55,99 +282,70 @@ class EsmeTransceiver(Protocol):
         self.smpp_bind_timeout = self.config.smpp_bind_timeout
         self.smpp_enquire_link_interval = \
                 self.config.smpp_enquire_link_interval
-        self.datastream = ''
+        self.framer = PDUFramer()
         self.redis = redis
+        self.seq_allocator = SequenceNumberAllocator(
+            redis, block_size=self.config.sequence_number_block_size)
+        self.unacked_window = UnackedWindow(
+            self.config.smpp_window_size, self.config.smpp_response_timeout,
+            clock=self.clock)
         self._lose_conn = None
-        # The PDU queue ensures that PDUs are processed in the order
-        # they arrive. `self._process_pdu_queue()` loops forever
-        # pulling PDUs off the queue and handling each before grabbing
-        # the next.
-        self._pdu_queue = DeferredQueue()
-        self._process_pdu_queue()  # intentionally throw away deferred
+        # PDUs that need to be handled in order (e.g. parts of the same
+        # multipart message or USSD session) are given the same ordering
+        # key, see `pdu_ordering_key()`.
+        self.pdu_processor = PDUProcessor(
+            self.handle_pdu, self.config.max_concurrent_pdus)
 
-    @inlineCallbacks
     def get_next_seq(self):
         """Get the next available SMPP sequence number.
 
         The valid range of sequence number is 0x00000001 to 0xFFFFFFFF.
-
-        We start trying to wrap at 0xFFFF0000 so we can keep returning values
-        (up to 0xFFFF of them) even while someone else is in the middle of
-        resetting the counter.
-        """
-        seq = yield self.redis.incr('smpp_last_sequence_number')
-
-        if seq >= 0xFFFF0000:
-            # We're close to the upper limit, so try to reset. It doesn't
-            # matter if we actually succeed or not, since we're going to return
-            # `seq` anyway.
-            yield self._reset_seq_counter()
-
-        returnValue(seq)
-
-    @inlineCallbacks
-    def _reset_seq_counter(self):
-        """Reset the sequence counter in a safe manner.
-
-        NOTE: There is a potential race condition in this implementation. If we
-        acquire the lock and it expires while we still think we hold it, it's
-        possible for the sequence number to be reset by someone else between
-        the final vlue check and the reset call. This seems like a very
-        unlikely situation, so we'll leave it like that for now.
-
-        A better solution is to replace this whole method with a lua script
-        that we send to redis, but scripting support is still very new at the
-        time of writing.
+        Sequence numbers are handed out from blocks reserved in redis, see
+        :class:`SequenceNumberAllocator`.
         """
-        # SETNX can be used as a lock.
-        locked = yield self.redis.setnx('smpp_last_sequence_number_wrap', 1)
-
-        # If someone crashed in exactly the wrong place, the lock may be
-        # held by someone else but have no expire time. A race condition
-        # here may set the TTL multiple times, but that's fine.
-        if (yield self.redis.ttl('smpp_last_sequence_number_wrap')) < 0:
-            # The TTL only gets set if the lock exists and recently had no TTL.
-            yield self.redis.expire('smpp_last_sequence_number_wrap', 10)
-
-        if not locked:
-            # We didn't actually get the lock, so our job is done.
-            return
-
-        if (yield self.redis.get('smpp_last_sequence_number')) < 0xFFFF0000:
-            # Our stored sequence number is no longer outside the allowed
-            # range, so someone else must have reset it before we got the lock.
-            return
+        return self.seq_allocator.get_next_seq()
 
-        # We reset the counter by deleting the key. The next INCR will recreate
-        # it for us.
-        yield self.redis.delete('smpp_last_sequence_number')
+    def handle_data(self, data):
+        return self.handle_pdu(self._unpack_pdu(data))
 
-    def pop_data(self):
-        data = None
-        if(len(self.datastream) >= 16):
-            command_length = int(binascii.b2a_hex(self.datastream[0:4]), 16)
-            if(len(self.datastream) >= command_length):
-                data = self.datastream[0:command_length]
-                self.datastream = self.datastream[command_length:]
-        return data
+    def handle_pdu(self, pdu):
+        handler = getattr(self, 'handle_%s' % (pdu['header']['command_id'],),
+                          self._command_handler_not_found)
+        return maybeDeferred(handler, pdu)
 
-    @inlineCallbacks
-    def handle_data(self, data):
+    def _unpack_pdu(self, data):
         pdu = unpack_pdu(data)
-        command_id = pdu['header']['command_id']
-        if command_id not in ('enquire_link', 'enquire_link_resp'):
+        if (self.config.log_pdus and
+                pdu['header']['command_id'] not in self.UNLOGGED_PDUS):
             log.debug('INCOMING <<<< %s' % binascii.b2a_hex(data))
             log.debug('INCOMING <<<< %s' % pdu)
-        handler = getattr(self, 'handle_%s' % (command_id,),
-                          self._command_handler_not_found)
-        yield handler(pdu)
+        return pdu
 
-    @inlineCallbacks
-    def _process_pdu_queue(self):
-        data = yield self._pdu_queue.get()
-        while data is not None:
-            yield self.handle_data(data)
-            data = yield self._pdu_queue.get()
+    def _queue_pdu(self, data):
+        pdu = self._unpack_pdu(data)
+        self.pdu_processor.put(self.pdu_ordering_key(pdu), pdu)
+
+    def pdu_ordering_key(self, pdu):
+        """Return a key for PDUs that must be handled in order.
+
+        Messages from the same source address are kept in order so that
+        multipart messages and USSD sessions are handled correctly. Delivery
+        reports and submit_sm responses can be handled in any order. All
+        other PDUs are handled in the order they arrive.
+        """
+        command_id = pdu['header']['command_id']
+        if command_id == 'submit_sm_resp':
+            return None
+        if command_id == 'deliver_sm':
+            pdu_params = pdu['body']['mandatory_parameters']
+            if self.config.delivery_report_re.search(
+                    pdu_params['short_message'] or ''):
+                return None
+            return ('deliver_sm', pdu_params['source_addr'])
+        return 'link'
+
+    def get_pdu_queue_depth(self):
+        return self.pdu_processor.queue_depth()
 
     def _command_handler_not_found(self, pdu):
         log.err('No command handler available for %s' % (pdu,))
@@ -179,23 +377,28 @@ class EsmeTransceiver(Protocol):
 
     def connectionLost(self, *args, **kwargs):
         self.state = 'CLOSED'
+        # Nothing still outstanding is going to get a response now.
+        self.unacked_window.clear()
         self.stop_enquire_link()
         self.cancel_drop_connection_call()
         log.msg('STATE: %s' % (self.state))
 
     def dataReceived(self, data):
-        self.datastream += data
-        data = self.pop_data()
-        while data is not None:
-            self._pdu_queue.put(data)
-            data = self.pop_data()
+        try:
+            pdus = self.framer.feed(data)
+        except PDUFramingError, e:
+            log.err("Dropping connection: %s" % (e,))
+            self.transport.loseConnection()
+            return
+        for pdu_data in pdus:
+            self._queue_pdu(pdu_data)
 
     def send_pdu(self, pdu):
         data = pdu.get_bin()
-        unpacked = unpack_pdu(data)
-        command_id = unpacked['header']['command_id']
-        if command_id not in ('enquire_link', 'enquire_link_resp'):
-            log.debug('OUTGOING >>>> %s' % unpacked)
+        if (self.config.log_pdus and
+                pdu.obj['header']['command_id'] not in self.UNLOGGED_PDUS):
+            log.debug('OUTGOING >>>> %s' % binascii.b2a_hex(data))
+            log.debug('OUTGOING >>>> %s' % (pdu.obj,))
         self.transport.write(data)
 
     @inlineCallbacks
@@ -227,14 +430,16 @@ class EsmeTransceiver(Protocol):
 
     @inlineCallbacks
     def handle_submit_sm_resp(self, pdu):
-        yield self.pop_unacked()
+        self.unacked_window.remove(pdu['header']['sequence_number'])
+        log.msg("unacked popped to: %s" % (self.get_unacked_count(),))
         message_id = pdu.get('body', {}).get(
                 'mandatory_parameters', {}).get('message_id')
         yield self.esme_callbacks.submit_sm_resp(
                 sequence_number=pdu['header']['sequence_number'],
                 command_status=pdu['header']['command_status'],
                 command_id=pdu['header']['command_id'],
-                message_id=message_id)
+                message_id=message_id,
+                esme_client=self)
 
     def _decode_message(self, message, data_coding):
         """
@@ -425,17 +630,12 @@ class EsmeTransceiver(Protocol):
             log.msg("enquire_link_resp NOT OK: %r" % (pdu,))
 
     def get_unacked_count(self):
-        return self.redis.llen("unacked").addCallback(int)
-
-    @inlineCallbacks
-    def push_unacked(self, sequence_number=-1):
-        yield self.redis.lpush("unacked", sequence_number)
-        log.msg("unacked pushed to: %s" % ((yield self.get_unacked_count())))
+        return len(self.unacked_window)
 
-    @inlineCallbacks
-    def pop_unacked(self):
-        yield self.redis.lpop("unacked")
-        log.msg("unacked popped to: %s" % ((yield self.get_unacked_count())))
+    def expire_unacked(self):
+        for sequence_number in self.unacked_window.expire():
+            log.warning("No response received for PDU with sequence number"
+                        " %s, expiring it." % (sequence_number,))
 
     @inlineCallbacks
     def submit_sm(self, **kwargs):
@@ -457,12 +657,15 @@ class EsmeTransceiver(Protocol):
         if self.config.send_long_messages and len(message) > 254:
             pdu.add_message_payload(''.join('%02x' % ord(c) for c in message))
 
+        # This waits for a free slot if the window is full.
+        yield self.unacked_window.add(sequence_number)
+        log.msg("unacked pushed to: %s" % (self.get_unacked_count(),))
         self.send_pdu(pdu)
-        yield self.push_unacked(sequence_number)
         returnValue(sequence_number)
 
     @inlineCallbacks
     def enquire_link(self, **kwargs):
+        self.expire_unacked()
         if self.state in ['BOUND_TX', 'BOUND_RX', 'BOUND_TRX']:
             sequence_number = yield self.get_next_seq()
             pdu = EnquireLink(sequence_number, **dict(self.defaults, **kwargs))
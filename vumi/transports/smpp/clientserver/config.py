@@ -27,6 +27,11 @@ class ClientConfig(object):
                  delivery_report_regex=None,
                  data_coding_overrides=None,
                  send_long_messages=False,
+                 sequence_number_block_size=100,
+                 smpp_window_size=100,
+                 smpp_response_timeout=60.0,
+                 log_pdus=True,
+                 max_concurrent_pdus=1,
                  ):
         # in SMPP system_id is the username
         self.host = host
@@ -50,6 +55,11 @@ class ClientConfig(object):
         self.data_coding_overrides = dict(
             (int(k), v) for k, v in (data_coding_overrides or {}).items())
         self.send_long_messages = send_long_messages
+        self.sequence_number_block_size = int(sequence_number_block_size)
+        self.smpp_window_size = int(smpp_window_size)
+        self.smpp_response_timeout = float(smpp_response_timeout)
+        self.log_pdus = log_pdus
+        self.max_concurrent_pdus = int(max_concurrent_pdus)
 
     def __eq__(self, other):
         if not isinstance(other, ClientConfig):
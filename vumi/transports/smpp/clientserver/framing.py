@@ -0,0 +1,55 @@
+# -*- test-case-name: vumi.transports.smpp.clientserver.tests.test_framing -*-
+
+import struct
+
+
+class PDUFramingError(Exception):
+    """Raised when a stream contains something that can't be a PDU."""
+
+
+class PDUFramer(object):
+    """Splits a stream of bytes into whole SMPP PDUs.
+
+    Received data is appended to a buffer and complete PDUs are read from an
+    offset into it, so a read containing many PDUs doesn't copy the rest of
+    the stream for each one. Consumed data is only discarded once the buffer
+    has been emptied or `compact_threshold` bytes have been consumed.
+    """
+
+    COMMAND_LENGTH = struct.Struct('!I')
+    HEADER_LENGTH = 16
+
+    def __init__(self, compact_threshold=65536):
+        self.compact_threshold = compact_threshold
+        self._buffer = bytearray()
+        self._offset = 0
+
+    def __len__(self):
+        """Number of bytes received but not yet returned as PDUs."""
+        return len(self._buffer) - self._offset
+
+    def feed(self, data):
+        """Add `data` to the stream and return a list of complete PDUs.
+        """
+        buf = self._buffer
+        buf.extend(data)
+        offset, end = self._offset, len(buf)
+        pdus = []
+        while end - offset >= self.HEADER_LENGTH:
+            [command_length] = self.COMMAND_LENGTH.unpack_from(buf, offset)
+            if command_length < self.HEADER_LENGTH:
+                raise PDUFramingError(
+                    "Invalid PDU command_length: %s" % (command_length,))
+            if end - offset < command_length:
+                break
+            pdus.append(str(buf[offset:offset + command_length]))
+            offset += command_length
+
+        if offset == end:
+            del buf[:]
+            offset = 0
+        elif offset >= self.compact_threshold:
+            del buf[:offset]
+            offset = 0
+        self._offset = offset
+        return pdus
@@ -13,7 +13,9 @@ from smpp.pdu_builder import (BindTransceiverResp,
                                 EnquireLinkResp,
                                 SubmitSMResp,
                                 DeliverSM)
-from smpp.pdu_inspector import binascii, unpack_pdu
+from smpp.pdu_inspector import unpack_pdu
+
+from vumi.transports.smpp.clientserver.framing import PDUFramer
 
 
 class SmscServer(Protocol):
@@ -26,16 +28,7 @@ class SmscServer(Protocol):
                     's sub:001 dlvrd:001 submit date:%' \
                     's done date:%' \
                     's stat:DELIVRD err:000 text:'
-        self.datastream = ''
-
-    def pop_data(self):
-        data = None
-        if(len(self.datastream) >= 16):
-            command_length = int(binascii.b2a_hex(self.datastream[0:4]), 16)
-            if(len(self.datastream) >= command_length):
-                data = self.datastream[0:command_length]
-                self.datastream = self.datastream[command_length:]
-        return data
+        self.framer = PDUFramer()
 
     def handle_data(self, data):
         pdu = unpack_pdu(data)
@@ -107,11 +100,8 @@ class SmscServer(Protocol):
         self.send_pdu(pdu)
 
     def dataReceived(self, data):
-        self.datastream += data
-        data = self.pop_data()
-        while data is not None:
-            self.handle_data(data)
-            data = self.pop_data()
+        for pdu_data in self.framer.feed(data):
+            self.handle_data(pdu_data)
 
     def send_pdu(self, pdu):
         data = pdu.get_bin()
@@ -1,19 +1,28 @@
+import binascii
+
 from twisted.trial import unittest
 from twisted.internet.task import Clock
-from twisted.internet.defer import inlineCallbacks, returnValue
-from smpp.pdu_builder import DeliverSM, BindTransceiverResp
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, gatherResults, Deferred)
+from smpp.pdu_builder import (
+    DeliverSM, BindTransceiverResp, SubmitSMResp, EnquireLink)
 from smpp.pdu import unpack_pdu
 
 from vumi.tests.utils import LogCatcher, PersistenceMixin
+from vumi.transports.smpp.clientserver import client
 from vumi.transports.smpp.clientserver.client import (
     EsmeTransceiver, EsmeReceiver, EsmeTransmitter, EsmeCallbacks, ESME,
-    unpacked_pdu_opts)
+    unpacked_pdu_opts, SequenceNumberAllocator, UnackedWindow, PDUProcessor)
 from vumi.transports.smpp.clientserver.config import ClientConfig
 
 
 class FakeTransport(object):
     def __init__(self):
         self.connected = True
+        self.written = []
+
+    def write(self, data):
+        self.written.append(data)
 
     def loseConnection(self):
         self.connected = False
@@ -25,6 +34,7 @@ class FakeEsmeMixin(object):
         self.clock = Clock()
         self.callLater = self.clock.callLater
         self.fake_sent_pdus = []
+        self.unacked_window.clock = self.clock
 
     def fake_send_pdu(self, pdu):
         self.fake_sent_pdus.append(pdu)
@@ -57,6 +67,208 @@ class FakeEsmeTransmitter(EsmeTransmitter, FakeEsmeMixin):
         return self.fake_send_pdu(pdu)
 
 
+class CountingRedisManager(object):
+    """Wraps a redis manager and counts the scripts run on it."""
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.scripts_run = 0
+
+    def run_script(self, *args, **kw):
+        self.scripts_run += 1
+        return self.redis.run_script(*args, **kw)
+
+
+class SequenceNumberAllocatorTestCase(unittest.TestCase, PersistenceMixin):
+    timeout = 5
+
+    @inlineCallbacks
+    def setUp(self):
+        self._persist_setUp()
+        self.redis = yield self.get_redis_manager()
+        self.counting_redis = CountingRedisManager(self.redis)
+
+    def tearDown(self):
+        return self._persist_tearDown()
+
+    def mk_allocator(self, block_size=10):
+        return SequenceNumberAllocator(
+            self.counting_redis, block_size=block_size)
+
+    @inlineCallbacks
+    def test_get_next_seq(self):
+        allocator = self.mk_allocator()
+        seqs = []
+        for _ in range(25):
+            seqs.append((yield allocator.get_next_seq()))
+        self.assertEqual(range(1, 26), seqs)
+        self.assertEqual(3, self.counting_redis.scripts_run)
+        self.assertEqual(
+            '30', (yield self.redis.get('smpp_last_sequence_number')))
+
+    @inlineCallbacks
+    def test_concurrent_get_next_seq(self):
+        allocator = self.mk_allocator()
+        seqs = yield gatherResults(
+            [allocator.get_next_seq() for _ in range(25)])
+        self.assertEqual(range(1, 26), seqs)
+        self.assertEqual(3, self.counting_redis.scripts_run)
+
+    @inlineCallbacks
+    def test_allocators_get_distinct_blocks(self):
+        allocator1 = self.mk_allocator()
+        allocator2 = self.mk_allocator()
+        self.assertEqual(1, (yield allocator1.get_next_seq()))
+        self.assertEqual(11, (yield allocator2.get_next_seq()))
+        self.assertEqual(2, (yield allocator1.get_next_seq()))
+        self.assertEqual(12, (yield allocator2.get_next_seq()))
+
+    @inlineCallbacks
+    def test_wrap(self):
+        allocator = self.mk_allocator()
+        yield self.redis.set('smpp_last_sequence_number', 0xFFFFFFFF - 5)
+        self.assertEqual(1, (yield allocator.get_next_seq()))
+        self.assertEqual(
+            '10', (yield self.redis.get('smpp_last_sequence_number')))
+
+    @inlineCallbacks
+    def test_reservation_failure(self):
+        allocator = self.mk_allocator()
+        yield self.redis.set('smpp_last_sequence_number', 'bad')
+        failures = []
+        for _ in range(2):
+            allocator.get_next_seq().addErrback(failures.append)
+        yield allocator.get_next_seq().addErrback(failures.append)
+        self.assertEqual(3, len(failures))
+        yield self.redis.set('smpp_last_sequence_number', 0)
+        self.assertEqual(1, (yield allocator.get_next_seq()))
+
+    @inlineCallbacks
+    def test_throughput(self):
+        allocator = self.mk_allocator(block_size=100)
+        seqs = yield gatherResults(
+            [allocator.get_next_seq() for _ in range(10000)])
+        self.assertEqual(range(1, 10001), seqs)
+        self.assertEqual(100, self.counting_redis.scripts_run)
+
+
+class UnackedWindowTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.window = UnackedWindow(2, 10, clock=self.clock)
+
+    def test_add_and_remove(self):
+        self.assertEqual(0, len(self.window))
+        self.assertEqual(1, self.successResultOf(self.window.add(1)))
+        self.assertTrue(1 in self.window)
+        self.assertEqual(1, len(self.window))
+        self.assertTrue(self.window.remove(1))
+        self.assertFalse(1 in self.window)
+        self.assertFalse(self.window.remove(1))
+        self.assertEqual(0, len(self.window))
+
+    def test_add_waits_when_full(self):
+        self.window.add(1)
+        self.window.add(2)
+        self.assertTrue(self.window.is_full())
+        d3 = self.window.add(3)
+        d4 = self.window.add(4)
+        self.assertNoResult(d3)
+        self.assertNoResult(d4)
+        self.window.remove(2)
+        self.assertEqual(3, self.successResultOf(d3))
+        self.assertNoResult(d4)
+        self.window.remove(5)
+        self.assertNoResult(d4)
+        self.window.remove(1)
+        self.assertEqual(4, self.successResultOf(d4))
+        self.assertEqual(2, len(self.window))
+
+    def test_expire(self):
+        self.window.add(1)
+        self.clock.advance(5)
+        self.window.add(2)
+        d3 = self.window.add(3)
+        self.assertEqual([], self.window.expire())
+        self.clock.advance(5)
+        self.assertEqual([1], self.window.expire())
+        self.assertEqual(3, self.successResultOf(d3))
+        self.assertEqual(2, len(self.window))
+
+    def test_add_expires_when_full(self):
+        self.window.add(1)
+        self.window.add(2)
+        self.clock.advance(10)
+        self.assertEqual(3, self.successResultOf(self.window.add(3)))
+        self.assertEqual(1, len(self.window))
+
+    def test_clear(self):
+        self.window.add(1)
+        self.window.add(2)
+        d3 = self.window.add(3)
+        self.window.clear()
+        self.assertEqual(3, self.successResultOf(d3))
+        self.assertEqual(1, len(self.window))
+
+
+class PDUProcessorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.started = []
+        self.pending = {}
+
+    def process(self, pdu):
+        self.started.append(pdu)
+        d = self.pending[pdu] = Deferred()
+        return d
+
+    def finish(self, pdu):
+        self.pending.pop(pdu).callback(None)
+
+    def test_sequential(self):
+        processor = PDUProcessor(self.process, 1)
+        processor.put(None, 'a')
+        processor.put(None, 'b')
+        self.assertEqual(['a'], self.started)
+        self.assertEqual(1, processor.queue_depth())
+        self.finish('a')
+        self.assertEqual(['a', 'b'], self.started)
+        self.assertEqual(0, processor.queue_depth())
+
+    def test_concurrent(self):
+        processor = PDUProcessor(self.process, 2)
+        for pdu in 'abc':
+            processor.put(None, pdu)
+        self.assertEqual(['a', 'b'], self.started)
+        self.finish('b')
+        self.assertEqual(['a', 'b', 'c'], self.started)
+
+    def test_same_key_in_order(self):
+        processor = PDUProcessor(self.process, 10)
+        processor.put('k1', 'a')
+        processor.put('k1', 'b')
+        processor.put('k2', 'c')
+        processor.put(None, 'd')
+        processor.put('k1', 'e')
+        self.assertEqual(['a', 'c', 'd'], self.started)
+        self.assertEqual(2, processor.queue_depth())
+        self.finish('a')
+        self.assertEqual(['a', 'c', 'd', 'b'], self.started)
+        self.finish('b')
+        self.assertEqual(['a', 'c', 'd', 'b', 'e'], self.started)
+        self.finish('e')
+        self.assertFalse('k1' in processor._blocked)
+
+    def test_error_does_not_stop_processing(self):
+        processor = PDUProcessor(self.process, 1)
+        processor.put('k', 'a')
+        processor.put('k', 'b')
+        self.pending.pop('a').errback(ValueError("bad pdu"))
+        self.assertEqual(1, len(self.flushLoggedErrors(ValueError)))
+        self.assertEqual(['a', 'b'], self.started)
+
+
 class EsmeTestCaseBase(unittest.TestCase, PersistenceMixin):
     timeout = 5
     ESME_CLASS = None
@@ -150,12 +362,105 @@ class EsmeGenericMixin(object):
     @inlineCallbacks
     def test_sequence_rollover(self):
         esme = yield self.get_unbound_esme()
+        block_size = esme.config.sequence_number_block_size
         self.assertEqual(1, (yield esme.get_next_seq()))
         self.assertEqual(2, (yield esme.get_next_seq()))
-        yield esme.redis.set('smpp_last_sequence_number', 0xFFFF0000)
-        self.assertEqual(0xFFFF0001, (yield esme.get_next_seq()))
+        yield esme.redis.set('smpp_last_sequence_number',
+                             0xFFFFFFFF - block_size)
+        # We still have the rest of our first block to hand out.
+        for seq in range(3, block_size + 1):
+            self.assertEqual(seq, (yield esme.get_next_seq()))
+        self.assertEqual(0xFFFFFFFF - block_size + 1,
+                         (yield esme.get_next_seq()))
+        for _ in range(block_size - 2):
+            yield esme.get_next_seq()
+        self.assertEqual(0xFFFFFFFF, (yield esme.get_next_seq()))
         self.assertEqual(1, (yield esme.get_next_seq()))
 
+    @inlineCallbacks
+    def test_data_received_batch(self):
+        esme = yield self.get_esme()
+        data = ''.join(EnquireLink(seq).get_bin() for seq in range(1, 11))
+        esme.dataReceived(data[:-5])
+        esme.dataReceived(data[-5:])
+        self.assertEqual(
+            range(1, 11),
+            [pdu.get_obj()['header']['sequence_number']
+             for pdu in esme.fake_sent_pdus])
+
+    @inlineCallbacks
+    def test_pdu_ordering_key(self):
+        esme = yield self.get_esme()
+
+        def key(pdu):
+            return esme.pdu_ordering_key(unpack_pdu(pdu.get_bin()))
+
+        self.assertEqual(None, key(SubmitSMResp(1, "3rd_party_id")))
+        self.assertEqual('link', key(EnquireLink(1)))
+        self.assertEqual(('deliver_sm', '123'), key(DeliverSM(
+            1, short_message="hello", source_addr="123")))
+        self.assertEqual(None, key(DeliverSM(
+            1, source_addr="123", short_message=(
+                "id:1b1720be-5f48-41c4-b3f8-6e59dbf45366 sub:001 dlvrd:001"
+                " submit date:120726132548 done date:120726132548"
+                " stat:DELIVRD err:000 text:"))))
+
+    @inlineCallbacks
+    def test_data_received_concurrent(self):
+        esme = yield self.get_esme()
+        esme.pdu_processor.max_concurrent = 2
+        handled = []
+        pending = []
+
+        def handle_pdu(pdu):
+            handled.append(pdu['header']['sequence_number'])
+            d = Deferred()
+            pending.append(d)
+            return d
+        esme.pdu_processor.process = handle_pdu
+
+        esme.dataReceived(''.join(
+            SubmitSMResp(seq, "id%s" % seq).get_bin() for seq in (1, 2, 3)))
+        self.assertEqual([1, 2], handled)
+        self.assertEqual(1, esme.get_pdu_queue_depth())
+        pending.pop().callback(None)
+        self.assertEqual([1, 2, 3], handled)
+        self.assertEqual(0, esme.get_pdu_queue_depth())
+
+    @inlineCallbacks
+    def test_data_received_bad_framing(self):
+        esme = yield self.get_esme()
+        esme.dataReceived('\x00' * 16)
+        self.assertEqual(False, esme.transport.connected)
+
+    @inlineCallbacks
+    def test_send_pdu_does_not_unpack(self):
+        esme = yield self.get_esme()
+        esme.config.log_pdus = False
+
+        def unpack_pdu(data):
+            self.fail("send_pdu() should not unpack PDUs")
+        self.patch(client, 'unpack_pdu', unpack_pdu)
+
+        pdu = SubmitSMResp(1, "3rd_party_id")
+        with LogCatcher(message='OUTGOING') as lc:
+            EsmeTransceiver.send_pdu(esme, pdu)
+        self.assertEqual([pdu.get_bin()], esme.transport.written)
+        self.assertEqual([], lc.messages())
+
+    @inlineCallbacks
+    def test_send_pdu_log_pdus(self):
+        esme = yield self.get_esme()
+        self.assertTrue(esme.config.log_pdus)
+        pdu = SubmitSMResp(1, "3rd_party_id")
+        with LogCatcher(message='OUTGOING') as lc:
+            EsmeTransceiver.send_pdu(esme, EnquireLink(2))
+            EsmeTransceiver.send_pdu(esme, pdu)
+        self.assertEqual(2, len(esme.transport.written))
+        [hex_dump, obj_dump] = lc.messages()
+        self.assertTrue(binascii.b2a_hex(pdu.get_bin()) in hex_dump)
+        self.assertTrue("'submit_sm_resp'" in obj_dump)
+
 
 class EsmeTransmitterMixin(EsmeGenericMixin):
     """Transmitter-side tests."""
@@ -189,6 +494,30 @@ class EsmeTransmitterMixin(EsmeGenericMixin):
         self.assertEqual(''.join('%02x' % ord(c) for c in long_message),
                          pdu_opts['message_payload'])
 
+    @inlineCallbacks
+    def test_submit_sm_window(self):
+        esme = yield self.get_esme()
+        esme.unacked_window.max_size = 1
+        seq = yield esme.submit_sm(short_message='hello')
+        self.assertEqual(1, esme.get_unacked_count())
+        d = esme.submit_sm(short_message='world')
+        self.assertNoResult(d)
+        self.assertEqual(1, len(esme.fake_sent_pdus))
+        yield esme.handle_submit_sm_resp(
+            unpack_pdu(SubmitSMResp(seq, "3rd_party_id").get_bin()))
+        next_seq = yield d
+        self.assertEqual(2, len(esme.fake_sent_pdus))
+        self.assertEqual([next_seq], esme.unacked_window._pending.keys())
+
+    @inlineCallbacks
+    def test_submit_sm_response_timeout(self):
+        esme = yield self.get_esme()
+        yield esme.submit_sm(short_message='hello')
+        esme.clock.advance(esme.config.smpp_response_timeout)
+        esme.fake_sent_pdus.pop()
+        yield esme.enquire_link()
+        self.assertEqual(0, esme.get_unacked_count())
+
     @inlineCallbacks
     def test_submit_sm_ussd_continue(self):
         """Submit a USSD message with a session continue flag."""
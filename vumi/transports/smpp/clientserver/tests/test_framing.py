@@ -0,0 +1,62 @@
+from twisted.trial.unittest import TestCase
+from smpp.pdu_builder import DeliverSM, EnquireLink
+
+from vumi.transports.smpp.clientserver.framing import (
+    PDUFramer, PDUFramingError)
+
+
+class PDUFramerTestCase(TestCase):
+
+    def mk_pdus(self, count):
+        return [DeliverSM(i, short_message="message %s" % (i,)).get_bin()
+                for i in range(1, count + 1)]
+
+    def test_single_pdu(self):
+        framer = PDUFramer()
+        pdu = EnquireLink(1).get_bin()
+        self.assertEqual([pdu], framer.feed(pdu))
+        self.assertEqual(0, len(framer))
+
+    def test_many_pdus_in_one_read(self):
+        framer = PDUFramer()
+        pdus = self.mk_pdus(100)
+        self.assertEqual(pdus, framer.feed(''.join(pdus)))
+        self.assertEqual(0, len(framer))
+
+    def test_pdu_split_across_reads(self):
+        framer = PDUFramer()
+        [pdu1, pdu2] = self.mk_pdus(2)
+        self.assertEqual([], framer.feed(pdu1[:10]))
+        self.assertEqual([], framer.feed(pdu1[10:20]))
+        self.assertEqual([pdu1], framer.feed(pdu1[20:] + pdu2[:5]))
+        self.assertEqual(5, len(framer))
+        self.assertEqual([pdu2], framer.feed(pdu2[5:]))
+        self.assertEqual(0, len(framer))
+
+    def test_byte_at_a_time(self):
+        framer = PDUFramer()
+        pdus = self.mk_pdus(3)
+        received = []
+        for byte in ''.join(pdus):
+            received.extend(framer.feed(byte))
+        self.assertEqual(pdus, received)
+
+    def test_compaction(self):
+        framer = PDUFramer(compact_threshold=100)
+        pdus = self.mk_pdus(20)
+        data = ''.join(pdus) + pdus[0][:3]
+        self.assertEqual(pdus, framer.feed(data))
+        self.assertEqual(3, len(framer))
+        self.assertEqual(0, framer._offset)
+        self.assertEqual([pdus[0]], framer.feed(pdus[0][3:]))
+
+    def test_no_compaction_below_threshold(self):
+        framer = PDUFramer()
+        [pdu1, pdu2] = self.mk_pdus(2)
+        self.assertEqual([pdu1], framer.feed(pdu1 + pdu2[:3]))
+        self.assertEqual(len(pdu1), framer._offset)
+        self.assertEqual([pdu2], framer.feed(pdu2[3:]))
+
+    def test_invalid_command_length(self):
+        framer = PDUFramer()
+        self.assertRaises(PDUFramingError, framer.feed, '\x00' * 16)
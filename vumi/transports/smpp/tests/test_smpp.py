@@ -2,6 +2,7 @@ import binascii
 
 from twisted.internet.defer import Deferred, inlineCallbacks, succeed
 from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
 from smpp.pdu_builder import SubmitSMResp, DeliverSM
 
 from vumi.message import TransportUserMessage
@@ -106,6 +107,54 @@ class SmppTransportTestCase(TransportTestCase):
         self.assertEqual(None, (
                 yield self.transport.r_get_id_for_third_party_id(their_id)))
 
+    @inlineCallbacks
+    def test_submit_keys_expire(self):
+        redis = self.transport.redis
+        yield self.dispatch(self.mkmsg_out("message 1", message_id='444'))
+        self.assertTrue(
+            (yield redis.ttl(self.transport.r_message_key('444'))) > 0)
+        self.assertEqual('444', (yield redis.get('1')))
+        self.assertTrue((yield redis.ttl('1')) > 0)
+
+    @inlineCallbacks
+    def test_store_error_after_submit_error(self):
+        stored = Deferred()
+        self.patch(self.transport, 'r_set_message', lambda message: stored)
+
+        def submit(message):
+            raise ValueError("Submit failed.")
+
+        self.patch(self.transport, '_submit_outbound_message', submit)
+        d = self.transport.handle_outbound_message(self.mkmsg_out())
+        yield self.assertFailure(d, ValueError)
+        stored.errback(RuntimeError("Store failed."))
+        self.assertEqual(1, len(self.flushLoggedErrors(RuntimeError)))
+
+    @inlineCallbacks
+    def test_submit_sm_resp_maps_third_party_id(self):
+        redis = self.transport.redis
+        yield self.dispatch(self.mkmsg_out("message 1", message_id='444'))
+        yield self.esme.handle_data(SubmitSMResp(1, "3rd_party_id").get_bin())
+        self.assertEqual(None, (yield redis.get('1')))
+        self.assertEqual('444', (
+            yield self.transport.r_get_id_for_third_party_id("3rd_party_id")))
+        self.assertTrue((yield redis.ttl(
+            self.transport.r_third_party_id_key("3rd_party_id"))) > 0)
+        self.assertEqual(None, (yield self.transport.r_get_message('444')))
+
+    @inlineCallbacks
+    def test_unacked_metric(self):
+        yield self.dispatch(self.mkmsg_out("message 1", message_id='444'))
+        yield self.dispatch(self.mkmsg_out("message 2", message_id='445'))
+        self.assertEqual(
+            [0, 1], [v for _t, v in self.transport.unacked_metric.poll()])
+        self.assertEqual(2, self.esme.get_unacked_count())
+
+    def test_pdu_queue_metric(self):
+        self.transport._sample_metrics(self.transport.metrics)
+        self.assertEqual(
+            [0], [v for _t, v in self.transport.pdu_queue_metric.poll()])
+
     @inlineCallbacks
     def test_out_of_order_responses(self):
         # Sequence numbers are hardcoded, assuming we start fresh from 0.
@@ -223,17 +272,162 @@ class SmppTransportTestCase(TransportTestCase):
     def test_reconnect(self):
         connector = self.transport.connectors[self.transport.transport_name]
         self.assertFalse(connector._consumers['outbound'].paused)
+        self.esme.state = 'CLOSED'
         yield self.transport.esme_disconnected()
         self.assertTrue(connector._consumers['outbound'].paused)
         yield self.transport.esme_disconnected()
         self.assertTrue(connector._consumers['outbound'].paused)
 
+        self.esme.state = 'BOUND_TRX'
         yield self.transport.esme_connected(self.esme)
         self.assertFalse(connector._consumers['outbound'].paused)
         yield self.transport.esme_connected(self.esme)
         self.assertFalse(connector._consumers['outbound'].paused)
 
 
+class MultiBindSmppTransportTestCase(TransportTestCase):
+    transport_class = SmppTransport
+
+    @inlineCallbacks
+    def setUp(self):
+        super(MultiBindSmppTransportTestCase, self).setUp()
+        self.config = {
+                "transport_name": self.transport_name,
+                "system_id": "vumitest-vumitest-vumitest",
+                "host": "host",
+                "port": "port",
+                "password": "password",
+                "bind_count": 2,
+                }
+        self.clientConfig = ClientConfig.from_config(self.config)
+
+        self.transport = yield self.get_transport(self.config, start=False)
+        self.transport.esme_client = None
+        yield self.transport.startWorker()
+
+        self.esme1 = self._make_esme()
+        self.esme2 = self._make_esme()
+        self.transport.factories = [self.transport.make_factory()
+                                    for _ in range(2)]
+        for factory, esme in zip(self.transport.factories,
+                                 [self.esme1, self.esme2]):
+            factory.esme = esme
+            self.transport.esme_connected(esme)
+
+    def _make_esme(self):
+        esme_callbacks = EsmeCallbacks(
+            submit_sm_resp=self.transport.submit_sm_resp)
+        esme = EsmeTransceiver(
+            self.clientConfig, self.transport.redis, esme_callbacks)
+        esme.transport = StringTransport()
+        esme.sent_pdus = []
+        esme.send_pdu = esme.sent_pdus.append
+        esme.state = 'BOUND_TRX'
+        return esme
+
+    def sent_contents(self, esme):
+        return [p.obj['body']['mandatory_parameters']['short_message']
+                for p in esme.sent_pdus]
+
+    @inlineCallbacks
+    def test_submit_sm_spread_by_free_window(self):
+        yield self.dispatch(self.mkmsg_out("message 1", message_id='444'))
+        yield self.dispatch(self.mkmsg_out("message 2", message_id='445'))
+        yield self.dispatch(self.mkmsg_out("message 3", message_id='446'))
+        self.assertEqual(["message 1", "message 3"],
+                         self.sent_contents(self.esme1))
+        self.assertEqual(["message 2"], self.sent_contents(self.esme2))
+
+    @inlineCallbacks
+    def test_submit_sm_skips_closed_bind(self):
+        self.esme1.state = 'CLOSED'
+        yield self.transport.esme_disconnected()
+        connector = self.transport.connectors[self.transport.transport_name]
+        self.assertFalse(connector._consumers['outbound'].paused)
+        self.assertEqual([self.esme2], self.transport.esme_clients)
+        yield self.dispatch(self.mkmsg_out("message 1", message_id='444'))
+        self.assertEqual([], self.sent_contents(self.esme1))
+        self.assertEqual(["message 1"], self.sent_contents(self.esme2))
+
+        self.esme2.state = 'CLOSED'
+        yield self.transport.esme_disconnected()
+        self.assertTrue(connector._consumers['outbound'].paused)
+
+    @inlineCallbacks
+    def test_throttled_bind(self):
+        clock = Clock()
+        self.transport.callLater = clock.callLater
+        connector = self.transport.connectors[self.transport.transport_name]
+
+        yield self.dispatch(self.mkmsg_out("Heimlich", message_id='447'))
+        yield self.esme1.handle_data(SubmitSMResp(
+            1, "3rd_party_id_4", command_status="ESME_RTHROTTLED").get_bin())
+        self.assertFalse(self.transport.throttled)
+        self.assertFalse(connector._consumers['outbound'].paused)
+        self.assertEqual(set([self.esme1]), self.transport.throttled_binds)
+
+        # New messages go out on the unthrottled bind.
+        yield self.dispatch(self.mkmsg_out("Other", message_id='448'))
+        self.assertEqual(["Heimlich"], self.sent_contents(self.esme1))
+        self.assertEqual(["Other"], self.sent_contents(self.esme2))
+
+        # Once every bind is throttled, we stop consuming. Each bind reserves
+        # its own block of sequence numbers.
+        yield self.esme2.handle_data(SubmitSMResp(
+            101, "3rd_party_id_5", command_status="ESME_RTHROTTLED").get_bin())
+        self.assertTrue(self.transport.throttled)
+        self.assertTrue(connector._consumers['outbound'].paused)
+
+        # Both binds carry retries again after the throttle delay.
+        clock.advance(0.1)
+        self.assertEqual(set(), self.transport.throttled_binds)
+        self.assertEqual(["Heimlich", "Heimlich"],
+                         self.sent_contents(self.esme1))
+        self.assertEqual(["Other", "Other"], self.sent_contents(self.esme2))
+        self.assertTrue(self.transport.throttled)
+
+        yield self.esme1.handle_data(
+            SubmitSMResp(2, "3rd_party_6").get_bin())
+        self.assertFalse(self.transport.throttled)
+        self.assertFalse(connector._consumers['outbound'].paused)
+        self.assertEqual([self.mkmsg_ack('447', '3rd_party_6')],
+                         self.get_dispatched_events())
+
+    @inlineCallbacks
+    def test_throttled_bind_recovers(self):
+        clock = Clock()
+        self.transport.callLater = clock.callLater
+
+        yield self.dispatch(self.mkmsg_out("Heimlich", message_id='447'))
+        yield self.esme1.handle_data(SubmitSMResp(
+            1, "3rd_party_id_4", command_status="ESME_RTHROTTLED").get_bin())
+        yield self.dispatch(self.mkmsg_out("Other", message_id='448'))
+        yield self.dispatch(self.mkmsg_out("Third", message_id='449'))
+        self.assertEqual(["Heimlich"], self.sent_contents(self.esme1))
+        self.assertEqual(["Other", "Third"], self.sent_contents(self.esme2))
+
+        # The throttled bind takes traffic again without needing a response.
+        clock.advance(0.1)
+        self.assertEqual(set(), self.transport.throttled_binds)
+        self.assertEqual(["Heimlich", "Heimlich"],
+                         self.sent_contents(self.esme1))
+        yield self.dispatch(self.mkmsg_out("Fourth", message_id='450'))
+        self.assertEqual(["Heimlich", "Heimlich", "Fourth"],
+                         self.sent_contents(self.esme1))
+        self.assertEqual(["Other", "Third"], self.sent_contents(self.esme2))
+
+    @inlineCallbacks
+    def test_bind_metrics(self):
+        yield self.dispatch(self.mkmsg_out("message 1", message_id='444'))
+        self.transport.throttled_binds.add(self.esme2)
+        self.transport._sample_metrics(self.transport.metrics)
+        [(unacked1, queue1, throttled1), (unacked2, queue2, throttled2)] = [
+            [[v for _t, v in metric.poll()] for metric in bind_metrics]
+            for bind_metrics in self.transport.bind_metrics]
+        self.assertEqual(([1], [0], [0]), (unacked1, queue1, throttled1))
+        self.assertEqual(([0], [0], [1]), (unacked2, queue2, throttled2))
+
+
 class MockSmppTransport(SmppTransport):
     @inlineCallbacks
     def esme_connected(self, client):
@@ -15,6 +15,30 @@ from vumi.transports.smpp.clientserver.config import ClientConfig
 from vumi.transports.failures import FailureMessage
 from vumi.message import Message, TransportUserMessage
 from vumi.persist.txredis_manager import TxRedisManager
+from vumi.persist.redis_base import RedisScript
+from vumi.blinkenlights.metrics import MetricManager, Metric
+
+
+def _fake_pop_id_for_sequence(fake_redis, keys, args):
+    [sequence_key, third_party_id_key], [expiry] = keys, args
+    message_id = fake_redis.get.sync(fake_redis, sequence_key)
+    if message_id is not None:
+        fake_redis.delete.sync(fake_redis, sequence_key)
+        fake_redis.setex.sync(
+            fake_redis, third_party_id_key, int(expiry), message_id)
+    return message_id
+
+
+# Looks up the message id for a sequence number, deletes the sequence number
+# and maps the third party id to the message id, all in one round trip.
+POP_ID_FOR_SEQUENCE = RedisScript("""
+local message_id = redis.call('GET', KEYS[1])
+if message_id then
+    redis.call('DEL', KEYS[1])
+    redis.call('SETEX', KEYS[2], ARGV[1], message_id)
+end
+return message_id
+""", _fake_pop_id_for_sequence)
 
 
 class SmppTransport(Transport):
@@ -63,6 +87,15 @@ class SmppTransport(Transport):
     :param throttle_delay:
         Delay (in seconds) before retrying a message after receiving
         `ESME_RTHROTTLED`. Default 0.1
+    :type submit_sm_expiry: int, optional
+    :param submit_sm_expiry:
+        Number of seconds to keep outbound messages and their sequence
+        numbers in Redis while waiting for a `submit_sm_resp`. Default is
+        one day.
+    :type third_party_id_expiry: int, optional
+    :param third_party_id_expiry:
+        Number of seconds to keep the mapping from the SMSC's message id to
+        ours for delivery reports. Default is one week.
 
     SMPP protocol configuration options:
 
@@ -99,6 +132,45 @@ class SmppTransport(Transport):
         `message_payload` optional field instead of the `short_message` field.
         Default is `False`, simply because that maintains previous behaviour.
 
+    :param int sequence_number_block_size:
+        How many SMPP sequence numbers to reserve from redis at a time.
+        Sequence numbers within a reserved block are handed out without
+        talking to redis. Default is 100.
+
+    :param int smpp_window_size:
+        The maximum number of submit_sm PDUs that may be awaiting a response
+        at once. Further messages wait until a response arrives. The number of
+        outstanding PDUs is published as the `<transport_name>.unacked_pdus`
+        metric. Default is 100.
+
+    :param float smpp_response_timeout:
+        How long to wait for a response to a submit_sm PDU before giving up
+        on it and freeing its slot in the window. Default is 60 seconds.
+
+    :param bool log_pdus:
+        If `True`, PDUs sent and received (other than enquire_link PDUs) are
+        logged at debug level. Default is `True`. Building these log
+        messages is expensive, so set this to `False` on busy binds that
+        don't need them.
+
+    :param int max_concurrent_pdus:
+        The maximum number of incoming PDUs to handle at once. Messages from
+        the same source address are always handled in order, as are bind and
+        enquire_link PDUs. Delivery reports and submit_sm responses may be
+        handled in any order. The number of PDUs waiting to be handled is
+        published as the `<transport_name>.pdu_queue_depth` metric.
+        Default is 1.
+
+    :param int bind_count:
+        The number of binds to open to the SMPP server. Outbound messages are
+        sent on whichever healthy bind has the most free space in its window,
+        and a bind that is throttled by the server is skipped for
+        `throttle_delay` seconds. The transport only stops consuming messages
+        once every bind is throttled or disconnected. Each bind publishes
+        `<transport_name>.bind<n>.unacked_pdus`,
+        `<transport_name>.bind<n>.pdu_queue_depth` and
+        `<transport_name>.bind<n>.throttled` metrics. Default is 1.
+
     The list of SMPP protocol configuration options given above is not
     exhaustive. Any other options specified are passed through to the
     python-smpp library PDU (protocol data unit) builder.
@@ -130,6 +202,7 @@ class SmppTransport(Transport):
     def validate_config(self):
         self.client_config = ClientConfig.from_config(self.config)
         self.throttle_delay = float(self.config.get('throttle_delay', 0.1))
+        self.bind_count = int(self.config.get('bind_count', 1))
 
     @inlineCallbacks
     def setup_transport(self):
@@ -139,6 +212,10 @@ class SmppTransport(Transport):
                 "third_party_id_expiry",
                 60 * 60 * 24 * 7  # 1 week
                 )
+        self.submit_sm_expiry = self.config.get(
+                "submit_sm_expiry",
+                60 * 60 * 24  # 1 day
+                )
 
         r_config = self.config.get('redis_manager', {})
         default_prefix = "%s@%s:%s" % (
@@ -152,6 +229,19 @@ class SmppTransport(Transport):
 
         self.r_message_prefix = "message_json"
         self.throttled = False
+        self.esme_clients = []
+        self.throttled_binds = set()
+        self.bind_throttle_timers = {}
+        self.factories = []
+
+        self.metrics = yield self.start_publisher(
+            MetricManager, "%s." % (self.transport_name,),
+            on_publish=self._sample_metrics)
+        self.unacked_metric = self.metrics.register(Metric('unacked_pdus'))
+        self.pdu_queue_metric = self.metrics.register(
+            Metric('pdu_queue_depth'))
+        self.bind_metrics = [self._register_bind_metrics(i)
+                             for i in range(self.bind_count)]
 
         self.esme_callbacks = EsmeCallbacks(
             connect=self.esme_connected,
@@ -162,36 +252,94 @@ class SmppTransport(Transport):
 
         if not hasattr(self, 'esme_client'):
             # start the Smpp transport (if we don't have one)
-            self.factory = self.make_factory()
-            reactor.connectTCP(
-                self.client_config.host,
-                self.client_config.port,
-                self.factory)
+            self.factories = [self.make_factory()
+                              for _ in range(self.bind_count)]
+            self.factory = self.factories[0]
+            for factory in self.factories:
+                reactor.connectTCP(
+                    self.client_config.host,
+                    self.client_config.port,
+                    factory)
 
     @inlineCallbacks
     def teardown_transport(self):
-        if hasattr(self, 'factory'):
-            self.factory.stopTrying()
-            self.factory.esme.transport.loseConnection()
+        for esme_client in getattr(self, 'bind_throttle_timers', {}).keys():
+            self._cancel_bind_throttle_timer(esme_client)
+        for factory in getattr(self, 'factories', []):
+            factory.stopTrying()
+            if factory.esme is not None:
+                factory.esme.transport.loseConnection()
+        if hasattr(self, 'metrics'):
+            self.metrics.stop()
         yield self.redis._close()
 
     def make_factory(self):
         return EsmeTransceiverFactory(
             self.client_config, self.redis, self.esme_callbacks)
 
+    def _register_bind_metrics(self, index):
+        prefix = "bind%d." % (index,)
+        return (self.metrics.register(Metric(prefix + 'unacked_pdus')),
+                self.metrics.register(Metric(prefix + 'pdu_queue_depth')),
+                self.metrics.register(Metric(prefix + 'throttled')))
+
     def esme_connected(self, client):
         log.msg("ESME Connected, adding handlers")
+        if client not in self.esme_clients:
+            self.esme_clients.append(client)
         self.esme_client = client
         # Start the consumer
         self.unpause_connectors()
 
+    def esme_disconnected(self):
+        log.msg("ESME Disconnected")
+        # A client's state is CLOSED by the time its factory tells us that
+        # the connection was lost.
+        for client in self.esme_clients[:]:
+            if client.state == 'CLOSED':
+                self.esme_clients.remove(client)
+                self.throttled_binds.discard(client)
+                self._cancel_bind_throttle_timer(client)
+        if not self._tx_binds():
+            self.pause_connectors()
+
+    def _tx_binds(self):
+        return [client for client in self.esme_clients
+                if client.state in ('BOUND_TX', 'BOUND_TRX')]
+
+    def choose_bind(self):
+        """Pick the bind to send the next message on.
+
+        Unthrottled binds are preferred over throttled ones, and of those the
+        bind with the most free space in its window is chosen.
+        """
+        binds = self._tx_binds()
+        candidates = [client for client in binds
+                      if client not in self.throttled_binds] or binds
+        if not candidates:
+            return self.esme_client
+        return max(candidates, key=lambda client: (
+            client.unacked_window.max_size - len(client.unacked_window)))
+
     @inlineCallbacks
     def handle_outbound_message(self, message):
         log.debug("Consumed outgoing message %r" % (message,))
-        log.debug("Unacknowledged message count: %s" % (
-                (yield self.esme_client.get_unacked_count()),))
-        yield self.r_set_message(message)
-        yield self._submit_outbound_message(message)
+        unacked_count = sum(client.get_unacked_count()
+                            for client in self.esme_clients)
+        log.debug("Unacknowledged message count: %s" % (unacked_count,))
+        self.unacked_metric.set(unacked_count)
+        # Redis handles commands in the order they're sent, so we don't need
+        # to wait for the message to be stored before submitting it.
+        stored = self.r_set_message(message)
+        try:
+            yield self._submit_outbound_message(message)
+        except Exception:
+            # Nothing will wait for the message to be stored now, so make
+            # sure any error storing it is logged.
+            stored.addErrback(log.err, "Error storing outbound message %r" % (
+                message['message_id'],))
+            raise
+        yield stored
 
     @inlineCallbacks
     def _submit_outbound_message(self, message):
@@ -199,9 +347,18 @@ class SmppTransport(Transport):
         yield self.r_set_id_for_sequence(
             sequence_number, message.payload.get("message_id"))
 
-    def esme_disconnected(self):
-        log.msg("ESME Disconnected")
-        self.pause_connectors()
+    def _sample_metrics(self, metrics):
+        # Values are sampled after each publish, for the next one.
+        self.pdu_queue_metric.set(sum(client.get_pdu_queue_depth()
+                                      for client in self.esme_clients))
+        for factory, bind_metrics in zip(self.factories, self.bind_metrics):
+            unacked, pdu_queue, throttled = bind_metrics
+            client = factory.esme
+            if client is None:
+                continue
+            unacked.set(client.get_unacked_count())
+            pdu_queue.set(client.get_pdu_queue_depth())
+            throttled.set(int(client in self.throttled_binds))
 
     # Redis message storing methods
 
@@ -210,8 +367,9 @@ class SmppTransport(Transport):
 
     def r_set_message(self, message):
         message_id = message.payload['message_id']
-        return self.redis.set(
-            self.r_message_key(message_id), message.to_json())
+        return self.redis.setex(
+            self.r_message_key(message_id), self.submit_sm_expiry,
+            message.to_json())
 
     def r_get_message_json(self, message_id):
         return self.redis.get(self.r_message_key(message_id))
@@ -236,7 +394,17 @@ class SmppTransport(Transport):
         return self.redis.delete(str(sequence_number))
 
     def r_set_id_for_sequence(self, sequence_number, id):
-        return self.redis.set(str(sequence_number), id)
+        return self.redis.setex(
+            str(sequence_number), self.submit_sm_expiry, id)
+
+    def r_pop_id_for_sequence(self, sequence_number, third_party_id):
+        """Fetch and delete the message id for a sequence number and map the
+        third party id to it.
+        """
+        return self.redis.run_script(
+            POP_ID_FOR_SEQUENCE,
+            [str(sequence_number), self.r_third_party_id_key(third_party_id)],
+            [self.third_party_id_expiry])
 
     # Redis 3rd party id to vumi id mapping
 
@@ -250,51 +418,86 @@ class SmppTransport(Transport):
         return self.redis.delete(
                 self.r_third_party_id_key(third_party_id))
 
-    @inlineCallbacks
     def r_set_id_for_third_party_id(self, third_party_id, id):
         rkey = self.r_third_party_id_key(third_party_id)
-        yield self.redis.set(rkey, id)
-        yield self.redis.expire(rkey, self.third_party_id_expiry)
-
-    def _start_throttling(self):
+        return self.redis.setex(rkey, self.third_party_id_expiry, id)
+
+    def _start_throttling(self, esme_client=None):
+        if esme_client is not None:
+            if esme_client not in self.throttled_binds:
+                log.msg("Throttling outbound messages on bind %r." % (
+                    esme_client,))
+                self.throttled_binds.add(esme_client)
+            self._start_bind_throttle_timer(esme_client)
         if self.throttled:
             return
+        if esme_client is not None and any(
+                client not in self.throttled_binds
+                for client in self._tx_binds()):
+            # Other binds can carry our messages for now.
+            return
         log.err("Throttling outbound messages.")
         self.throttled = True
         self.pause_connectors()
 
-    def _stop_throttling(self):
+    def _stop_throttling(self, esme_client=None):
+        if esme_client in self.throttled_binds:
+            log.msg("No longer throttling outbound messages on bind %r." % (
+                esme_client,))
+            self.throttled_binds.discard(esme_client)
+        self._cancel_bind_throttle_timer(esme_client)
         if not self.throttled:
             return
         log.err("No longer throttling outbound messages.")
         self.throttled = False
         self.unpause_connectors()
 
+    def _start_bind_throttle_timer(self, esme_client):
+        # A throttled bind gets no messages while other binds are healthy, so
+        # it won't see the response that would unthrottle it. We let it carry
+        # messages again once `throttle_delay` has passed instead.
+        timer = self.bind_throttle_timers.get(esme_client)
+        if timer is not None and timer.active():
+            timer.reset(self.throttle_delay)
+        else:
+            self.bind_throttle_timers[esme_client] = self.callLater(
+                self.throttle_delay, self._bind_throttle_expired, esme_client)
+
+    def _cancel_bind_throttle_timer(self, esme_client):
+        timer = self.bind_throttle_timers.pop(esme_client, None)
+        if timer is not None and timer.active():
+            timer.cancel()
+
+    def _bind_throttle_expired(self, esme_client):
+        self.bind_throttle_timers.pop(esme_client, None)
+        if esme_client in self.throttled_binds:
+            log.msg("Retrying outbound messages on throttled bind %r." % (
+                esme_client,))
+            self.throttled_binds.discard(esme_client)
+
     @inlineCallbacks
     def submit_sm_resp(self, *args, **kwargs):
         transport_msg_id = kwargs['message_id']
-        sent_sms_id = (
-            yield self.r_get_id_for_sequence(kwargs['sequence_number']))
+        esme_client = kwargs.get('esme_client')
+        sent_sms_id = yield self.r_pop_id_for_sequence(
+            kwargs['sequence_number'], transport_msg_id)
         if sent_sms_id is None:
             log.err("Sequence number lookup failed for:%s" % (
                 kwargs['sequence_number'],))
         else:
-            yield self.r_set_id_for_third_party_id(
-                transport_msg_id, sent_sms_id)
-            yield self.r_delete_for_sequence(kwargs['sequence_number'])
             status = kwargs['command_status']
             if status == 'ESME_ROK':
                 # The sms was submitted ok
                 yield self.submit_sm_success(sent_sms_id, transport_msg_id)
-                yield self._stop_throttling()
+                yield self._stop_throttling(esme_client)
             elif status == 'ESME_RTHROTTLED':
-                yield self._start_throttling()
+                yield self._start_throttling(esme_client)
                 yield self.submit_sm_throttled(sent_sms_id)
             else:
                 # We have an error
                 yield self.submit_sm_failure(sent_sms_id,
                                              status or 'Unspecified')
-                yield self._stop_throttling()
+                yield self._stop_throttling(esme_client)
 
     @inlineCallbacks
     def submit_sm_success(self, sent_sms_id, transport_msg_id):
@@ -395,7 +598,7 @@ class SmppTransport(Transport):
         #       better.
         return self.publish_message(**message).addErrback(log.err)
 
-    def send_smpp(self, message):
+    def send_smpp(self, message, esme_client=None):
         log.debug("Sending SMPP message: %s" % (message))
         # first do a lookup in our YAML to see if we've got a source_addr
         # defined for the given MT number, if not, trust the from_addr
@@ -409,7 +612,9 @@ class SmppTransport(Transport):
                 self.config.get('COUNTRY_CODE', ''),
                 self.config.get('OPERATOR_PREFIX', {}),
                 self.config.get('OPERATOR_NUMBER', {})) or from_addr
-        return self.esme_client.submit_sm(
+        if esme_client is None:
+            esme_client = self.choose_bind()
+        return esme_client.submit_sm(
                 short_message=text.encode('utf-8'),
                 destination_addr=str(to_addr),
                 source_addr=route,
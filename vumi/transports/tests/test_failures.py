@@ -1,6 +1,7 @@
 import time
+import gzip
 import json
-from datetime import datetime, timedelta
+import calendar
 
 from twisted.trial import unittest
 from twisted.internet.defer import inlineCallbacks
@@ -9,11 +10,6 @@ from vumi.tests.utils import get_stubbed_worker, PersistenceMixin
 from vumi.transports.failures import FailureWorker
 
 
-def mktimestamp(delta=0):
-    timestamp = datetime.utcnow() + timedelta(seconds=delta)
-    return timestamp.isoformat().split('.')[0]
-
-
 class FailureWorkerTestCase(unittest.TestCase, PersistenceMixin):
 
     timeout = 5
@@ -28,26 +24,22 @@ class FailureWorkerTestCase(unittest.TestCase, PersistenceMixin):
         yield self._persist_tearDown()
 
     @inlineCallbacks
-    def make_worker(self, retry_delivery_period=0):
-        self.config = self.mk_config({
+    def make_worker(self, retry_delivery_period=0, **config):
+        self.config = self.mk_config(dict({
                 'transport_name': 'sphex',
                 'retry_routing_key': 'sms.outbound.%(transport_name)s',
                 'failures_routing_key': 'sms.failures.%(transport_name)s',
                 'retry_delivery_period': retry_delivery_period,
-                })
+                }, **config))
         self.worker = get_stubbed_worker(FailureWorker, self.config)
         yield self.worker.startWorker()
         self.redis = self.worker.redis
         yield self.redis._purge_all()  # Just in case
         self.broker = self.worker._amqp_client.broker
 
-    def assert_write_timestamp(self, expected, delta, now):
-        self.assertEqual(expected,
-                         self.worker.get_next_write_timestamp(delta, now=now))
-
     @inlineCallbacks
-    def assert_zcard(self, expected, key):
-        self.assertEqual(expected, (yield self.redis.zcard(key)))
+    def assert_queued_retries(self, expected):
+        self.assertEqual(expected, (yield self.worker.retry_queue.count()))
 
     @inlineCallbacks
     def assert_equal_d(self, expected, value):
@@ -58,17 +50,15 @@ class FailureWorkerTestCase(unittest.TestCase, PersistenceMixin):
         self.assertNotEqual((yield expected), (yield value))
 
     @inlineCallbacks
-    def assert_get_retry_key(self, exists=True):
-        retry_key = yield self.worker.get_next_retry_key()
-        if exists:
-            self.assertNotEqual(None, retry_key)
-        else:
-            self.assertEqual(None, retry_key)
+    def assert_claimed_retries(self, expected):
+        retry_keys = yield self.worker.claim_retry_keys()
+        self.assertEqual(expected, len(retry_keys))
 
     @inlineCallbacks
-    def assert_stored_timestamps(self, *expected):
-        timestamps = yield self.redis.zrange('retry_timestamps', 0, -1)
-        self.assertEqual(list(expected), timestamps)
+    def assert_failure_keys(self, expected):
+        cursor, keys = yield self.worker.get_failure_keys()
+        self.assertEqual(None, cursor)
+        self.assertEqual(sorted(expected), sorted(keys))
 
     def assert_published_retries(self, expected):
         msgs = self.broker.get_dispatched('vumi', 'sms.outbound.sphex')
@@ -110,7 +100,7 @@ class FailureWorkerTestCase(unittest.TestCase, PersistenceMixin):
         Store a failure in redis and make sure we can get at it again.
         """
         key = yield self.store_failure(reason="reason")
-        yield self.assert_equal_d(set([key]), self.worker.get_failure_keys())
+        yield self.assert_failure_keys([key])
         message_json = json.dumps({"message": "foo", "reason": "reason"})
         yield self.assert_equal_d({
                 "message": message_json,
@@ -120,8 +110,7 @@ class FailureWorkerTestCase(unittest.TestCase, PersistenceMixin):
         # Test a second one, this time with a JSON-encoded message
         key2 = yield self.store_failure(
             message=json.dumps({"foo": "bar"}), reason="reason")
-        yield self.assert_equal_d(
-            set([key, key2]), self.worker.get_failure_keys())
+        yield self.assert_failure_keys([key, key2])
         message_json = json.dumps({"foo": "bar"})
         yield self.assert_equal_d({
                 "message": message_json,
@@ -129,168 +118,69 @@ class FailureWorkerTestCase(unittest.TestCase, PersistenceMixin):
                 "reason": "reason",
                 }, self.redis.hgetall(key2))
 
-    def test_write_timestamp(self):
-        """
-        We need granular timestamps.
-        """
-        start = datetime.utcnow().isoformat()
-        timestamp = self.worker.get_next_write_timestamp(0)
-        end = (datetime.utcnow() + timedelta(seconds=6)).isoformat()
-        self.assertTrue(start < timestamp < end)
-
-        self.assert_write_timestamp("1970-01-01T00:00:05", 0, 0)
-        self.assert_write_timestamp("1970-01-01T00:00:05", 0, 4)
-        self.assert_write_timestamp("1970-01-01T00:00:10", 0, 5)
-        self.assert_write_timestamp("1970-01-01T00:00:10", 0, 9)
-
-        self.assert_write_timestamp("1970-01-01T00:00:05", 2, 0)
-        self.assert_write_timestamp("1970-01-01T00:00:10", 2, 4)
-        self.assert_write_timestamp("1970-01-01T00:00:10", 2, 5)
-        self.assert_write_timestamp("1970-01-01T00:00:15", 2, 9)
-
-        self.assert_write_timestamp("1970-01-01T00:03:25", 101, 100)
-        self.assert_write_timestamp("1970-01-01T00:03:30", 101, 104)
-        self.assert_write_timestamp("1970-01-01T00:03:30", 101, 105)
-        self.assert_write_timestamp("1970-01-01T00:03:35", 101, 109)
-
-    def test_write_timestamp_granularity(self):
-        """
-        We need granular timestamps with assorted granularity.
-        """
-        self.worker.GRANULARITY = 10
-        self.assert_write_timestamp("1970-01-01T00:00:10", 0, 0)
-        self.assert_write_timestamp("1970-01-01T00:00:10", 0, 4)
-        self.assert_write_timestamp("1970-01-01T00:00:10", 0, 5)
-        self.assert_write_timestamp("1970-01-01T00:00:10", 0, 9)
-        self.assert_write_timestamp("1970-01-01T00:00:20", 0, 11)
-
-        self.assert_write_timestamp("1970-01-01T00:00:20", 12, 0)
-        self.assert_write_timestamp("1970-01-01T00:00:20", 12, 4)
-        self.assert_write_timestamp("1970-01-01T00:00:20", 12, 5)
-        self.assert_write_timestamp("1970-01-01T00:00:30", 12, 9)
-        self.assert_write_timestamp("1970-01-01T00:00:30", 12, 11)
-
-        self.worker.GRANULARITY = 3
-        self.assert_write_timestamp("1970-01-01T00:00:03", 0, 0)
-        self.assert_write_timestamp("1970-01-01T00:00:06", 0, 4)
-        self.assert_write_timestamp("1970-01-01T00:00:06", 0, 5)
-        self.assert_write_timestamp("1970-01-01T00:00:12", 0, 9)
-        self.assert_write_timestamp("1970-01-01T00:00:12", 0, 11)
-
-        self.assert_write_timestamp("1970-01-01T00:00:15", 12, 0)
-        self.assert_write_timestamp("1970-01-01T00:00:18", 12, 4)
-        self.assert_write_timestamp("1970-01-01T00:00:18", 12, 5)
-        self.assert_write_timestamp("1970-01-01T00:00:24", 12, 9)
-        self.assert_write_timestamp("1970-01-01T00:00:24", 12, 11)
-
-    @inlineCallbacks
-    def test_store_read_timestamp(self):
-        """
-        We need to store granular timestamps.
-        """
-        timestamp1 = "1977-07-28T12:34:56"
-        timestamp2 = "1980-07-30T12:34:56"
-        timestamp3 = "1980-09-02T12:34:56"
-        yield self.assert_stored_timestamps()
-        yield self.worker.store_read_timestamp(timestamp2)
-        yield self.assert_stored_timestamps(timestamp2)
-        yield self.worker.store_read_timestamp(timestamp1)
-        yield self.assert_stored_timestamps(timestamp1, timestamp2)
-        yield self.worker.store_read_timestamp(timestamp3)
-        yield self.assert_stored_timestamps(timestamp1, timestamp2, timestamp3)
-
-    @inlineCallbacks
-    def test_read_timestamp(self):
-        """
-        We need to read the next timestamp.
-        """
-        past = mktimestamp(-10)
-        future = mktimestamp(10)
-        yield self.assert_equal_d(None, self.worker.get_next_read_timestamp())
-        yield self.worker.store_read_timestamp(future)
-        yield self.assert_equal_d(None, self.worker.get_next_read_timestamp())
-        yield self.worker.store_read_timestamp(past)
-        yield self.assert_equal_d(past, self.worker.get_next_read_timestamp())
-
     @inlineCallbacks
     def test_store_retry(self):
         """
         Store a retry in redis and make sure we can get at it again.
         """
-        timestamp = "1970-01-01T00:00:05"
-        retry_key = "retry_keys." + timestamp
         key = yield self.store_failure()
-        yield self.assert_zcard(0, 'retry_timestamps')
+        yield self.assert_queued_retries(0)
 
-        yield self.worker.store_retry(key, 0, now=0)
-        yield self.assert_zcard(1, 'retry_timestamps')
-        yield self.assert_equal_d([timestamp],
-                                  self.redis.zrange('retry_timestamps', 0, 0))
-        yield self.assert_equal_d(set([key]), self.redis.smembers(retry_key))
+        yield self.worker.store_retry(key, 5, now=0)
+        yield self.assert_queued_retries(1)
+        yield self.assert_equal_d(
+            5, self.worker.retry_queue.get_due_time(key))
 
-    def test_get_retry_key_none(self):
+    def test_claim_retry_keys_none(self):
         """
-        If there are no stored retries, get None.
+        If there are no stored retries, claim nothing.
         """
-        return self.assert_get_retry_key(False)
+        return self.assert_claimed_retries(0)
 
     @inlineCallbacks
-    def test_get_retry_key_future(self):
+    def test_claim_retry_keys_future(self):
         """
-        If there are no retries due, get None.
+        If there are no retries due, claim nothing.
         """
         yield self.store_retry(10)
-        yield self.assert_zcard(1, 'retry_timestamps')
-        yield self.assert_get_retry_key(False)
-        yield self.assert_zcard(1, 'retry_timestamps')
-
-    @inlineCallbacks
-    def test_get_retry_key_one_due(self):
-        """
-        Get a retry from redis when we have one due.
-        """
-        yield self.store_retry(0, -5)
-        yield self.assert_zcard(1, 'retry_timestamps')
-        yield self.assert_get_retry_key()
-        yield self.assert_zcard(0, 'retry_timestamps')
-        yield self.assert_get_retry_key(False)
+        yield self.assert_claimed_retries(0)
+        yield self.assert_queued_retries(1)
 
     @inlineCallbacks
-    def test_get_retry_key_two_due(self):
+    def test_claim_retry_keys_one_due(self):
         """
-        Get a retry from redis when we have two due.
+        Claim a retry from redis when we have one due.
         """
         yield self.store_retry(0, -5)
-        yield self.store_retry(0, -5)
-        yield self.assert_zcard(1, 'retry_timestamps')
-        yield self.assert_get_retry_key()
-        yield self.assert_zcard(1, 'retry_timestamps')
+        yield self.assert_claimed_retries(1)
+        # The retry stays queued until it's been delivered, but it isn't
+        # claimed again in the meantime.
+        yield self.assert_queued_retries(1)
+        yield self.assert_claimed_retries(0)
 
     @inlineCallbacks
-    def test_get_retry_key_two_due_different_times(self):
+    def test_claim_retry_keys_many_due(self):
         """
-        Get a retry from redis when we have two due at different times.
+        Claim all due retries from redis at once.
         """
         yield self.store_retry(0, -5)
         yield self.store_retry(0, -15)
-        yield self.assert_zcard(2, 'retry_timestamps')
-        yield self.assert_get_retry_key()
-        yield self.assert_zcard(1, 'retry_timestamps')
-        yield self.assert_get_retry_key()
-        yield self.assert_zcard(0, 'retry_timestamps')
+        yield self.store_retry(0, -5)
+        yield self.store_retry(10)
+        yield self.assert_claimed_retries(3)
+        yield self.assert_claimed_retries(0)
 
     @inlineCallbacks
-    def test_get_retry_key_one_due_one_future(self):
+    def test_claimed_retry_keys_are_claimed_again(self):
         """
-        Get a retry from redis when we have one due and one in the future.
+        A claimed retry that isn't delivered is claimed again after the
+        visibility timeout.
         """
         yield self.store_retry(0, -5)
-        yield self.worker.store_retry(self.store_failure(), 0)
-        yield self.assert_zcard(2, 'retry_timestamps')
-        yield self.assert_get_retry_key()
-        yield self.assert_zcard(1, 'retry_timestamps')
-        yield self.assert_get_retry_key(False)
-        yield self.assert_zcard(1, 'retry_timestamps')
+        yield self.assert_claimed_retries(1)
+        retry_keys = yield self.worker.claim_retry_keys(
+            now=time.time() + self.worker.VISIBILITY_TIMEOUT + 1)
+        self.assertEqual(1, len(retry_keys))
 
     @inlineCallbacks
     def test_deliver_retries_none(self):
@@ -305,7 +195,7 @@ class FailureWorkerTestCase(unittest.TestCase, PersistenceMixin):
         """
         Delivering no current retries should do nothing.
         """
-        yield self.worker.store_retry(self.store_failure(), 0)
+        yield self.store_retry(10)
         yield self.worker.deliver_retries()
         self.assert_published_retries([])
 
@@ -334,6 +224,78 @@ class FailureWorkerTestCase(unittest.TestCase, PersistenceMixin):
                     'message': 'foo',
                     'reason': 'bad stuff happened',
                     }] * 3)
+        yield self.assert_queued_retries(0)
+
+    @inlineCallbacks
+    def test_deliver_retries_in_batches(self):
+        """
+        Delivering more retries than fit in one claim should deliver all
+        messages.
+        """
+        self.worker.retry_queue.claim_limit = 2
+        for i in range(5):
+            yield self.store_retry(0, -5)
+        yield self.worker.deliver_retries()
+        self.assert_published_retries([{
+                    'message': 'foo',
+                    'reason': 'bad stuff happened',
+                    }] * 5)
+        yield self.assert_queued_retries(0)
+
+    @inlineCallbacks
+    def test_deliver_retries_publish_error(self):
+        """
+        A retry that fails to publish should stay queued without stopping
+        the rest of its batch from being acked.
+        """
+        yield self.store_retry(0, -5, message_json={'message': 'bad'})
+        yield self.store_retry(0, -5)
+        publisher = self.worker.retry_publisher
+        publish_raw = publisher.publish_raw
+
+        def publish_or_fail(data):
+            if json.loads(data)['message'] == 'bad':
+                raise ValueError("Publish failed.")
+            return publish_raw(data)
+
+        self.patch(publisher, 'publish_raw', publish_or_fail)
+        yield self.worker.deliver_retries()
+        self.assertEqual(1, len(self.flushLoggedErrors(ValueError)))
+        self.assert_published_retries([{
+                    'message': 'foo',
+                    'reason': 'bad stuff happened',
+                    }])
+        yield self.assert_queued_retries(1)
+        yield self.assert_claimed_retries(0)
+
+    @inlineCallbacks
+    def test_migrate_old_retries(self):
+        """
+        Retries stored in the time buckets used by older versions should be
+        moved into the retry queue.
+        """
+        due_key = yield self.store_failure()
+        future_key = yield self.store_failure()
+        for key, timestamp in [(due_key, "2012-01-01T00:00:00"),
+                               (future_key, "2037-01-01T00:00:00")]:
+            yield self.redis.sadd("retry_keys." + timestamp, key)
+            yield self.redis.zadd("retry_timestamps", **{timestamp: 0})
+        yield self.assert_equal_d(2, self.worker.migrate_old_retries())
+        yield self.assert_equal_d(
+            False, self.redis.exists("retry_timestamps"))
+        yield self.assert_equal_d(
+            False, self.redis.exists("retry_keys.2012-01-01T00:00:00"))
+        yield self.assert_equal_d(
+            calendar.timegm((2037, 1, 1, 0, 0, 0)),
+            self.worker.retry_queue.get_due_time(future_key))
+        yield self.assert_queued_retries(2)
+
+        yield self.worker.deliver_retries()
+        self.assert_published_retries([{
+                    'message': 'foo',
+                    'reason': 'bad stuff happened',
+                    }])
+        yield self.assert_queued_retries(1)
 
     def test_update_retry_metadata(self):
         """
@@ -362,3 +324,131 @@ class FailureWorkerTestCase(unittest.TestCase, PersistenceMixin):
         self.assertEqual(self.worker.deliver_retries,
                          self.worker.delivery_loop.f)
         self.assertTrue(self.worker.delivery_loop.running)
+
+    @inlineCallbacks
+    def test_get_failure_keys_paged(self):
+        """
+        Failure keys should be returned a page at a time, oldest first.
+        """
+        keys = []
+        for i in range(5):
+            keys.append((yield self.store_failure()))
+        # Give some keys the same score to check that none are skipped.
+        yield self.redis.zadd(self.worker.FAILURE_INDEX_KEY, **{
+            keys[1]: 1, keys[2]: 1, keys[3]: 1, keys[4]: 2})
+        yield self.redis.zadd(self.worker.FAILURE_INDEX_KEY, **{keys[0]: 0})
+
+        # Keys with the same score are ordered by key.
+        keys[1:4] = sorted(keys[1:4])
+
+        cursor, page1 = yield self.worker.get_failure_keys(limit=2)
+        self.assertEqual(keys[:2], page1)
+        cursor, page2 = yield self.worker.get_failure_keys(cursor, limit=2)
+        self.assertEqual(keys[2:4], page2)
+        cursor, page3 = yield self.worker.get_failure_keys(cursor, limit=2)
+        self.assertEqual(keys[4:], page3)
+        self.assertEqual(None, cursor)
+
+    @inlineCallbacks
+    def test_failure_counts(self):
+        """
+        Failures should be counted by reason.
+        """
+        yield self.assert_equal_d({}, self.worker.get_failure_counts())
+        yield self.store_failure(reason="reason1")
+        yield self.store_retry(10, reason="reason2")
+        yield self.store_failure(reason="reason1")
+        yield self.assert_equal_d({"reason1": 2, "reason2": 1},
+                                  self.worker.get_failure_counts())
+
+    @inlineCallbacks
+    def test_retention(self):
+        """
+        Permanent failures should expire once the retention period is set.
+        Failures waiting to be retried should not.
+        """
+        yield self.worker.stopWorker()
+        yield self.make_worker(failure_retention=100)
+        key = yield self.store_failure()
+        retry_key = yield self.worker.store_failure(
+            {'message': 'foo'}, "reason", retry_delay=10)
+        self.assertTrue(0 < (yield self.redis.ttl(key)) <= 100)
+        self.assertFalse((yield self.redis.ttl(retry_key)) > 0)
+
+        yield self.worker.store_retry(retry_key, 0, now=time.time() - 5)
+        yield self.worker.deliver_retries()
+        self.assertTrue(0 < (yield self.redis.ttl(retry_key)) <= 100)
+
+    @inlineCallbacks
+    def test_deliver_expired_retry(self):
+        """
+        A retry whose failure has expired should be dropped.
+        """
+        yield self.store_retry(0, -5)
+        cursor, [key] = yield self.worker.get_failure_keys()
+        yield self.redis.delete(key)
+        yield self.worker.deliver_retries()
+        self.assert_published_retries([])
+        yield self.assert_queued_retries(0)
+
+    @inlineCallbacks
+    def test_compact_failures(self):
+        """
+        Compaction should remove failures older than the retention period.
+        """
+        self.worker.RETENTION = 100
+        old_key = yield self.store_failure()
+        new_key = yield self.store_failure()
+        now = time.time()
+        yield self.redis.zadd(self.worker.FAILURE_INDEX_KEY, **{
+            old_key: now - 200})
+        yield self.assert_equal_d(1, self.worker.compact_failures(now))
+        yield self.assert_failure_keys([new_key])
+        yield self.assert_equal_d({}, self.worker.get_failure(old_key))
+        yield self.assert_equal_d(
+            {"bad stuff happened": 2}, self.worker.get_failure_counts())
+
+    @inlineCallbacks
+    def test_compact_failures_archive(self):
+        """
+        Compaction should archive failures before removing them if an
+        archive path is set.
+        """
+        yield self.worker.stopWorker()
+        yield self.make_worker(failure_retention=100,
+                               failure_archive_path=self.mktemp())
+        keys = []
+        for reason in ["reason1", "reason2"]:
+            keys.append((yield self.store_failure(reason=reason)))
+        retry_key = yield self.worker.store_failure(
+            {'message': 'foo'}, "reason3", retry_delay=10)
+        yield self.worker.store_retry(retry_key, 0, now=time.time() - 5)
+        yield self.worker.deliver_retries()
+        for key in keys + [retry_key]:
+            self.assertFalse((yield self.redis.ttl(key)) > 0)
+
+        yield self.assert_equal_d(3, self.worker.compact_failures(
+            time.time() + 200))
+        yield self.assert_failure_keys([])
+        for key in keys + [retry_key]:
+            yield self.assert_equal_d({}, self.worker.get_failure(key))
+
+        archive = gzip.open(self.worker.ARCHIVE_PATH)
+        archived = [json.loads(line) for line in archive]
+        archive.close()
+        self.assertEqual(
+            sorted([(keys[0], "reason1"), (keys[1], "reason2"),
+                    (retry_key, "reason3")]),
+            sorted([(f['key'], f['reason']) for f in archived]))
+
+    @inlineCallbacks
+    def test_start_compaction(self):
+        """
+        Compaction should only run periodically if retention is set.
+        """
+        self.assertEqual(None, self.worker.compaction_loop)
+        yield self.worker.stopWorker()
+        yield self.make_worker(failure_retention=100)
+        self.assertEqual(self.worker.compact_failures,
+                         self.worker.compaction_loop.f)
+        self.assertTrue(self.worker.compaction_loop.running)
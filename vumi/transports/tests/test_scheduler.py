@@ -1,25 +1,30 @@
 import time
+import json
+import calendar
 from datetime import datetime
 
 from twisted.internet.defer import inlineCallbacks
 from twisted.trial.unittest import TestCase
 
-from vumi.persist.fake_redis import FakeRedis
 from vumi.transports.scheduler import Scheduler
 from vumi.message import TransportUserMessage
 from vumi.utils import to_kwargs
+from vumi.tests.utils import PersistenceMixin
 
 
-class SchedulerTestCase(TestCase):
+class SchedulerTestCase(TestCase, PersistenceMixin):
 
+    @inlineCallbacks
     def setUp(self):
-        self.r_server = FakeRedis()
+        self._persist_setUp()
+        self.r_server = yield self.get_redis_manager()
         self.scheduler = Scheduler(self.r_server, self._scheduler_callback)
         self._delivery_history = []
 
     def tearDown(self):
         if self.scheduler.is_running:
             self.scheduler.stop()
+        return self._persist_tearDown()
 
     def _scheduler_callback(self, scheduled_at, message):
         self._delivery_history.append((scheduled_at, message))
@@ -34,10 +39,6 @@ class SchedulerTestCase(TestCase):
     def assertNumDelivered(self, number):
         self.assertEqual(number, len(self._delivery_history))
 
-    def get_pending_messages(self):
-        scheduled_timestamps = self.scheduler.r_key('scheduled_timestamps')
-        return self.r_server.zrange(scheduled_timestamps, 0, -1)
-
     def mkmsg_in(self, content='hello world', message_id='abc',
                  to_addr='9292', from_addr='+41791234567',
                  session_event=None, transport_type='sms',
@@ -56,32 +57,33 @@ class SchedulerTestCase(TestCase):
             timestamp=datetime.now(),
             )
 
+    @inlineCallbacks
+    def assert_scheduled_keys(self, keys):
+        self.assertEqual(set(keys),
+                         (yield self.scheduler.get_all_scheduled_keys()))
+
+    @inlineCallbacks
     def test_scheduling(self):
         msg = self.mkmsg_in()
         now = time.mktime(datetime(2012, 1, 1).timetuple())
         delta = 10  # seconds from now
-        key, bucket_key = self.scheduler.schedule(delta, msg.payload, now)
-        self.assertEqual(bucket_key, '%s#%s.%s' % (
-            self.scheduler.r_prefix,
-            'scheduled_keys',
-            self.scheduler.get_next_write_timestamp(delta, now)
-        ))
-        scheduled_key = self.scheduler.get_scheduled_key(now)
-        self.assertEqual(scheduled_key, None)
-        scheduled_time = now + delta
-        scheduled_key = self.scheduler.get_scheduled_key(scheduled_time)
-        self.assertTrue(scheduled_key)
-        self.assertEqual(set([scheduled_key]),
-                        self.scheduler.get_all_scheduled_keys())
+        key = yield self.scheduler.schedule(delta, msg.payload, now)
+        self.assertEqual((yield self.scheduler.queue.get_due_time(key)),
+                         now + delta)
+        yield self.scheduler.deliver_scheduled(now)
+        self.assertNumDelivered(0)
+        yield self.assert_scheduled_keys([key])
+        scheduled = yield self.scheduler.get_scheduled(key)
+        self.assertEqual(json.loads(scheduled['payload']),
+                         json.loads(msg.to_json()))
 
     @inlineCallbacks
     def test_delivery_loop(self):
         msg = self.mkmsg_in()
         now = time.mktime(datetime(2012, 1, 1).timetuple())
         delta = 16  # seconds from now
-        self.scheduler.schedule(delta, msg.payload, now)
-        scheduled_time = now + delta + self.scheduler.granularity
-        yield self.scheduler.deliver_scheduled(scheduled_time)
+        yield self.scheduler.schedule(delta, msg.payload, now)
+        yield self.scheduler.deliver_scheduled(now + delta)
         self.assertDelivered(msg)
 
     @inlineCallbacks
@@ -90,13 +92,11 @@ class SchedulerTestCase(TestCase):
         for i in range(0, 3):
             msg = self.mkmsg_in(message_id='message_%s' % (i,))
             delta = i * 10
-            key, _ = self.scheduler.schedule(delta, msg.payload, now)
-            scheduled_time = now + delta + self.scheduler.granularity
-            self.assertEqual(set([key]),
-                self.scheduler.get_all_scheduled_keys())
-            yield self.scheduler.deliver_scheduled(scheduled_time)
+            key = yield self.scheduler.schedule(delta, msg.payload, now)
+            yield self.assert_scheduled_keys([key])
+            yield self.scheduler.deliver_scheduled(now + delta)
             self.assertNumDelivered(i + 1)
-            self.assertEqual(set(), self.scheduler.get_all_scheduled_keys())
+            yield self.assert_scheduled_keys([])
 
     @inlineCallbacks
     def test_deliver_ancient_messages(self):
@@ -104,30 +104,85 @@ class SchedulerTestCase(TestCase):
         # been running since 1912
         msg = self.mkmsg_in()
         way_back = time.mktime(datetime(1912, 1, 1).timetuple())
-        scheduled_key, _ = self.scheduler.schedule(0, msg.payload, way_back)
+        scheduled_key = yield self.scheduler.schedule(
+            0, msg.payload, way_back)
         self.assertTrue(scheduled_key)
-        now = time.mktime(datetime.now().timetuple())
+        yield self.scheduler.deliver_scheduled()
+        self.assertDelivered(msg)
+        yield self.assert_scheduled_keys([])
+
+    @inlineCallbacks
+    def test_deliver_in_batches(self):
+        self.scheduler.queue.claim_limit = 2
+        now = time.mktime(datetime(2012, 1, 1).timetuple())
+        for i in range(5):
+            msg = self.mkmsg_in(message_id='message_%s' % (i,))
+            yield self.scheduler.schedule(i, msg.payload, now)
+        yield self.scheduler.deliver_scheduled(now + 10)
+        self.assertNumDelivered(5)
+        yield self.assert_scheduled_keys([])
+
+    @inlineCallbacks
+    def test_failed_delivery_is_retried(self):
+        msg = self.mkmsg_in()
+        now = time.mktime(datetime(2012, 1, 1).timetuple())
+        yield self.scheduler.schedule(0, msg.payload, now)
+        self.scheduler.callback = lambda scheduled_at, message: 1 / 0
+        yield self.assertFailure(self.scheduler.deliver_scheduled(now),
+                                 ZeroDivisionError)
+        self.scheduler.callback = self._scheduler_callback
         yield self.scheduler.deliver_scheduled(now)
-        self.assertEqual(set([scheduled_key]),
-            self.scheduler.get_all_scheduled_keys())
-        self.assertEqual(len(self.get_pending_messages()), 1)
+        self.assertNumDelivered(0)
         yield self.scheduler.deliver_scheduled(
-            way_back + self.scheduler.granularity)
+            now + self.scheduler.queue.visibility_timeout)
         self.assertDelivered(msg)
-        self.assertEqual(self.get_pending_messages(), [])
-        self.assertEqual(set(), self.scheduler.get_all_scheduled_keys())
+        yield self.assert_scheduled_keys([])
 
     @inlineCallbacks
     def test_clear_scheduled_messages(self):
         msg = self.mkmsg_in()
         now = time.mktime(datetime.now().timetuple())
-        scheduled_time = now + self.scheduler.granularity
-        key, bucket = self.scheduler.schedule(0, msg.payload, scheduled_time)
-        self.assertEqual(len(self.get_pending_messages()), 1)
-        self.assertEqual(set([key]),
-            self.scheduler.get_all_scheduled_keys())
-        self.scheduler.clear_scheduled(key)
+        key = yield self.scheduler.schedule(0, msg.payload, now)
+        yield self.assert_scheduled_keys([key])
+        yield self.scheduler.clear_scheduled(key)
         yield self.scheduler.deliver_scheduled()
-        self.assertEqual(self.r_server.hgetall(key), {})
-        self.assertEqual(self.r_server.smembers(bucket), set())
+        self.assertEqual((yield self.scheduler.get_scheduled(key)), {})
+        yield self.assert_scheduled_keys([])
+        self.assertNumDelivered(0)
+
+    @inlineCallbacks
+    def test_migrate_old_scheduled(self):
+        msg = self.mkmsg_in()
+        old_key = "scheduler#scheduled.2012-01-01T00:00:00.abc"
+        bucket_key = "scheduler#scheduled_keys.2012-01-01T00:00:10"
+        yield self.r_server.hmset(old_key, {
+            'payload': msg.to_json(),
+            'scheduled_at': '2012-01-01T00:00:00',
+            'bucket_key': bucket_key,
+        })
+        yield self.r_server.sadd("scheduler#scheduled_keys", old_key)
+        yield self.r_server.sadd(bucket_key, old_key)
+        yield self.r_server.zadd("scheduler#scheduled_timestamps", **{
+            "2012-01-01T00:00:10": 0})
+
+        due = calendar.timegm((2012, 1, 1, 0, 0, 10))
+        yield self.scheduler.deliver_scheduled(due - 1)
         self.assertNumDelivered(0)
+        yield self.assert_scheduled_keys(["scheduled.2012-01-01T00:00:00.abc"])
+        for key in [old_key, bucket_key, "scheduler#scheduled_keys",
+                    "scheduler#scheduled_timestamps"]:
+            self.assertFalse((yield self.r_server.exists(key)))
+
+        yield self.scheduler.deliver_scheduled(due)
+        self.assertDelivered(msg)
+        self.assertEqual('2012-01-01T00:00:00', self._delivery_history[0][0])
+        yield self.assert_scheduled_keys([])
+
+    @inlineCallbacks
+    def test_from_redis_config(self):
+        scheduler = yield Scheduler.from_redis_config(
+            self._persist_config['redis_manager'], self._scheduler_callback,
+            prefix='other')
+        self.addCleanup(scheduler.r_server.close_manager)
+        self.assertEqual(scheduler.r_prefix, 'other')
+        self.assertEqual(scheduler.callback, self._scheduler_callback)
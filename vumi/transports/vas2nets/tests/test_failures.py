@@ -114,12 +114,8 @@ class Vas2NetsFailureWorkerTestCase(unittest.TestCase, PersistenceMixin):
 
     @inlineCallbacks
     def get_retry_keys(self):
-        timestamps = yield self.redis.zrange('retry_timestamps', 0, 0)
-        retry_keys = set()
-        for timestamp in timestamps:
-            bucket_key = "retry_keys." + timestamp
-            retry_keys.update((yield self.redis.smembers(bucket_key)))
-        returnValue(retry_keys)
+        retry_keys = yield self.fail_worker.retry_queue.get_item_ids()
+        returnValue(set(retry_keys))
 
     def mkmsg_out(self, in_reply_to=None):
         return TransportUserMessage(
@@ -175,7 +171,7 @@ class Vas2NetsFailureWorkerTestCase(unittest.TestCase, PersistenceMixin):
             "No SmsId Header" in nack['nack_reason'])
 
         yield self.broker.kick_delivery()
-        [key] = yield self.fail_worker.get_failure_keys()
+        _cursor, [key] = yield self.fail_worker.get_failure_keys()
         self.assertEqual(set(), (yield self.get_retry_keys()))
 
     @inlineCallbacks
@@ -202,5 +198,5 @@ class Vas2NetsFailureWorkerTestCase(unittest.TestCase, PersistenceMixin):
         self.assertTrue(fmsg['reason'].strip().endswith("connection refused"))
 
         yield self.broker.kick_delivery()
-        [key] = yield self.fail_worker.get_failure_keys()
+        _cursor, [key] = yield self.fail_worker.get_failure_keys()
         self.assertEqual(set([key]), (yield self.get_retry_keys()))
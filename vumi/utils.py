@@ -382,6 +382,80 @@ def safe_routing_key(routing_key):
 def generate_worker_id(system_id, worker_id):
     return "%s:%s" % (system_id, worker_id,)
 
+
+class LRUCache(object):
+    """
+    A dictionary-like cache that holds at most `max_size` items. Adding an
+    item to a full cache evicts the least recently used one.
+
+    >>> cache = LRUCache(2)
+    >>> cache['a'] = 1
+    >>> cache['b'] = 2
+    >>> cache.get('a')
+    1
+    >>> cache['c'] = 3
+    >>> 'b' in cache
+    False
+    >>>
+
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        # Each item is a [prev, next, key, value] link in a circular list,
+        # ordered from least to most recently used. OrderedDict would do
+        # this for us, but we still support Python 2.6.
+        self._items = {}
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None]
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def _unlink(self, link):
+        link_prev, link_next = link[0], link[1]
+        link_prev[1] = link_next
+        link_next[0] = link_prev
+
+    def _append(self, link):
+        last = self._root[0]
+        link[0], link[1] = last, self._root
+        last[1] = self._root[0] = link
+
+    def get(self, key, default=None):
+        link = self._items.get(key)
+        if link is None:
+            return default
+        self._unlink(link)
+        self._append(link)
+        return link[3]
+
+    def __setitem__(self, key, value):
+        link = self._items.get(key)
+        if link is not None:
+            self._unlink(link)
+        link = self._items[key] = [None, None, key, value]
+        self._append(link)
+        while len(self._items) > self.max_size:
+            oldest = self._root[1]
+            self._unlink(oldest)
+            del self._items[oldest[2]]
+
+    def pop(self, key, default=None):
+        link = self._items.pop(key, None)
+        if link is None:
+            return default
+        self._unlink(link)
+        return link[3]
+
+    def clear(self):
+        self._items.clear()
+        self._root[:] = [self._root, self._root, None, None]
+
+
 ### SAMPLE CONFIG PARAMETERS - REPLACE 'x's IN OPERATOR_NUMBER
 
 """
@@ -33,6 +33,23 @@ class BaseConfig(Config):
         "The number of messages fetched concurrently from each AMQP queue"
         " by each worker instance.",
         default=20, static=True)
+    amqp_consumer_concurrency = ConfigInt(
+        "The maximum number of messages from each AMQP queue processed"
+        " concurrently by each worker instance. This is limited to"
+        " `amqp_prefetch_count`. The default processes messages one at a"
+        " time, in order.",
+        default=1, static=True)
+    amqp_ack_batch_size = ConfigInt(
+        "The number of processed messages from each AMQP queue to acknowledge"
+        " together. Outstanding acknowledgements are always sent when no"
+        " messages are being processed. This is limited to"
+        " `amqp_prefetch_count`.",
+        default=1, static=True)
+    amqp_max_outstanding_publishes = ConfigInt(
+        "The number of messages each AMQP publisher may have waiting to be"
+        " published before the worker stops consuming messages until it"
+        " catches up. By default there is no limit.",
+        static=True)
 
 
 class BaseWorker(Worker):
@@ -176,12 +193,16 @@ class BaseWorker(Worker):
         if connector_name in self.connectors:
             raise DuplicateConnectorError("Attempt to add duplicate connector"
                                           " with name %r" % (connector_name,))
-        prefetch_count = self.get_static_config().amqp_prefetch_count
+        config = self.get_static_config()
         middlewares = self.middlewares if middleware else None
 
-        connector = connector_cls(self, connector_name,
-                                  prefetch_count=prefetch_count,
-                                  middlewares=middlewares)
+        connector = connector_cls(
+            self, connector_name,
+            prefetch_count=config.amqp_prefetch_count,
+            middlewares=middlewares,
+            concurrency=config.amqp_consumer_concurrency,
+            ack_batch_size=config.amqp_ack_batch_size,
+            max_outstanding=config.amqp_max_outstanding_publishes)
         self.connectors[connector_name] = connector
 
         d = connector.setup()